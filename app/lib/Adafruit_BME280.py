@@ -33,6 +33,7 @@ from __future__ import absolute_import
 from __future__ import division
 from builtins import object
 
+import hashlib
 import logging
 import time
 
@@ -47,6 +48,47 @@ BME280_OSAMPLE_4 = 3
 BME280_OSAMPLE_8 = 4
 BME280_OSAMPLE_16 = 5
 
+# Power modes
+BME280_SLEEP = 0
+BME280_FORCED = 1
+BME280_NORMAL = 3
+
+# Standby time between measurements in normal mode
+BME280_STANDBY_0_5 = 0
+BME280_STANDBY_62_5 = 1
+BME280_STANDBY_125 = 2
+BME280_STANDBY_250 = 3
+BME280_STANDBY_500 = 4
+BME280_STANDBY_1000 = 5
+BME280_STANDBY_10 = 6
+BME280_STANDBY_20 = 7
+
+# IIR filter coefficients
+BME280_FILTER_OFF = 0
+BME280_FILTER_2 = 1
+BME280_FILTER_4 = 2
+BME280_FILTER_8 = 3
+BME280_FILTER_16 = 4
+
+# Lookup tables from user-facing values to register values
+BME280_STANDBY_MS = {
+    0.5: BME280_STANDBY_0_5,
+    10: BME280_STANDBY_10,
+    20: BME280_STANDBY_20,
+    62.5: BME280_STANDBY_62_5,
+    125: BME280_STANDBY_125,
+    250: BME280_STANDBY_250,
+    500: BME280_STANDBY_500,
+    1000: BME280_STANDBY_1000
+}
+BME280_FILTER_COEFFICIENTS = {
+    0: BME280_FILTER_OFF,
+    2: BME280_FILTER_2,
+    4: BME280_FILTER_4,
+    8: BME280_FILTER_8,
+    16: BME280_FILTER_16
+}
+
 # BME280 Registers
 
 BME280_REGISTER_DIG_T1 = 0x88  # Trimming parameter registers
@@ -76,6 +118,7 @@ BME280_REGISTER_VERSION = 0xD1
 BME280_REGISTER_SOFTRESET = 0xE0
 
 BME280_REGISTER_CONTROL_HUM = 0xF2
+BME280_REGISTER_STATUS = 0xF3
 BME280_REGISTER_CONTROL = 0xF4
 BME280_REGISTER_CONFIG = 0xF5
 BME280_REGISTER_PRESSURE_DATA = 0xF7
@@ -83,8 +126,37 @@ BME280_REGISTER_TEMP_DATA = 0xFA
 BME280_REGISTER_HUMIDITY_DATA = 0xFD
 
 
+# Calibration (trimming) parameters stored on the chip
+BME280_CALIBRATION_PARAMS = [
+    'dig_T1', 'dig_T2', 'dig_T3',
+    'dig_P1', 'dig_P2', 'dig_P3', 'dig_P4', 'dig_P5', 'dig_P6', 'dig_P7',
+    'dig_P8', 'dig_P9',
+    'dig_H1', 'dig_H2', 'dig_H3', 'dig_H4', 'dig_H5', 'dig_H6'
+]
+
+
+def _s8(value):
+    """Converts an unsigned byte to a signed value."""
+    return value - 256 if value > 127 else value
+
+
+def _u16le(data, offset):
+    """Reads an unsigned little endian 16-bit value from a byte list."""
+    return data[offset] | (data[offset + 1] << 8)
+
+
+def _s16le(data, offset):
+    """Reads a signed little endian 16-bit value from a byte list."""
+    result = _u16le(data, offset)
+    if result > 32767:
+        result -= 65536
+    return result
+
+
 class BME280(object):
     def __init__(self, mode=BME280_OSAMPLE_1, address=BME280_I2CADDR, i2c=None,
+                 calibration=None, power_mode=BME280_FORCED,
+                 standby=BME280_STANDBY_1000, iir_filter=BME280_FILTER_OFF,
                  **kwargs):
         self._logger = logging.getLogger('Adafruit_BMP.BMP085')
         # Check that mode is valid.
@@ -97,62 +169,152 @@ class BME280(object):
                 .format(mode)
             )
         self._mode = mode
+        if power_mode not in [BME280_FORCED, BME280_NORMAL]:
+            raise ValueError(
+                'Unexpected power mode value {0}.  Set power mode to one of '
+                'BME280_FORCED or BME280_NORMAL'.format(power_mode)
+            )
+        self._power_mode = power_mode
+        self._standby = standby
+        self._iir_filter = iir_filter
         # Create I2C device.
         if i2c is None:
             from .Adafruit_GPIO import I2C as i2c
         self._device = i2c.get_i2c_device(address, **kwargs)
-        # Load calibration values.
-        self._load_calibration()
-        self._device.write8(BME280_REGISTER_CONTROL, 0x3F)
+        self.address = address
+        self.chip_id = self._device.readU8(BME280_REGISTER_CHIPID)
+        # Load calibration values, reusing previously parsed values if
+        # they were supplied (as a dict keyed by calibration_key). The
+        # chip ID is the same for every BME280, so the key is made from
+        # the address and the calibration registers themselves.
+        cal1, cal2 = self._read_calibration()
+        self.calibration_key = '{:#04x}-{}'.format(
+            address, hashlib.sha1(bytearray(cal1 + cal2)).hexdigest()[:16]
+        )
+        if calibration and self.calibration_key in calibration:
+            self.set_calibration(calibration[self.calibration_key])
+        else:
+            self._load_calibration(cal1, cal2)
+        self._configure()
         self.t_fine = 0.0
 
-    def _load_calibration(self):
+    def _configure(self):
+        """Writes the oversampling, standby and filter settings. In
+        normal mode the chip then samples continuously and the data
+        registers always hold the latest measurement."""
+        # The config register is only writable in sleep mode
+        self._device.write8(BME280_REGISTER_CONTROL, BME280_SLEEP)
+        self._device.write8(
+            BME280_REGISTER_CONFIG,
+            (self._standby << 5) | (self._iir_filter << 2)
+        )
+        # Humidity oversampling only takes effect after the control
+        # register is written
+        self._device.write8(BME280_REGISTER_CONTROL_HUM, self._mode)
+        if self._power_mode == BME280_NORMAL:
+            self._device.write8(
+                BME280_REGISTER_CONTROL,
+                self._mode << 5 | self._mode << 2 | BME280_NORMAL
+            )
+
+    def _read_calibration(self):
+        """Reads the raw calibration registers using one block read for
+        each of the two calibration register ranges."""
+        # 0x88 - 0xA1: dig_T1 - dig_P9, (0xA0 unused), dig_H1
+        cal1 = list(self._device.readList(BME280_REGISTER_DIG_T1, 26))
+        # 0xE1 - 0xE7: dig_H2 - dig_H6
+        cal2 = list(self._device.readList(BME280_REGISTER_DIG_H2, 7))
+        return (cal1, cal2)
 
-        self.dig_T1 = self._device.readU16LE(BME280_REGISTER_DIG_T1)
-        self.dig_T2 = self._device.readS16LE(BME280_REGISTER_DIG_T2)
-        self.dig_T3 = self._device.readS16LE(BME280_REGISTER_DIG_T3)
+    def _load_calibration(self, cal1, cal2):
+        """Parses the calibration parameters from the raw calibration
+        registers."""
+        self.dig_T1 = _u16le(cal1, 0)
+        self.dig_T2 = _s16le(cal1, 2)
+        self.dig_T3 = _s16le(cal1, 4)
 
-        self.dig_P1 = self._device.readU16LE(BME280_REGISTER_DIG_P1)
-        self.dig_P2 = self._device.readS16LE(BME280_REGISTER_DIG_P2)
-        self.dig_P3 = self._device.readS16LE(BME280_REGISTER_DIG_P3)
-        self.dig_P4 = self._device.readS16LE(BME280_REGISTER_DIG_P4)
-        self.dig_P5 = self._device.readS16LE(BME280_REGISTER_DIG_P5)
-        self.dig_P6 = self._device.readS16LE(BME280_REGISTER_DIG_P6)
-        self.dig_P7 = self._device.readS16LE(BME280_REGISTER_DIG_P7)
-        self.dig_P8 = self._device.readS16LE(BME280_REGISTER_DIG_P8)
-        self.dig_P9 = self._device.readS16LE(BME280_REGISTER_DIG_P9)
+        self.dig_P1 = _u16le(cal1, 6)
+        self.dig_P2 = _s16le(cal1, 8)
+        self.dig_P3 = _s16le(cal1, 10)
+        self.dig_P4 = _s16le(cal1, 12)
+        self.dig_P5 = _s16le(cal1, 14)
+        self.dig_P6 = _s16le(cal1, 16)
+        self.dig_P7 = _s16le(cal1, 18)
+        self.dig_P8 = _s16le(cal1, 20)
+        self.dig_P9 = _s16le(cal1, 22)
 
-        self.dig_H1 = self._device.readU8(BME280_REGISTER_DIG_H1)
-        self.dig_H2 = self._device.readS16LE(BME280_REGISTER_DIG_H2)
-        self.dig_H3 = self._device.readU8(BME280_REGISTER_DIG_H3)
-        self.dig_H6 = self._device.readS8(BME280_REGISTER_DIG_H7)
+        self.dig_H1 = cal1[25]
+        self.dig_H2 = _s16le(cal2, 0)
+        self.dig_H3 = cal2[2]
+        self.dig_H6 = _s8(cal2[6])
 
-        h4 = self._device.readS8(BME280_REGISTER_DIG_H4)
+        h4 = _s8(cal2[3])
         h4 = (h4 << 24) >> 20
-        self.dig_H4 = h4 | (self._device.readU8(BME280_REGISTER_DIG_H5) & 0x0F)
+        self.dig_H4 = h4 | (cal2[4] & 0x0F)
 
-        h5 = self._device.readS8(BME280_REGISTER_DIG_H6)
+        h5 = _s8(cal2[5])
         h5 = (h5 << 24) >> 20
-        self.dig_H5 = h5 | (
-            self._device.readU8(BME280_REGISTER_DIG_H5) >> 4 & 0x0F
-        )
+        self.dig_H5 = h5 | (cal2[4] >> 4 & 0x0F)
 
-    def read_raw_temp(self):
-        """Reads the raw (uncompensated) temperature from the sensor."""
+    def get_calibration(self):
+        """Returns the calibration parameters read from the chip as a
+        dict that can be passed back to the constructor."""
+        calibration = {'chip_id': self.chip_id}
+        for param in BME280_CALIBRATION_PARAMS:
+            calibration[param] = getattr(self, param)
+        return calibration
+
+    def set_calibration(self, calibration):
+        """Sets the calibration parameters without reading them from the
+        chip."""
+        for param in BME280_CALIBRATION_PARAMS:
+            setattr(self, param, calibration[param])
+
+    def _start_measurement(self):
+        """Triggers a forced mode measurement and waits for it to
+        complete. In normal mode this returns immediately because the
+        data registers already hold the latest measurement."""
+        if self._power_mode == BME280_NORMAL:
+            return
         meas = self._mode
         self._device.write8(BME280_REGISTER_CONTROL_HUM, meas)
-        meas = self._mode << 5 | self._mode << 2 | 1
+        meas = self._mode << 5 | self._mode << 2 | BME280_FORCED
         self._device.write8(BME280_REGISTER_CONTROL, meas)
-        sleep_time = 0.00125 + 0.0023 * (1 << self._mode)
-        sleep_time = sleep_time + 0.0023 * (1 << self._mode) + 0.000575
-        sleep_time = sleep_time + 0.0023 * (1 << self._mode) + 0.000575
-        time.sleep(sleep_time)  # Wait the required time
+        # Typical and maximum measurement times from the datasheet
+        oversampling = 1 << (self._mode - 1)
+        typical_time = 0.001 + 0.002 * oversampling * 3 + 0.001
+        max_time = 0.00125 + 0.0023 * oversampling * 3 + 0.000575 * 2
+        time.sleep(typical_time)
+        # Poll the measuring bit rather than waiting for the worst case
+        deadline = time.time() + (max_time - typical_time)
+        while self._device.readU8(BME280_REGISTER_STATUS) & 0x08:
+            if time.time() > deadline:
+                break
+            time.sleep(0.0005)
+
+    def read_raw_temp(self):
+        """Reads the raw (uncompensated) temperature from the sensor."""
+        self._start_measurement()
         msb = self._device.readU8(BME280_REGISTER_TEMP_DATA)
         lsb = self._device.readU8(BME280_REGISTER_TEMP_DATA + 1)
         xlsb = self._device.readU8(BME280_REGISTER_TEMP_DATA + 2)
         raw = ((msb << 16) | (lsb << 8) | xlsb) >> 4
         return raw
 
+    def read_raw_all(self):
+        """Reads the raw (uncompensated) temperature, pressure and
+        humidity values with a single block read of the data registers.
+        Returns a (temperature, pressure, humidity) tuple.
+        """
+        self._start_measurement()
+        # 0xF7 - 0xFE: press_msb ... press_xlsb, temp_msb ... temp_xlsb,
+        # hum_msb, hum_lsb
+        data = self._device.readList(BME280_REGISTER_PRESSURE_DATA, 8)
+        raw_pressure = ((data[0] << 16) | (data[1] << 8) | data[2]) >> 4
+        raw_temp = ((data[3] << 16) | (data[4] << 8) | data[5]) >> 4
+        raw_humidity = (data[6] << 8) | data[7]
+        return (raw_temp, raw_pressure, raw_humidity)
+
     def read_raw_pressure(self):
         """Reads the raw (uncompensated) pressure level from the sensor.
         Assumes that the temperature has already been read
@@ -175,8 +337,30 @@ class BME280(object):
 
     def read_temperature(self):
         """Gets the compensated temperature in degrees celsius."""
+        return self._compensate_temperature(self.read_raw_temp())
+
+    def read_pressure(self):
+        """Gets the compensated pressure in Pascals."""
+        return self._compensate_pressure(self.read_raw_pressure())
+
+    def read_humidity(self):
+        return self._compensate_humidity(self.read_raw_humidity())
+
+    def read_all(self):
+        """Gets the compensated temperature (degrees celsius), pressure
+        (Pascals) and relative humidity from one measurement, using a
+        single block read. Returns a (temperature, pressure, humidity)
+        tuple.
+        """
+        raw_temp, raw_pressure, raw_humidity = self.read_raw_all()
+        temp = self._compensate_temperature(raw_temp)
+        pressure = self._compensate_pressure(raw_pressure)
+        humidity = self._compensate_humidity(raw_humidity)
+        return (temp, pressure, humidity)
+
+    def _compensate_temperature(self, adc):
         # float in Python is double precision
-        UT = float(self.read_raw_temp())
+        UT = float(adc)
         var1 = (UT / 16384.0 - self.dig_T1 / 1024.0) * float(self.dig_T2)
         var2 = (
             ((UT / 131072.0 - self.dig_T1 / 8192.0)
@@ -186,9 +370,7 @@ class BME280(object):
         temp = (var1 + var2) / 5120.0
         return temp
 
-    def read_pressure(self):
-        """Gets the compensated pressure in Pascals."""
-        adc = self.read_raw_pressure()
+    def _compensate_pressure(self, adc):
         var1 = self.t_fine / 2.0 - 64000.0
         var2 = var1 * var1 * self.dig_P6 / 32768.0
         var2 = var2 + var1 * self.dig_P5 * 2.0
@@ -206,8 +388,7 @@ class BME280(object):
         p = p + (var1 + var2 + self.dig_P7) / 16.0
         return p
 
-    def read_humidity(self):
-        adc = self.read_raw_humidity()
+    def _compensate_humidity(self, adc):
         # print 'Raw humidity = {0:d}'.format (adc)
         h = self.t_fine - 76800.0
         h = (
@@ -0,0 +1,414 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+
+import sqlite3
+import threading
+import time
+import os
+import logging
+from .nido import Status
+
+
+class HistoryError(Exception):
+    """Exception class for errors generated by the history store"""
+
+    def __init__(self, msg):
+        self.msg = msg
+        return
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+class History(object):
+    """Time-series store for sensor readings and HVAC state.
+
+    Raw samples are kept in the samples table. Every sample is also
+    folded into the rollups table at 1 minute, 15 minute and 1 hour
+    resolution as it is recorded, so charts over long periods read a
+    handful of pre-aggregated rows instead of scanning raw samples.
+    Changes of HVAC status are recorded in the events table as the
+    controller makes them, with record_event().
+
+    Each resolution (0 for raw samples) has its own retention period in
+    seconds; None keeps data forever.
+
+    Reads go through snapshot(). A History opened with readonly=True
+    (eg. by the web server) only ever opens read-only connections, it
+    doesn't create the database or its tables.
+    """
+
+    RAW = 0
+    RESOLUTIONS = [60, 900, 3600]
+    DEFAULT_RETENTION = {
+        0: 7 * 86400,
+        60: 30 * 86400,
+        900: 365 * 86400,
+        3600: None
+    }
+    # How often old data is pruned, in seconds
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, db_path, retention=None, readonly=False):
+        self._l = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._db_path = db_path
+        self._retention = dict(self.DEFAULT_RETENTION)
+        if retention:
+            self._retention.update(retention)
+        self._last_status = None
+        self._last_prune = 0
+        self._db = None
+        if readonly:
+            return
+        try:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._create_tables()
+        except sqlite3.Error as e:
+            raise HistoryError(
+                'Error opening history database: {}'.format(e)
+            )
+        return
+
+    def _create_tables(self):
+        with self._lock:
+            # WAL lets the web server read while the daemon writes
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS samples ('
+                '  ts REAL NOT NULL,'
+                '  temp_c REAL,'
+                '  relative_humidity REAL,'
+                '  pressure_mb REAL,'
+                '  set_temp REAL,'
+                '  mode TEXT,'
+                '  status INTEGER'
+                ')'
+            )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS rollups ('
+                '  resolution INTEGER NOT NULL,'
+                '  bucket INTEGER NOT NULL,'
+                '  count INTEGER NOT NULL DEFAULT 0,'
+                '  temp_sum REAL NOT NULL DEFAULT 0,'
+                '  temp_min REAL,'
+                '  temp_max REAL,'
+                '  rh_sum REAL NOT NULL DEFAULT 0,'
+                '  pressure_sum REAL NOT NULL DEFAULT 0,'
+                '  set_temp REAL,'
+                '  mode TEXT,'
+                '  heating INTEGER NOT NULL DEFAULT 0,'
+                '  cooling INTEGER NOT NULL DEFAULT 0,'
+                '  PRIMARY KEY (resolution, bucket)'
+                ')'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                '  ts REAL NOT NULL,'
+                '  status INTEGER,'
+                '  mode TEXT,'
+                '  set_temp REAL'
+                ')'
+            )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS events_ts ON events (ts)'
+            )
+            self._db.commit()
+            row = self._db.execute(
+                'SELECT status FROM events ORDER BY ts DESC LIMIT 1'
+            ).fetchone()
+            if row is not None:
+                self._last_status = row[0]
+        return
+
+    @classmethod
+    def from_config(cls, config, readonly=False):
+        """Creates a History instance from the history section of the
+        configuration, or returns None if no database is configured.
+        Retention periods are given in days, 0 keeps data forever."""
+        history_cfg = config['history']
+        if not history_cfg.get('db'):
+            return None
+        retention = {}
+        for resolution, setting in [(cls.RAW, 'retention_raw_days'),
+                                    (60, 'retention_1m_days'),
+                                    (900, 'retention_15m_days'),
+                                    (3600, 'retention_1h_days')]:
+            days = history_cfg[setting]
+            retention[resolution] = days * 86400 if days else None
+        return cls(history_cfg['db'], retention=retention,
+                   readonly=readonly)
+
+    def _check_writable(self):
+        if self._db is None:
+            raise HistoryError('The history database is open read-only.')
+        return
+
+    def record(self, ts, conditions, set_temp, mode, status):
+        """Records one sample and updates the rollups incrementally.
+
+        conditions is the 'conditions' dict returned by
+        Sensor.get_conditions(), status is a Status value.
+        """
+        temp = conditions['temp_c']
+        rh = conditions['relative_humidity']
+        pressure = conditions['pressure_mb']
+        heating = 1 if status == Status.Heating.value else 0
+        cooling = 1 if status == Status.Cooling.value else 0
+
+        self._check_writable()
+        with self._lock:
+            try:
+                self._db.execute(
+                    'INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (ts, temp, rh, pressure, set_temp, mode, status)
+                )
+                for resolution in self.RESOLUTIONS:
+                    bucket = int(ts // resolution * resolution)
+                    self._db.execute(
+                        'INSERT OR IGNORE INTO rollups (resolution, bucket, '
+                        'temp_min, temp_max) VALUES (?, ?, ?, ?)',
+                        (resolution, bucket, temp, temp)
+                    )
+                    self._db.execute(
+                        'UPDATE rollups SET count = count + 1, '
+                        'temp_sum = temp_sum + ?, '
+                        'temp_min = MIN(temp_min, ?), '
+                        'temp_max = MAX(temp_max, ?), '
+                        'rh_sum = rh_sum + ?, '
+                        'pressure_sum = pressure_sum + ?, '
+                        'set_temp = ?, mode = ?, '
+                        'heating = heating + ?, cooling = cooling + ? '
+                        'WHERE resolution = ? AND bucket = ?',
+                        (temp, temp, temp, rh, pressure, set_temp, mode,
+                         heating, cooling, resolution, bucket)
+                    )
+                self._db.commit()
+            except sqlite3.Error as e:
+                self._db.rollback()
+                raise HistoryError('Error recording sample: {}'.format(e))
+
+        if ts - self._last_prune > self.PRUNE_INTERVAL:
+            self.prune(now=ts)
+        return
+
+    def record_event(self, ts, status, mode, set_temp):
+        """Records a change of HVAC status (a Status value) at ts,
+        unless it's the status last recorded."""
+        self._check_writable()
+        with self._lock:
+            if status == self._last_status:
+                return
+            try:
+                self._db.execute(
+                    'INSERT INTO events VALUES (?, ?, ?, ?)',
+                    (ts, status, mode, set_temp)
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                self._db.rollback()
+                raise HistoryError('Error recording event: {}'.format(e))
+            self._last_status = status
+        return
+
+    def prune(self, now=None):
+        """Deletes data older than the retention period of each
+        resolution."""
+        if now is None:
+            now = time.time()
+        self._check_writable()
+        with self._lock:
+            try:
+                raw_retention = self._retention[self.RAW]
+                if raw_retention is not None:
+                    self._db.execute('DELETE FROM samples WHERE ts < ?',
+                                     (now - raw_retention,))
+                    self._db.execute('DELETE FROM events WHERE ts < ?',
+                                     (now - raw_retention,))
+                for resolution in self.RESOLUTIONS:
+                    retention = self._retention.get(resolution)
+                    if retention is None:
+                        continue
+                    self._db.execute(
+                        'DELETE FROM rollups '
+                        'WHERE resolution = ? AND bucket < ?',
+                        (resolution, now - retention)
+                    )
+                self._db.commit()
+            except sqlite3.Error as e:
+                self._db.rollback()
+                raise HistoryError('Error pruning history: {}'.format(e))
+            self._last_prune = now
+        self._l.debug('History pruned')
+        return
+
+    # Columns available from get_columns(). Rollup values are averages
+    # over each bucket; heating and cooling are duty cycles (0 - 1).
+    COLUMNS = {
+        'ts': ('ts', 'bucket'),
+        'temp_c': ('temp_c', 'temp_sum / count'),
+        'temp_min': ('temp_c', 'temp_min'),
+        'temp_max': ('temp_c', 'temp_max'),
+        'relative_humidity': ('relative_humidity', 'rh_sum / count'),
+        'pressure_mb': ('pressure_mb', 'pressure_sum / count'),
+        'set_temp': ('set_temp', 'set_temp'),
+        'mode': ('mode', 'mode'),
+        'heating': ('status = {}'.format(Status.Heating.value),
+                    'CAST(heating AS REAL) / count'),
+        'cooling': ('status = {}'.format(Status.Cooling.value),
+                    'CAST(cooling AS REAL) / count')
+    }
+    COLUMN_ORDER = ['ts', 'temp_c', 'temp_min', 'temp_max',
+                    'relative_humidity', 'pressure_mb', 'set_temp', 'mode',
+                    'heating', 'cooling']
+
+    def choose_resolution(self, start, end, max_points=1000, now=None):
+        """Returns the finest resolution that covers start - end in at
+        most max_points rows and is still retained for that period."""
+        if now is None:
+            now = time.time()
+        span = max(end - start, 0)
+        for resolution in [self.RAW] + self.RESOLUTIONS:
+            retention = self._retention.get(resolution)
+            if retention is not None and start < now - retention:
+                continue
+            # Raw samples arrive roughly every sample interval, assume
+            # no more than one every 10 seconds
+            if span / (resolution or 10) <= max_points:
+                return resolution
+        return self.RESOLUTIONS[-1]
+
+    def _column_query(self, column, start, end, resolution):
+        if column not in self.COLUMNS:
+            raise HistoryError('Unknown history column: {}'.format(column))
+        raw_expr, rollup_expr = self.COLUMNS[column]
+        if resolution == self.RAW:
+            query = (
+                'SELECT {} FROM samples WHERE ts >= ? AND ts < ? '
+                'ORDER BY ts'.format(raw_expr)
+            )
+            params = (start, end)
+        else:
+            query = (
+                'SELECT {} FROM rollups WHERE resolution = ? AND '
+                'bucket >= ? AND bucket < ? ORDER BY bucket'
+                .format(rollup_expr)
+            )
+            params = (resolution, start // resolution * resolution, end)
+        return query, params
+
+    def snapshot(self):
+        """Returns a HistorySnapshot for reading, which must be
+        closed."""
+        return HistorySnapshot(self)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+        return
+
+
+class HistorySnapshot(object):
+    """Read-only view of the history database at one point in time.
+
+    Everything read from a snapshot, events and columns alike, comes
+    from the same read transaction, so the results stay consistent with
+    each other even if the daemon records or prunes meanwhile. Each
+    snapshot has its own connection, letting several requests read
+    concurrently with the daemon writing; close() releases it.
+    """
+
+    def __init__(self, history):
+        self._history = history
+        self._db = None
+        # Connecting would create a missing database
+        if not os.path.isfile(history._db_path):
+            raise HistoryError('The history database does not exist yet.')
+        try:
+            self._db = sqlite3.connect(history._db_path,
+                                       isolation_level=None,
+                                       check_same_thread=False)
+            self._db.execute('PRAGMA query_only = ON')
+            # The read transaction's snapshot is taken by its first
+            # read, so take it now
+            self._db.execute('BEGIN')
+            self._db.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        except sqlite3.Error as e:
+            self.close()
+            raise HistoryError('Error reading history: {}'.format(e))
+        return
+
+    def get_events(self, start, end):
+        """Returns the HVAC status changes between start and end as
+        dicts with ts, status, mode and set_temp, in time order. The
+        change in effect at start, if any, is included first."""
+        try:
+            rows = self._db.execute(
+                'SELECT ts, status, mode, set_temp FROM ('
+                '  SELECT * FROM events WHERE ts < ? '
+                '  ORDER BY ts DESC LIMIT 1'
+                ') UNION ALL '
+                'SELECT ts, status, mode, set_temp FROM events '
+                'WHERE ts >= ? AND ts < ? ORDER BY ts',
+                (start, start, end)
+            ).fetchall()
+        except sqlite3.Error as e:
+            raise HistoryError('Error reading events: {}'.format(e))
+        return [{'ts': ts, 'status': status, 'mode': mode,
+                 'set_temp': set_temp} for ts, status, mode, set_temp in rows]
+
+    def iter_columns(self, columns, start, end, resolution):
+        """Returns a list of (column, values) pairs for the columns
+        between start and end, in time order. The values are read lazily,
+        without loading the whole result into memory, and must be read
+        before the snapshot is closed."""
+        history = self._history
+        if (resolution != history.RAW
+                and resolution not in history.RESOLUTIONS):
+            raise HistoryError(
+                'Unknown history resolution: {}'.format(resolution)
+            )
+        queries = [history._column_query(column, start, end, resolution)
+                   for column in columns]
+
+        def values(query, params):
+            for row in self._db.execute(query, params):
+                yield row[0]
+
+        return [(column, values(query, params))
+                for column, (query, params) in zip(columns, queries)]
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        return
@@ -27,41 +27,97 @@ from builtins import map
 from builtins import str
 from builtins import object
 
-import requests
-from requests import RequestException
+import copy
+import json
 import time
+import queue
+import threading
+import tempfile
+import shutil
 import yaml
 import os
-import re
 import logging
 from enum import Enum
+from functools import wraps
+from . import metrics
+from . import tracing
+from . import weather
 
 if 'NIDO_TESTING' in os.environ:
     from .testing import FakeGPIO, FakeSensor as BME280
-    GPIO = FakeGPIO(os.environ['NIDO_TESTING_GPIO'])
+    GPIO = FakeGPIO(
+        os.environ.get('NIDO_TESTING_GPIO') or None,
+        flush_delay=float(os.environ.get('NIDO_TESTING_GPIO_FLUSH', 0))
+    )
     BME280_OSAMPLE_8 = None
 else:
     import RPi.GPIO as GPIO
     from .Adafruit_BME280 import BME280, BME280_OSAMPLE_8
+from .Adafruit_BME280 import (BME280_FORCED, BME280_NORMAL, BME280_STANDBY_MS,
+                              BME280_FILTER_COEFFICIENTS)
 
 _NIDO_BASE = os.environ['NIDO_BASE']
 
+_SENSOR_READ_SECONDS = metrics.histogram(
+    'nido_sensor_read_seconds', 'Time taken to read the sensor.'
+)
+_CONTROLLER_UPDATE_SECONDS = metrics.histogram(
+    'nido_controller_update_seconds', 'Time taken by Controller.update().'
+)
+_RELAY_TRANSITIONS = metrics.counter(
+    'nido_relay_transitions_total', 'Relay pin changes.',
+    labels=('relay', 'state')
+)
+_WEATHER_REQUESTS = metrics.counter(
+    'nido_weather_cache_requests_total',
+    'Weather requests by cache result (hit, stale or miss).',
+    labels=('result',)
+)
+_CONFIG_CACHE_REQUESTS = metrics.counter(
+    'nido_config_cache_requests_total',
+    'Configuration reads by cache result (hit or miss).',
+    labels=('result',)
+)
+_CONFIG_LOAD_SECONDS = metrics.histogram(
+    'nido_config_load_seconds', 'Time taken to parse config.yaml.'
+)
+_CONFIG_SAVE_SECONDS = metrics.histogram(
+    'nido_config_save_seconds', 'Time taken to write config.yaml.'
+)
+
 # Enums:
 #   Mode
 #   Status
 #   FormTypes
 # Weather data:
+#   WeatherCache
 #   LocalWeather
 # Hardware data:
 #   Sensor
+#   SensorSampler
 # Hardware control:
 #   ControllerError
 #   Controller
+#   ControllerEngine
 # Configuration:
 #   ConfigError
+#   ConfigCache
 #   Config
 
 
+def _synchronized(func):
+    """Decorator that serialises calls to a method using the class-level
+    _lock of its instance, as the web server handles requests on
+    multiple threads."""
+
+    @wraps(func)
+    def locked(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+
+    return locked
+
+
 class Mode(Enum):
     Off = 0
     Heat = 1
@@ -85,20 +141,102 @@ class FormTypes(Enum):
 
 
 class Sensor(object):
+    """Reads conditions from the BME280 sensor.
+
+    The underlying BME280 device is created once per process and mode,
+    and shared by every Sensor instance, so calibration data is only
+    read from the chip the first time. If sensor:calibration_file is
+    set in config.yaml, the calibration is also persisted there and
+    reused across restarts. Entries are keyed by I2C address and a hash
+    of the calibration registers, so a replaced sensor never gets the
+    old part's calibration.
+
+    By default the chip runs in normal mode, sampling continuously every
+    sensor:standby_ms milliseconds (filtered by sensor:iir_filter), so
+    reads return immediately. Set sensor:mode to 'forced' to trigger a
+    measurement on each read instead.
+    """
+
+    _devices = {}
+    _lock = threading.RLock()
+
     def __init__(self, mode=BME280_OSAMPLE_8):
-        self.sensor = BME280(mode)
         self._l = logging.getLogger(__name__)
+        self.sensor = self._get_device(mode)
         return None
 
+    @classmethod
+    def _get_device(cls, mode):
+        with cls._lock:
+            if mode not in cls._devices:
+                cls._devices[mode] = cls._create_device(mode)
+            return cls._devices[mode]
+
+    @classmethod
+    def _create_device(cls, mode):
+        log = logging.getLogger(__name__)
+        config = Config().get_config()
+        calibration_file = config['sensor'].get('calibration_file')
+        calibrations = {}
+        if calibration_file and os.path.isfile(calibration_file):
+            try:
+                with open(calibration_file, 'r') as f:
+                    calibrations = yaml.load(f, Loader=yaml.Loader) or {}
+            except (IOError, yaml.YAMLError) as e:
+                log.warning('Error loading sensor calibration: {}'.format(e))
+                calibrations = {}
+
+        sensor_cfg = config['sensor']
+        try:
+            power_mode = {
+                'forced': BME280_FORCED,
+                'normal': BME280_NORMAL
+            }[sensor_cfg['mode'].lower()]
+            standby = BME280_STANDBY_MS[sensor_cfg['standby_ms']]
+            iir_filter = BME280_FILTER_COEFFICIENTS[sensor_cfg['iir_filter']]
+        except KeyError as e:
+            raise ConfigError('Invalid sensor setting: {}'.format(e))
+
+        # The calibration key isn't known until the device is opened, so
+        # the driver picks the matching entry
+        device = BME280(mode, calibration=calibrations,
+                        power_mode=power_mode, standby=standby,
+                        iir_filter=iir_filter)
+        calibration = device.get_calibration()
+        key = device.calibration_key
+        if (calibration_file and calibration
+                and calibrations.get(key) != calibration):
+            # Drop entries for a previous sensor at the same address, and
+            # those keyed by chip ID by older versions
+            prefix = '{:#04x}-'.format(device.address)
+            calibrations = dict(
+                (k, v) for k, v in calibrations.items()
+                if not isinstance(k, int) and not str(k).startswith(prefix)
+            )
+            calibrations[key] = calibration
+            try:
+                with open(calibration_file, 'w') as f:
+                    yaml.dump(calibrations, f, default_flow_style=False,
+                              indent=4)
+            except IOError as e:
+                log.warning('Error saving sensor calibration: {}'.format(e))
+            else:
+                log.debug('Sensor calibration saved to {}'
+                          .format(calibration_file))
+        return device
+
     def get_conditions(self):
         # Initialize response dict
         resp = {}
 
         # Get sensor data
         try:
-            temp_c = self.sensor.read_temperature()
-            pressure_mb = self.sensor.read_pressure() / 100
-            relative_humidity = self.sensor.read_humidity()
+            # The device is shared between threads, so serialise the
+            # measurement transaction
+            with self._lock, _SENSOR_READ_SECONDS.time(), \
+                    tracing.span('sensor.read'):
+                temp_c, pressure, relative_humidity = self.sensor.read_all()
+            pressure_mb = pressure / 100
             self._l.debug(
                 'Sensor data: T = {}C | P = {} | RH = {}'
                 .format(temp_c, pressure_mb, relative_humidity)
@@ -118,6 +256,218 @@ class Sensor(object):
         return resp
 
 
+class SensorSampler(threading.Thread):
+    """Background thread that reads the sensor at a fixed interval and
+    keeps the latest reading.
+
+    The latest reading is published by replacing a single reference, so
+    readers never take a lock or touch the I2C bus. The daemon runs one
+    sampler, which serves both the controller and (via RPC) the web
+    server.
+    """
+
+    _instance = None
+
+    def __init__(self, interval):
+        super(SensorSampler, self).__init__(name='SensorSampler')
+        self.daemon = True
+        self._l = logging.getLogger(__name__)
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._listeners = []
+        self._latest = None
+        return
+
+    @classmethod
+    def get_instance(cls):
+        return cls._instance
+
+    @classmethod
+    def start_instance(cls, interval):
+        if cls._instance is None:
+            cls._instance = cls(interval)
+            cls._instance.start()
+        return cls._instance
+
+    @classmethod
+    def stop_instance(cls):
+        if cls._instance is not None:
+            cls._instance.stop()
+            cls._instance = None
+        return
+
+    def add_listener(self, listener):
+        """Registers listener(reading) to be called from the sampler
+        thread after each new reading."""
+        self._listeners.append(listener)
+        return
+
+    def run(self):
+        self._l.debug(
+            'Sensor sampler started, interval = {}s'.format(self.interval)
+        )
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+        return
+
+    def stop(self):
+        self._stop_event.set()
+        return
+
+    def sample(self):
+        reading = Sensor().get_conditions()
+        reading['sample_time'] = time.time()
+        self._latest = reading
+        for listener in self._listeners:
+            try:
+                listener(reading)
+            except Exception as e:
+                self._l.error(
+                    'Error in sensor sample listener: {}'.format(e)
+                )
+        return reading
+
+    def get_latest(self, max_age=None):
+        """Returns the latest reading, or None if there is no reading
+        newer than max_age seconds. The returned dict must not be
+        modified."""
+        reading = self._latest
+        if reading is None:
+            return None
+        if (max_age is not None
+                and time.time() - reading['sample_time'] > max_age):
+            return None
+        return reading
+
+
+def get_sensor_conditions():
+    """Returns the latest sensor reading from this process' sampler if
+    it is running and recent, otherwise reads the sensor directly."""
+    sampler = SensorSampler.get_instance()
+    if sampler is not None:
+        reading = sampler.get_latest(max_age=sampler.interval * 3)
+        if reading is not None:
+            return reading
+    return Sensor().get_conditions()
+
+
+class WeatherCache(object):
+    """Process-wide cache of weather conditions keyed by location query.
+
+    Entries are kept in memory and, if a cache file is configured,
+    mirrored to disk so the cache is still warm after a restart. Expired
+    entries are still served while a single background refresh per
+    query fetches a new value (stale-while-revalidate). Concurrent
+    fetches for the same query share a single in-flight request.
+    """
+
+    def __init__(self):
+        self._l = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._inflight = {}
+        self._cache_file = None
+        return
+
+    def set_cache_file(self, cache_file):
+        """Sets the on-disk copy of the cache and loads it on first
+        use."""
+        with self._lock:
+            if cache_file == self._cache_file:
+                return
+            self._cache_file = cache_file
+            if not cache_file or not os.path.isfile(cache_file):
+                return
+            try:
+                with open(cache_file, 'r') as f:
+                    entries = json.load(f)
+            except (IOError, ValueError) as e:
+                self._l.warning('Error loading weather cache: {}'.format(e))
+                return
+            for query, entry in entries.items():
+                if query not in self._entries:
+                    self._entries[query] = (entry['time'],
+                                            entry['conditions'])
+        return
+
+    def get(self, query):
+        """Returns a (retrieval time, conditions) tuple, or None."""
+        return self._entries.get(query)
+
+    def set(self, query, conditions, retrieval_time=None):
+        if retrieval_time is None:
+            retrieval_time = int(time.time())
+        with self._lock:
+            self._entries[query] = (retrieval_time, conditions)
+            self._save()
+        return
+
+    def _save(self):
+        if not self._cache_file:
+            return
+        entries = {}
+        for query, (retrieval_time, conditions) in self._entries.items():
+            entries[query] = {'time': retrieval_time,
+                              'conditions': conditions}
+        cache_dir = os.path.dirname(os.path.abspath(self._cache_file))
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix='.weather.',
+                                            suffix='.tmp', dir=cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp_path, self._cache_file)
+        except (IOError, OSError) as e:
+            self._l.warning('Error saving weather cache: {}'.format(e))
+        return
+
+    def fetch(self, query, refresh):
+        """Calls refresh() and returns its result. Callers that ask for
+        the same query while a refresh is in progress wait for, and
+        share, its result instead of making another request."""
+        with self._lock:
+            flight = self._inflight.get(query)
+            leader = flight is None
+            if leader:
+                flight = {'done': threading.Event(), 'result': None}
+                self._inflight[query] = flight
+
+        if not leader:
+            flight['done'].wait()
+            return flight['result']
+
+        try:
+            flight['result'] = refresh()
+        except Exception as e:
+            self._l.error('Error refreshing weather: {}'.format(e))
+            flight['result'] = {
+                'error': 'Error retrieving local weather: {}'.format(e)
+            }
+        finally:
+            with self._lock:
+                del self._inflight[query]
+            flight['done'].set()
+        return flight['result']
+
+    def refresh_async(self, query, refresh):
+        """Calls refresh() on a background thread unless a refresh of
+        query is already in progress."""
+        with self._lock:
+            if query in self._inflight:
+                return
+
+        thread = threading.Thread(target=self.fetch, args=(query, refresh),
+                                  name='WeatherRefresh')
+        thread.daemon = True
+        thread.start()
+        return
+
+
+_WEATHER_CACHE = WeatherCache()
+_WEATHER_PROVIDERS = {}
+_WEATHER_PROVIDERS_LOCK = threading.Lock()
+
+
 class LocalWeather(object):
     def __init__(self, zipcode=None, location=None):
         self._l = logging.getLogger(__name__)
@@ -132,10 +482,15 @@ class LocalWeather(object):
         self.conditions = None
         # Unix time of last request to implement basic caching
         self.last_req = 0
+        config = Config().get_config()
         # Cache expiry period in seconds
         # 900 == 15 minutes
-        self._CACHE_EXPIRY = 900
-        self.api_key = Config().get_config()['wunderground']['api_key']
+        self._CACHE_EXPIRY = config['weather']['cache_expiry']
+        self._provider_key = json.dumps(
+            [config['weather'], config['wunderground']], sort_keys=True
+        )
+        self._config = config
+        _WEATHER_CACHE.set_cache_file(config['weather'].get('cache_file'))
 
     def set_zipcode(self, zipcode):
         if not isinstance(zipcode, int):
@@ -151,153 +506,96 @@ class LocalWeather(object):
         self.conditions = None
         return
 
-    def _wunderground_req(self, request_url):
-        try:
-            r = requests.get(request_url)
-        except RequestException as e:
-            # Making the request failed
-            resp = {}
-            resp['error'] = 'Error retrieving local weather: {}'.format(e)
-            return resp
-        else:
-            return r
+    def _get_provider(self):
+        # Providers hold state (eg. the replay position), so one is kept
+        # per weather configuration
+        with _WEATHER_PROVIDERS_LOCK:
+            provider = _WEATHER_PROVIDERS.get(self._provider_key)
+            if provider is None:
+                provider = weather.get_provider(self._config)
+                _WEATHER_PROVIDERS[self._provider_key] = provider
+        return provider
+
+    def _get_query(self):
+        # Determine location query type
+        # Prefer lat,long over zipcode
+        if (self.location is None) and (self.zipcode is None):
+            query = 'autoip'
+        elif self.location:
+            query = ','.join(map(str, self.location))
+        elif self.zipcode:
+            query = str(self.zipcode)
+        return query
 
-    def _wunderground_parse_result(self, r):
+    def _refresh(self, query):
+        """Fetches the conditions for query from the configured provider
+        and stores them in the shared cache."""
         resp = {}
-        r_json = r.json()
         try:
-            current_observation = r_json['current_observation']
-            forecast = r_json['forecast']['simpleforecast']['forecastday']
-            sun_phase = r_json['sun_phase']
-        except KeyError:
-            try:
-                api_error = r_json['response']['error']
-            except KeyError:
-                resp['error'] = (
-                    'Unknown Wunderground API error. Response data: '
-                    + str(r_json)
-                )
-            else:
-                if 'description' in api_error:
-                    resp['error'] = (
-                        'Wunderground API error ({}): {}'
-                        .format(api_error['type'], api_error['description'])
-                    )
-                else:
-                    resp['error'] = (
-                        'Wunderground API error ({})'.format(api_error['type'])
-                    )
+            with tracing.span('weather.fetch', query=query):
+                conditions = self._get_provider().get_conditions(query)
+        except weather.WeatherProviderError as e:
+            resp['error'] = e.msg
         else:
-            try:
-                # Remove '%' and format relatively humidity as a number
-                rh = re.sub('[^0-9]', '',
-                            current_observation['relative_humidity'])
-                rh = int(float(rh))
-                # Get shortest term high/low forecast
-                for period in forecast:
-                    if period['period'] == 1:
-                        fcast_high = float(period['high']['celsius'])
-                        fcast_low = float(period['low']['celsius'])
-
-                display_location = current_observation['display_location']
-                sunrise = sun_phase['sunrise']
-                sunset = sun_phase['sunset']
-                self.conditions = {
-                    'location': {
-                        'full': display_location['full'],
-                        'city': display_location['city'],
-                        'state': display_location['state'],
-                        'zipcode': display_location['zip'],
-                        'country': display_location['country'],
-                        'coordinates': {
-                            'latitude': display_location['latitude'],
-                            'longitude': display_location['longitude']
-                        }
-                    },
-                    'temp_c': current_observation['temp_c'],
-                    'relative_humidity': rh,
-                    'pressure_mb': current_observation['pressure_mb'],
-                    'condition': {
-                        'description': current_observation['weather'],
-                        'icon_url': current_observation['icon_url']
-                    },
-                    'forecast': {
-                        'high': fcast_high,
-                        'low': fcast_low
-                    },
-                    'solar': {
-                        'sunrise': int(sunrise['hour'] + sunrise['minute']),
-                        'sunset': int(sunset['hour'] + sunset['minute'])
-                    }
-                }
-                # Convert icon URL to HTTPS
-                icon_url = re.sub('(http)', 'https',
-                                  current_observation['icon_url'], count=1)
-                self.conditions['condition']['icon_url'] = icon_url
-            except KeyError as e:
-                # Something changed in the response format, generate an error
-                resp['error'] = (
-                    'Error parsing Wunderground API data: {}'.format(str(e))
-                )
-            else:
-                # Reset retrieval time
-                self.last_req = int(time.time())
-                self._interval = 0
-        finally:
-            return resp
+            _WEATHER_CACHE.set(query, conditions)
+        return resp
 
     def get_conditions(self):
         # Initialize response dict
         resp = {}
-        # How long since last retrieval?
-        self._interval = int(time.time()) - self.last_req
-        # System clock must have changed. Make cache stale.
-        if self._interval < 0:
-            self._interval = self._CACHE_EXPIRY
-        # We've never made a request.
-        if self.last_req == 0:
-            self._interval = -1
-
-        # If we made a request within caching period and have a cached
-        # result, use that instead
-        if (self.conditions and (self._interval < self._CACHE_EXPIRY)
-                and (self._interval >= 0)):
+        query = self._get_query()
+
+        cached = _WEATHER_CACHE.get(query)
+        if cached is not None:
+            self.last_req, self.conditions = cached
+            # How long since last retrieval?
+            self._interval = int(time.time()) - self.last_req
+            # System clock must have changed. Make cache stale.
+            if self._interval < 0:
+                self._interval = self._CACHE_EXPIRY
+            # Serve the cached result, refreshing it in the background
+            # if it has expired
+            if self._interval >= self._CACHE_EXPIRY:
+                _WEATHER_REQUESTS.inc(result='stale')
+                _WEATHER_CACHE.refresh_async(
+                    query, lambda: LocalWeather(
+                        zipcode=self.zipcode, location=self.location
+                    )._refresh(query)
+                )
+            else:
+                _WEATHER_REQUESTS.inc(result='hit')
             resp['weather'] = self.conditions
             resp['retrieval_age'] = self._interval
             return resp
 
-        # Determine location query type
-        # API documentation here:
-        # http://api.wunderground.com/weather/api/d/docs?d=data/index
-        # Prefer lat,long over zipcode
-        if (self.location is None) and (self.zipcode is None):
-            query = 'autoip'
-        elif self.location:
-            query = ','.join(map(str, self.location))
-        elif self.zipcode:
-            query = self.zipcode
-
-        # Get Wunderground weather conditions
-        request_url = (
-            'https://api.wunderground.com/api/{}/{}/q/{}.json'
-            .format(
-                self.api_key, 'conditions/forecast/astronomy',
-                query
-            )
-        )
-        api_response = self._wunderground_req(request_url)
-
-        if isinstance(api_response, requests.Response):
-            resp.update(self._wunderground_parse_result(api_response))
-        else:
-            resp.update(api_response)
-
-        if self.conditions:
+        # We've never made a request.
+        _WEATHER_REQUESTS.inc(result='miss')
+        self._interval = -1
+        resp.update(_WEATHER_CACHE.fetch(query,
+                                         lambda: self._refresh(query)))
+
+        cached = _WEATHER_CACHE.get(query)
+        if cached is not None:
+            self.last_req, self.conditions = cached
+            self._interval = max(int(time.time()) - self.last_req, 0)
             resp['weather'] = self.conditions
             resp['retrieval_age'] = self._interval
 
         return resp
 
+    def get_cached_conditions(self):
+        """Returns the cached conditions without waiting for a request,
+        or None if there are none yet. Missing or expired conditions are
+        refreshed in the background."""
+        query = self._get_query()
+        cached = _WEATHER_CACHE.get(query)
+        if (cached is None
+                or int(time.time()) - cached[0] >= self._CACHE_EXPIRY):
+            _WEATHER_CACHE.refresh_async(query, lambda: self._refresh(query))
+        if cached is None:
+            return None
+        return cached[1]
+
 
 class ControllerError(Exception):
     """Exception class for errors generated by the controller"""
@@ -313,10 +611,41 @@ class ControllerError(Exception):
 class Controller(object):
     """This is the controller code that determines whether the
     heating / cooling system should be enabled based on the thermostat
-    set point."""
+    set point.
 
-    def __init__(self):
+    The controller is a state machine over Status (Off, Heating,
+    Cooling). In Heat and Cool modes it calls for heating / cooling
+    once the temperature is hysteresis beyond the set point and runs
+    until the set point is reached. In Heat_Cool mode the heating and
+    cooling targets are moved apart by the deadband so the two never
+    fight each other. Transitions are held back to protect the
+    equipment from short-cycling:
+
+        min_on_time    - minimum run time before stopping
+        min_off_time   - minimum rest time before starting again
+        min_cycle_time - minimum time between successive starts
+
+    Switching directly between heating and cooling always passes
+    through Off. Setting the mode to Off stops immediately.
+
+    If optimal_start is set (see optimalstart.OptimalStart) it follows
+    the runs to learn how fast the house heats and cools, and may move
+    the set point to the next scheduled one early so that it's reached
+    on time.
+
+    clock and sensor can be replaced (eg. with a simulation), they
+    default to time.time and get_sensor_conditions.
+    """
+
+    # Serialises GPIO access between threads
+    _lock = threading.RLock()
+
+    @_synchronized
+    def __init__(self, clock=None, sensor=None, optimal_start=None):
         self._l = logging.getLogger(__name__)
+        self._clock = clock or time.time
+        self._sensor = sensor or get_sensor_conditions
+        self.optimal_start = optimal_start
         try:
             self.cfg = Config()
             config = self.cfg.get_config()
@@ -327,6 +656,7 @@ class Controller(object):
         else:
             self._HEATING = config['GPIO']['heat_pin']
             self._COOLING = config['GPIO']['cool_pin']
+            self._reconcile_interval = config['GPIO']['reconcile_interval']
 
         # Set up the GPIO pins
         GPIO.setwarnings(False)
@@ -338,65 +668,217 @@ class Controller(object):
             .format(self._HEATING, self._COOLING)
         )
 
+        # In-memory shadow of the relay pins, {pin: state}. Pins are only
+        # written when the shadow changes and are read back every
+        # reconcile_interval seconds in case something else changed them.
+        self._pins = None
+        self._last_reconcile = None
+
+        # State machine. The time of the last transition is unknown
+        # until this controller makes one, so no hold applies at first.
+        self._status = None
+        self._status_since = None
+        self._last_start = None
+        # Seconds until a transition held back by the timing limits is
+        # allowed, 0 if none is pending
+        self.hold_remaining = 0
+        self.cycles = {Status.Heating.name: 0, Status.Cooling.name: 0}
+        # Set point worked to by the last update, including any early
+        # start, None in mode Off
+        self.target_temp = None
+        self._listeners = []
+
+        return
+
+    def add_listener(self, listener):
+        """Registers listener(status, time) to be called when the
+        controller changes the HVAC status, with a Status value."""
+        self._listeners.append(listener)
+        return
+
+    @tracing.traced('gpio.reconcile')
+    def _reconcile(self, now):
+        pins = {
+            self._HEATING: bool(GPIO.input(self._HEATING)),
+            self._COOLING: bool(GPIO.input(self._COOLING))
+        }
+        if self._pins is not None and pins != self._pins:
+            self._l.warning(
+                'GPIO pins changed externally: heat = {} | cool = {}'
+                .format(pins[self._HEATING], pins[self._COOLING])
+            )
+        self._pins = pins
+        self._last_reconcile = now
+        return
+
+    def _write_pins(self, heating, cooling, force=False):
+        # Switch off before switching on so both relays are never
+        # enabled at the same time
+        pins = sorted([(self._HEATING, heating), (self._COOLING, cooling)],
+                      key=lambda p: p[1])
+        for pin, state in pins:
+            changed = self._pins is None or self._pins[pin] != state
+            if changed:
+                _RELAY_TRANSITIONS.inc(
+                    relay='heat' if pin == self._HEATING else 'cool',
+                    state='on' if state else 'off'
+                )
+            if force or changed:
+                with tracing.span('gpio.output', pin=pin, state=state):
+                    GPIO.output(pin, state)
+                self._l.debug('GPIO pin {} -> {}'
+                              .format(pin, 'on' if state else 'off'))
+        self._pins = {self._HEATING: heating, self._COOLING: cooling}
         return
 
+    @_synchronized
     def get_status(self):
-        if (GPIO.input(self._HEATING) and GPIO.input(self._COOLING)):
+        now = self._clock()
+        if (self._last_reconcile is None
+                or now - self._last_reconcile >= self._reconcile_interval):
+            self._reconcile(now)
+
+        if self._pins[self._HEATING] and self._pins[self._COOLING]:
             self._l.error('** Both heating and cooling pins enabled. **')
             self.shutdown()
             raise ControllerError(
                 'Both heating and cooling pins were enabled. '
                 'Both pins disabled as a precaution.'
             )
-        elif GPIO.input(self._HEATING):
-            self._l.debug('Get status: {}'.format(Status.Heating.name))
+        elif self._pins[self._HEATING]:
             return Status.Heating.value
-        elif GPIO.input(self._COOLING):
-            self._l.debug('Get state: {}'.format(Status.Cooling.name))
+        elif self._pins[self._COOLING]:
             return Status.Cooling.value
         else:
-            self._l.debug('Get state: {}'.format(Status.Off.name))
             return Status.Off.value
 
-    def _enable_heating(self, status, temp, set_temp, hysteresis):
-        if (temp + hysteresis) < set_temp:
-            GPIO.output(self._HEATING, True)
-            GPIO.output(self._COOLING, False)
-            self._l.debug(
-                'Enabled HEAT: {} < {}'.format(temp + hysteresis, set_temp)
-            )
-        elif (temp < set_temp) and (status is Status.Heating):
-            GPIO.output(self._HEATING, True)
-            GPIO.output(self._COOLING, False)
-            self._l.debug(
-                'Enabled HEAT: {} < {} and status = Heating'
-                .format(temp, set_temp)
-            )
-        return
+    @_synchronized
+    def get_stats(self):
+        """Returns the state machine's status and cycle counts."""
+        stats = {
+            'status': self._status.name if self._status else None,
+            'status_since': self._status_since,
+            'hold_remaining': self.hold_remaining,
+            'cycles': dict(self.cycles)
+        }
+        if self.optimal_start is not None:
+            stats['optimal_start'] = self.optimal_start.get_status()
+        return stats
+
+    @staticmethod
+    def _heat_demand(status, temp, target, hysteresis):
+        # Start once hysteresis below the target, run until it's reached
+        if status is Status.Heating:
+            return temp < target
+        return (temp + hysteresis) < target
 
-    def _enable_cooling(self, status, temp, set_temp, hysteresis):
-        if (temp + hysteresis) > set_temp:
-            GPIO.output(self._HEATING, False)
-            GPIO.output(self._COOLING, True)
-        elif (temp > set_temp) and (status is Status.Cooling):
-            GPIO.output(self._HEATING, False)
-            GPIO.output(self._COOLING, True)
+    @staticmethod
+    def _cool_demand(status, temp, target, hysteresis):
+        # Start once hysteresis above the target, run until it's reached
+        if status is Status.Cooling:
+            return temp > target
+        return (temp - hysteresis) > target
+
+    def _demand(self, mode, status, temp, set_temp, behavior):
+        hysteresis = behavior['hysteresis']
+        if mode == Mode.Heat.name:
+            heat_target = set_temp
+            cool_target = None
+        elif mode == Mode.Cool.name:
+            heat_target = None
+            cool_target = set_temp
+        elif mode == Mode.Heat_Cool.name:
+            heat_target = set_temp - behavior['deadband'] / 2
+            cool_target = set_temp + behavior['deadband'] / 2
+        else:
+            return Status.Off
+
+        if (heat_target is not None
+                and self._heat_demand(status, temp, heat_target, hysteresis)):
+            return Status.Heating
+        if (cool_target is not None
+                and self._cool_demand(status, temp, cool_target, hysteresis)):
+            return Status.Cooling
+        return Status.Off
+
+    def _apply_timing(self, status, desired, now, behavior):
+        """Returns the status to switch to, holding back transitions
+        that would violate the minimum on / off / cycle times."""
+        self.hold_remaining = 0
+        if desired is status:
+            return status
+        if self._status_since is None:
+            elapsed = float('inf')
+        else:
+            elapsed = now - self._status_since
+
+        if status is not Status.Off:
+            # Running: stop once the minimum on time has passed. A
+            # change between heating and cooling stops first.
+            wait = behavior['min_on_time'] - elapsed
+            if wait > 0:
+                self.hold_remaining = wait
+                self._l.debug('Holding {} for {:.0f}s (min_on_time)'
+                              .format(status.name, wait))
+                return status
+            return Status.Off
+
+        # Off: start once rested for the minimum off time, and the
+        # minimum cycle time since the last start has passed
+        wait = behavior['min_off_time'] - elapsed
+        if self._last_start is not None:
+            wait = max(wait,
+                       behavior['min_cycle_time'] - (now - self._last_start))
+        if wait > 0:
+            self.hold_remaining = wait
+            self._l.debug('Holding {} for {:.0f}s (min_off_time / '
+                          'min_cycle_time)'.format(desired.name, wait))
+            return Status.Off
+        return desired
+
+    def _set_status(self, status, now, force=False):
+        if status is not self._status:
+            self._l.info('Status {} -> {}'.format(
+                self._status.name if self._status else 'Unknown', status.name
+            ))
+            if self._status is not None:
+                self._status_since = now
+                if status is not Status.Off:
+                    self._last_start = now
+                    self.cycles[status.name] += 1
+            self._status = status
+            for listener in self._listeners:
+                try:
+                    listener(status.value, now)
+                except Exception as e:
+                    self._l.error(
+                        'Error in controller status listener: {}'.format(e)
+                    )
+        self._write_pins(status is Status.Heating, status is Status.Cooling,
+                         force=force)
         return
 
+    @_synchronized
     def shutdown(self):
-        GPIO.output(self._HEATING, False)
-        GPIO.output(self._COOLING, False)
+        # Always write the pins, whatever the shadow state says
+        self._set_status(Status.Off, self._clock(), force=True)
         self._l.debug('Shut down GPIO pins.')
         return
 
+    @_synchronized
     def update(self):
+        with _CONTROLLER_UPDATE_SECONDS.time(), \
+                tracing.span('Controller.update'):
+            return self._update()
+
+    def _update(self):
         config = self.cfg.get_config()
         try:
             mode = config['config']['mode_set']
-            status = self.get_status()
-            temp = Sensor().get_conditions()['conditions']['temp_c']
+            status = Status(self.get_status())
+            temp = self._sensor()['conditions']['temp_c']
             set_temp = float(config['config']['set_temperature'])
-            hysteresis = config['behavior']['hysteresis']
+            behavior = config['behavior']
         except KeyError as e:
             self.shutdown()
             raise ControllerError('Error reading Nido configuration: {}'
@@ -405,20 +887,30 @@ class Controller(object):
             self.shutdown()
             raise
 
+        now = self._clock()
+        if status is not self._status:
+            # First update, or the pins were changed behind our back
+            self._set_status(status, now)
+
+        if self.optimal_start is not None:
+            self.optimal_start.observe(now, status, temp)
+            if mode != Mode.Off.name:
+                set_temp = self.optimal_start.target(now, mode, temp,
+                                                     set_temp, behavior)
+
+        self._l.debug('Mode = {} | Set temp {}C | Temp {}C'
+                      .format(mode, set_temp, temp))
         if mode == Mode.Off.name:
-            self._l.debug('Mode = Off | Set temp {}C'.format(set_temp))
-            self.shutdown()
-        elif mode == Mode.Heat.name:
-            self._l.debug('Mode = Heat | Set temp {}C'.format(set_temp))
-            if temp < set_temp:
-                self._enable_heating(status, temp, set_temp, hysteresis)
-            else:
-                self.shutdown()
-        else:
-            # Additional modes can be enabled in future, eg. Mode.Cool,
-            # Mode.Heat_Cool
-            self.shutdown()
+            self.target_temp = None
+            self.hold_remaining = 0
+            self._set_status(Status.Off, now)
+            return
 
+        self.target_temp = set_temp
+        desired = self._demand(mode, status, temp, set_temp, behavior)
+        self._set_status(
+            self._apply_timing(status, desired, now, behavior), now
+        )
         return
 
     def daemon_running(self):
@@ -426,6 +918,144 @@ class Controller(object):
         return os.path.isfile(pid_file)
 
 
+class ControllerEngine(threading.Thread):
+    """Long-lived control loop run by the daemon.
+
+    The engine owns a single Controller for the life of the daemon and
+    re-evaluates it in response to events posted with notify():
+
+        'wakeup'   - configuration or set point changed (eg. via the
+                     web server)
+        'schedule' - a scheduled job fired
+        'sample'   - a new sensor sample is available
+
+    Wakeup and schedule events are handled immediately. Samples, and
+    the timer that runs when no events arrive, trigger an evaluation
+    only once the adaptive interval has elapsed: min_interval when the
+    temperature is at the set point the controller last worked to
+    (including an optimal start), rising linearly to max_interval when
+    it is adaptive_range degrees or more away.
+
+    Errors from the controller are logged and the relays switched off,
+    the loop carries on.
+    """
+
+    _instance = None
+
+    def __init__(self, controller, min_interval, max_interval,
+                 adaptive_range):
+        super(ControllerEngine, self).__init__(name='ControllerEngine')
+        self.daemon = True
+        self._l = logging.getLogger(__name__)
+        self.controller = controller
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._adaptive_range = adaptive_range
+        self._events = queue.Queue()
+        self._stop_event = threading.Event()
+        self._last_update = 0
+        self._interval = min_interval
+        self.updates = 0
+        return
+
+    @classmethod
+    def get_instance(cls):
+        return cls._instance
+
+    @classmethod
+    def start_instance(cls, controller, config):
+        if cls._instance is None:
+            schedule_cfg = config['schedule']
+            cls._instance = cls(
+                controller, schedule_cfg['min_interval'],
+                schedule_cfg['poll_interval'], schedule_cfg['adaptive_range']
+            )
+            cls._instance.start()
+        return cls._instance
+
+    @classmethod
+    def stop_instance(cls):
+        if cls._instance is not None:
+            cls._instance.stop()
+            cls._instance.join()
+            cls._instance = None
+        return
+
+    def notify(self, event):
+        self._events.put(event)
+        return
+
+    def stop(self):
+        self._stop_event.set()
+        self._events.put(None)
+        return
+
+    def run(self):
+        self._l.debug('Controller engine started')
+        self._evaluate('start')
+        while not self._stop_event.is_set():
+            timeout = max(
+                self._last_update + self._interval - time.time(), 0
+            )
+            try:
+                event = self._events.get(timeout=timeout)
+            except queue.Empty:
+                event = 'timer'
+            if event is None:
+                break
+
+            # Coalesce events that queued up while evaluating
+            events = set([event])
+            while True:
+                try:
+                    event = self._events.get_nowait()
+                except queue.Empty:
+                    break
+                if event is None:
+                    return
+                events.add(event)
+
+            if ('wakeup' in events or 'schedule' in events
+                    or time.time() - self._last_update >= self._interval):
+                self._evaluate(', '.join(sorted(events)))
+        return
+
+    def _evaluate(self, reason):
+        self._l.debug('Controller update: {}'.format(reason))
+        try:
+            self.controller.update()
+        except ControllerError as e:
+            self._l.error('Controller error: {}'.format(e))
+        except Exception:
+            # Keep the loop running, with the relays off, rather than
+            # leaving them latched
+            self._l.exception('Unexpected controller error')
+            try:
+                self.controller.shutdown()
+            except Exception:
+                self._l.exception('Error shutting down the controller')
+        self._last_update = time.time()
+        self.updates += 1
+        self._interval = self._next_interval()
+        # Re-evaluate as soon as a held back transition is allowed
+        if self.controller.hold_remaining:
+            self._interval = min(self._interval,
+                                 self.controller.hold_remaining)
+        return
+
+    def _next_interval(self):
+        set_temp = self.controller.target_temp
+        if set_temp is None:
+            return self._min_interval
+        try:
+            temp = self.controller._sensor()['conditions']['temp_c']
+        except (KeyError, TypeError):
+            return self._min_interval
+        distance = min(abs(temp - set_temp) / self._adaptive_range, 1)
+        return (self._min_interval
+                + (self._max_interval - self._min_interval) * distance)
+
+
 class ConfigError(Exception):
     """Exception class for errors generated by the Config class"""
 
@@ -437,8 +1067,106 @@ class ConfigError(Exception):
         return repr(self.msg)
 
 
+class ConfigCache(object):
+    """Process-wide cache of parsed configuration files.
+
+    Parsing config.yaml on every Config.get_config() call is expensive
+    on the Pi, so the parsed result is kept in memory and only re-read
+    when the file's (inode, mtime, size) signature changes. A single
+    instance is shared by every Config object in the process, i.e. by
+    both the Flask app and the daemon in their respective processes.
+
+    Each entry keeps both the configuration as persisted on disk and
+    the effective configuration (with schema defaults applied by the
+    optional prepare callback), along with the validation result.
+    Cache hits and misses are counted in the
+    nido_config_cache_requests_total metric.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        return
+
+    @staticmethod
+    def _signature(path):
+        st = os.stat(path)
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def get_entry(self, path, prepare=None):
+        """Returns the cache entry for path, re-parsing the file if it
+        has changed on disk.
+
+        prepare(config) is called on a freshly parsed configuration and
+        should apply any defaults in place and return whether the
+        configuration is valid. The returned entry is shared and must
+        not be modified by the caller.
+        """
+        signature = self._signature(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry['signature'] == signature:
+                _CONFIG_CACHE_REQUESTS.inc(result='hit')
+                return entry
+
+        with _CONFIG_LOAD_SECONDS.time(), tracing.span('config.load'):
+            with open(path, 'r') as f:
+                persisted = yaml.load(f, Loader=yaml.Loader)
+            config = copy.deepcopy(persisted)
+            valid = prepare(config) if prepare else True
+        entry = {
+            'signature': signature,
+            'persisted': persisted,
+            'config': config,
+            'valid': valid
+        }
+
+        _CONFIG_CACHE_REQUESTS.inc(result='miss')
+        with self._lock:
+            self._entries[path] = entry
+        return entry
+
+    def get(self, path, prepare=None):
+        return self.get_entry(path, prepare=prepare)['config']
+
+    def update(self, path, persisted, config):
+        """Stores the configuration for path after persisted has been
+        written to disk, so the next get() does not need to re-parse the
+        file. config is the effective configuration."""
+        with self._lock:
+            self._entries[path] = {
+                'signature': self._signature(path),
+                'persisted': persisted,
+                'config': config,
+                'valid': True
+            }
+        return
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+        return
+
+
+_CONFIG_CACHE = ConfigCache()
+
+
 class Config(object):
+    # Serialises read-modify-write updates of the configuration
+    _lock = threading.RLock()
+
+    # Settings that moved, ((old section, setting), (new section,
+    # setting)). The old ones are still read if the new ones aren't set.
+    _MOVED = [
+        (('wunderground', 'cache_expiry'), ('weather', 'cache_expiry')),
+        (('wunderground', 'cache_file'), ('weather', 'cache_file'))
+    ]
+
     def __init__(self):
+        self._l = logging.getLogger(__name__)
         self._CONFIG = '{}/app/cfg/config.yaml'.format(_NIDO_BASE)
         self._SCHEMA_VERSION = '1.3'
         self._SCHEMA = {
@@ -449,11 +1177,31 @@ class Config(object):
                 'cool_pin': {
                     'required': True
                 },
+                'reconcile_interval': {
+                    'required': False,
+                    'default': 60
+                },
             },
             'behavior': {
                 'hysteresis': {
                     'required': False,
                     'default': 0.6
+                },
+                'deadband': {
+                    'required': False,
+                    'default': 2.0
+                },
+                'min_on_time': {
+                    'required': False,
+                    'default': 180
+                },
+                'min_off_time': {
+                    'required': False,
+                    'default': 300
+                },
+                'min_cycle_time': {
+                    'required': False,
+                    'default': 600
                 }
             },
             'flask': {
@@ -464,6 +1212,14 @@ class Config(object):
                     'required': False,
                     'default': False
                 },
+                'server': {
+                    'required': False,
+                    'default': 'threadpool'
+                },
+                'threads': {
+                    'required': False,
+                    'default': 8
+                },
                 'secret_key': {
                     'required': True
                 },
@@ -480,6 +1236,40 @@ class Config(object):
             'wunderground': {
                 'api_key': {
                     'required': True
+                },
+                'api_url': {
+                    'required': False,
+                    'default': 'https://api.wunderground.com/api'
+                }
+            },
+            'weather': {
+                'provider': {
+                    'required': False,
+                    'default': 'wunderground'
+                },
+                'url': {
+                    'required': False
+                },
+                'key': {
+                    'required': False
+                },
+                'replay_file': {
+                    'required': False
+                },
+                'cache_expiry': {
+                    'required': False,
+                    'default': 900
+                },
+                'cache_file': {
+                    'required': False
+                },
+                'connect_timeout': {
+                    'required': False,
+                    'default': 5
+                },
+                'read_timeout': {
+                    'required': False,
+                    'default': 10
                 }
             },
             'google': {
@@ -516,6 +1306,125 @@ class Config(object):
                     'default': Mode.Off.name
                 }
             },
+            'sensor': {
+                'calibration_file': {
+                    'required': False
+                },
+                'mode': {
+                    'required': False,
+                    'default': 'normal'
+                },
+                'standby_ms': {
+                    'required': False,
+                    'default': 1000
+                },
+                'iir_filter': {
+                    'required': False,
+                    'default': 0
+                },
+                'sample_interval': {
+                    'required': False,
+                    'default': 10
+                }
+            },
+            'history': {
+                'db': {
+                    'required': False
+                },
+                'retention_raw_days': {
+                    'required': False,
+                    'default': 7
+                },
+                'retention_1m_days': {
+                    'required': False,
+                    'default': 30
+                },
+                'retention_15m_days': {
+                    'required': False,
+                    'default': 365
+                },
+                'retention_1h_days': {
+                    'required': False,
+                    'default': 0
+                }
+            },
+            'tracing': {
+                'file': {
+                    'required': False,
+                    'default': '/tmp/nido-trace.log'
+                },
+                'sample_rate': {
+                    'required': False,
+                    'default': 1.0
+                },
+                'max_bytes': {
+                    'required': False,
+                    'default': 1048576
+                },
+                'backup_count': {
+                    'required': False,
+                    'default': 3
+                }
+            },
+            'optimal_start': {
+                'enabled': {
+                    'required': False,
+                    'default': False
+                },
+                'model_file': {
+                    'required': False
+                },
+                'max_lead': {
+                    'required': False,
+                    'default': 10800
+                },
+                'warmup': {
+                    'required': False,
+                    'default': 120
+                },
+                'sample_span': {
+                    'required': False,
+                    'default': 900
+                },
+                'min_span': {
+                    'required': False,
+                    'default': 300
+                },
+                'forgetting': {
+                    'required': False,
+                    'default': 0.98
+                },
+                'min_samples': {
+                    'required': False,
+                    'default': 5
+                },
+                'default_heat_rate': {
+                    'required': False,
+                    'default': 0.05
+                },
+                'default_cool_rate': {
+                    'required': False,
+                    'default': 0.05
+                }
+            },
+            'metrics': {
+                'enabled': {
+                    'required': False,
+                    'default': True
+                },
+                'allow': {
+                    'required': False,
+                    'default': ['127.0.0.1', '::1']
+                },
+                'daemon_host': {
+                    'required': False,
+                    'default': 'localhost'
+                },
+                'daemon_port': {
+                    'required': False,
+                    'default': 0
+                }
+            },
             'daemon': {
                 'pid_file': {
                     'required': True
@@ -532,6 +1441,14 @@ class Config(object):
                     'required': False,
                     'default': 300
                 },
+                'min_interval': {
+                    'required': False,
+                    'default': 30
+                },
+                'adaptive_range': {
+                    'required': False,
+                    'default': 3.0
+                },
                 'db': {
                     'required': True
                 },
@@ -545,7 +1462,9 @@ class Config(object):
                 }
             }
         }
-        if self._is_valid():
+        # Validation (and application of schema defaults) happens once
+        # each time the file is parsed, not on every instantiation
+        if self._get_entry()['valid']:
             return
         else:
             raise ConfigError(
@@ -554,8 +1473,35 @@ class Config(object):
             )
 
     def get_config(self):
-        with open(self._CONFIG, 'r') as f:
-            return yaml.load(f)
+        # Callers are free to modify the returned dict, so hand out a
+        # copy of the cached configuration
+        return copy.deepcopy(self._get_entry()['config'])
+
+    def _get_entry(self):
+        return _CONFIG_CACHE.get_entry(self._CONFIG,
+                                       prepare=self._apply_schema)
+
+    def _apply_schema(self, config):
+        # Defaults are applied in memory only, _set_config() leaves
+        # them out of the file
+        self._apply_moved(config)
+        return self._is_valid(config=config, update=False)
+
+    def _apply_moved(self, config):
+        for (old_section, old), (section, setting) in self._MOVED:
+            settings = config.get(old_section)
+            if not isinstance(settings, dict) or old not in settings:
+                continue
+            if not isinstance(config.get(section), dict):
+                config[section] = {}
+            if setting in config[section]:
+                continue
+            config[section][setting] = settings[old]
+            self._l.warning(
+                '{}:{} is deprecated, please move it to {}:{} in '
+                'config.yaml'.format(old_section, old, section, setting)
+            )
+        return
 
     def get_schema(self, section):
         return self._SCHEMA[section]
@@ -563,6 +1509,7 @@ class Config(object):
     def get_version(self):
         return self._SCHEMA_VERSION
 
+    @_synchronized
     def update_config(self, new_cfg, cfg=None):
         if cfg is None:
             cfg = self.get_config()
@@ -573,24 +1520,33 @@ class Config(object):
 
         return self._is_valid(config=cfg)
 
+    @_synchronized
     def set_temp(self, temp, scale, cfg=None):
         if cfg is None:
             cfg = self.get_config()
 
         new_cfg = cfg['config']
-        scale = scale.upper()
+        celsius_temp = self.to_celsius(temp, scale)
+        if celsius_temp is not None:
+            new_cfg['set_temperature'] = celsius_temp
 
+        return self.update_config(new_cfg, cfg=cfg)
+
+    @staticmethod
+    def to_celsius(temp, scale):
+        """Converts a set point to Celsius, or returns None for an
+        unknown scale."""
+        scale = scale.upper()
         if scale == 'C':
-            new_cfg['set_temperature'] = temp
+            return temp
         elif scale == 'F':
             # The following conversion duplicates the logic in nido.js
             celsius_temp = (temp - 32) * 5 / 9
             celsius_temp = round(celsius_temp * 10) / 10
-            celsius_temp = float("{0:.1f}".format(celsius_temp))
-            new_cfg['set_temperature'] = celsius_temp
-
-        return self.update_config(new_cfg, cfg=cfg)
+            return float("{0:.1f}".format(celsius_temp))
+        return None
 
+    @_synchronized
     def set_mode(self, mode, cfg=None):
         if cfg is None:
             cfg = self.get_config()
@@ -605,9 +1561,59 @@ class Config(object):
 
         return False
 
+    @staticmethod
+    def _merge_changes(persisted, effective, config):
+        # Returns persisted updated with the settings of config that are
+        # already in the file or differ from the effective configuration
+        merged = copy.deepcopy(persisted) if persisted else {}
+        for section, settings in config.items():
+            current = effective.get(section)
+            if not (isinstance(settings, dict) and isinstance(current, dict)
+                    and isinstance(merged.get(section, {}), dict)):
+                if section in merged or settings != current:
+                    merged[section] = copy.deepcopy(settings)
+                continue
+            for setting, value in settings.items():
+                if (setting in merged.get(section, {})
+                        or setting not in current
+                        or value != current[setting]):
+                    merged.setdefault(section, {})[setting] = (
+                        copy.deepcopy(value)
+                    )
+        return merged
+
     def _set_config(self, config):
-        with open(self._CONFIG, 'w') as f:
-            yaml.dump(config, f, default_flow_style=False, indent=4)
+        # config is the effective configuration, with schema defaults.
+        # Only the settings the file already has, or that were changed,
+        # are written, so defaults stay out of the user's file.
+        entry = self._get_entry()
+        persisted = self._merge_changes(entry['persisted'], entry['config'],
+                                        config)
+        # Only write to disk (and the SD card) if something changed
+        if persisted == entry['persisted']:
+            self._l.debug('Configuration unchanged, skipping write.')
+            return
+
+        # Write to a temporary file and rename it into place so readers
+        # never see a partially written configuration
+        cfg_dir = os.path.dirname(self._CONFIG)
+        with _CONFIG_SAVE_SECONDS.time(), tracing.span('config.save'):
+            fd, tmp_path = tempfile.mkstemp(prefix='.config.', suffix='.tmp',
+                                            dir=cfg_dir)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    yaml.dump(persisted, f, default_flow_style=False,
+                              indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                shutil.copymode(self._CONFIG, tmp_path)
+                os.rename(tmp_path, self._CONFIG)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        _CONFIG_CACHE.update(self._CONFIG, persisted, copy.deepcopy(config))
+        self._l.debug('Configuration written to {}'.format(self._CONFIG))
         return
 
     def _is_valid(self, config=None, set_defaults=True, update=True):
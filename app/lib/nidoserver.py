@@ -26,14 +26,32 @@ from builtins import *
 from builtins import object
 
 import json
+import time
+import queue
+import threading
+import logging
 from functools import wraps
-from flask import session, abort, request
+from flask import session, abort, request, g, Response
 from werkzeug.routing import BaseConverter
+from werkzeug.serving import BaseWSGIServer
+from . import metrics
+from . import tracing
 from .nido import Config, ConfigError
 from .scheduler import NidoDaemonService
+from .history import History, HistoryError
 
 _CONFIG = Config()
 _PUBLIC_API_SECRET = _CONFIG.get_config()['flask']['public_api_secret']
+# Read-only History, opened by the first history request
+_HISTORY = {}
+_HISTORY_LOCK = threading.Lock()
+
+tracing.configure(_CONFIG.get_config(), 'web')
+
+_HTTP_REQUEST_SECONDS = metrics.histogram(
+    'nido_http_request_seconds', 'Time taken to handle HTTP requests.',
+    labels=('route', 'method', 'status')
+)
 
 
 class JSONResponse(object):
@@ -52,6 +70,46 @@ class JSONResponse(object):
         response.status_code = self.status
         return response
 
+    def get_flask_stream_response(self, app, columns, batch_size=500,
+                                  on_close=None):
+        """Streams self.data plus a 'columns' object of parallel arrays.
+
+        columns is a list of (name, iterable) pairs. Values are encoded
+        and sent in batches as they are produced, so memory use does not
+        grow with the number of values. on_close is called once the
+        response is finished with, whether or not it was sent in full.
+        """
+        def generate():
+            header = json.dumps(self.data, sort_keys=True,
+                                ensure_ascii=False)
+            # Reopen the object to append the columns
+            if len(self.data) > 0:
+                yield header[:-1] + ', "columns": {'
+            else:
+                yield '{"columns": {'
+            for i, (name, values) in enumerate(columns):
+                prefix = ', ' if i > 0 else ''
+                yield '{}{}: ['.format(prefix, json.dumps(name))
+                batch = []
+                first = True
+                for value in values:
+                    batch.append(json.dumps(value))
+                    if len(batch) >= batch_size:
+                        yield ('' if first else ', ') + ', '.join(batch)
+                        first = False
+                        batch = []
+                if batch:
+                    yield ('' if first else ', ') + ', '.join(batch)
+                yield ']'
+            yield '}}'
+
+        response = app.response_class(generate(),
+                                      mimetype='application/json')
+        response.status_code = self.status
+        if on_close is not None:
+            response.call_on_close(on_close)
+        return response
+
 
 # Helper function to validate JSON in requests
 # A list of tuples is passed in of the form ( 'name', type )
@@ -124,6 +182,170 @@ def set_config_helper(resp, cfg=None, mode=None, temp_scale=None):
     return resp
 
 
+def init_metrics(app):
+    """Records the latency of every request to app by route."""
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.time()
+
+    @app.after_request
+    def observe_request(response):
+        start = getattr(g, 'metrics_start', None)
+        if start is not None:
+            # Label by URL rule rather than path to keep the number of
+            # series bounded
+            rule = request.url_rule.rule if request.url_rule else 'unmatched'
+            _HTTP_REQUEST_SECONDS.observe(
+                time.time() - start, route=rule, method=request.method,
+                status=response.status_code
+            )
+        return response
+
+    return app
+
+
+def init_tracing(app):
+    """Runs every request to app in a trace span while tracing is
+    enabled."""
+
+    @app.before_request
+    def start_span():
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        g.trace_span = tracing.span('http ' + rule, method=request.method)
+        g.trace_span.__enter__()
+
+    @app.teardown_request
+    def finish_span(exc):
+        span = getattr(g, 'trace_span', None)
+        if span is not None:
+            g.trace_span = None
+            if exc is not None:
+                span.__exit__(type(exc), exc, None)
+            else:
+                span.__exit__(None, None, None)
+
+    return app
+
+
+def tracing_helper(resp, params):
+    """Enables or disables tracing in the web server and / or daemon.
+
+    params may contain 'enabled' (boolean, omit to only get the status),
+    'sample_rate' (0 - 1) and 'target' ('web', 'daemon' or 'all', the
+    default). The status of each target is returned.
+    """
+    enabled = params.get('enabled')
+    sample_rate = params.get('sample_rate')
+    target = params.get('target', 'all')
+    if target not in ('web', 'daemon', 'all'):
+        resp.data['error'] = 'Invalid target: {}'.format(target)
+        resp.status = 400
+        return resp
+    if enabled is not None and not isinstance(enabled, bool):
+        resp.data['error'] = '"enabled" must be true or false.'
+        resp.status = 400
+        return resp
+    try:
+        if sample_rate is not None:
+            sample_rate = float(sample_rate)
+    except (TypeError, ValueError):
+        resp.data['error'] = 'Invalid sample rate.'
+        resp.status = 400
+        return resp
+
+    if target in ('web', 'all'):
+        if enabled:
+            tracing.TRACER.enable(sample_rate)
+        elif enabled is not None:
+            tracing.TRACER.disable()
+        resp.data['web'] = tracing.TRACER.get_status()
+    if target in ('daemon', 'all'):
+        try:
+            resp.data['daemon'] = NidoDaemonService().set_tracing(
+                enabled, sample_rate
+            )
+        except Exception as e:
+            resp.data['warning'] = (
+                'Server error signalling daemon: {}'.format(e)
+            )
+    return resp
+
+
+def metrics_response():
+    # Prometheus scrapes without credentials, so the metrics are only
+    # served to the addresses in metrics:allow
+    metrics_cfg = _CONFIG.get_config()['metrics']
+    if not metrics_cfg['enabled']:
+        abort(404)
+    if request.remote_addr not in metrics_cfg['allow']:
+        abort(403)
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+def get_history():
+    """Returns the read-only History, or None if history is not
+    enabled."""
+    with _HISTORY_LOCK:
+        if 'history' not in _HISTORY:
+            _HISTORY['history'] = History.from_config(_CONFIG.get_config(),
+                                                      readonly=True)
+        return _HISTORY['history']
+
+
+def history_helper(app, resp, params):
+    """Returns a streamed, columnar response with the recorded history
+    between params['from'] and params['to'] (Unix time, defaulting to
+    the last 24 hours).
+
+    params['resolution'] may be 'auto' (the default), 'raw', or a
+    rollup resolution in seconds (60, 900, 3600). The HVAC status
+    changes over the period are returned in 'events'.
+    """
+    history = get_history()
+    if history is None:
+        resp.data['error'] = 'History is not enabled.'
+        resp.status = 404
+        return resp.get_flask_response(app)
+
+    try:
+        end = float(params.get('to') or time.time())
+        start = float(params.get('from') or end - 86400)
+        resolution = params.get('resolution') or 'auto'
+        if resolution == 'auto':
+            resolution = history.choose_resolution(start, end)
+        elif resolution == 'raw':
+            resolution = History.RAW
+        else:
+            resolution = int(resolution)
+        if resolution != History.RAW and \
+                resolution not in History.RESOLUTIONS:
+            raise ValueError('invalid resolution')
+    except (TypeError, ValueError) as e:
+        resp.data['error'] = 'Invalid history request: {}'.format(e)
+        resp.status = 400
+        return resp.get_flask_response(app)
+
+    resp.data['from'] = start
+    resp.data['to'] = end
+    resp.data['resolution'] = resolution
+    snapshot = None
+    try:
+        # Events and columns come from the same snapshot
+        snapshot = history.snapshot()
+        resp.data['events'] = snapshot.get_events(start, end)
+        columns = snapshot.iter_columns(History.COLUMN_ORDER, start, end,
+                                        resolution)
+    except HistoryError as e:
+        if snapshot is not None:
+            snapshot.close()
+        resp.data['error'] = 'Error reading history: {}'.format(e)
+        resp.status = 500
+        return resp.get_flask_response(app)
+    return resp.get_flask_stream_response(app, columns,
+                                          on_close=snapshot.close)
+
+
 # Decorator for routes that require a session cookie
 #
 def require_session(route):
@@ -170,3 +392,55 @@ class RegexConverter(BaseConverter):
     def __init__(self, url_map, *items):
         super(RegexConverter, self).__init__(url_map)
         self.regex = items[0]
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """Werkzeug WSGI server that handles requests on a fixed pool of
+    worker threads, so a slow request (eg. an outbound weather call)
+    doesn't block other clients, without spawning a thread per
+    request."""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=8, **kwargs):
+        BaseWSGIServer.__init__(self, host, port, app, **kwargs)
+        self._requests = queue.Queue()
+        for i in range(threads):
+            worker = threading.Thread(
+                target=self._worker, name='WSGIWorker-{}'.format(i)
+            )
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _worker(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def run_server(app, host, port, ssl_context=None, server='threadpool',
+               threads=8):
+    """Runs app with the server selected by flask:server in config.yaml.
+
+    'threadpool' uses ThreadPoolWSGIServer with flask:threads workers
+    and 'werkzeug' uses Flask's built-in server with a thread per
+    request.
+    """
+    _l = logging.getLogger(__name__)
+    _l.info('Starting {} server on port {}'.format(server, port))
+    if server == 'threadpool':
+        ThreadPoolWSGIServer(
+            host, port, app, threads=threads, ssl_context=ssl_context
+        ).serve_forever()
+    elif server == 'werkzeug':
+        app.run(host=host, port=port, ssl_context=ssl_context, threaded=True)
+    else:
+        raise ConfigError('Unknown server type: {}'.format(server))
@@ -0,0 +1,368 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+
+import json
+import math
+import os
+import tempfile
+import threading
+import logging
+from .nido import LocalWeather, Mode, Status
+from .timeline import TimelineError
+
+
+class RateModel(object):
+    """Linear model of how fast the system moves the temperature towards
+    its target, in degrees C per minute, against the indoor / outdoor
+    temperature difference:
+
+        rate = intercept + slope * (indoor - outdoor)
+
+    Fitted by least squares over running sums, so every observation is
+    an O(1) update. Older observations are discounted by the forgetting
+    factor, letting the model follow the seasons. Until min_samples
+    observations have been made default_rate is used.
+    """
+
+    def __init__(self, default_rate, forgetting=0.98, min_samples=5,
+                 state=None):
+        self.default_rate = default_rate
+        self.forgetting = forgetting
+        self.min_samples = min_samples
+        self.samples = 0
+        # Discounted sums of 1, x, y, x^2 and xy
+        self._n = 0.0
+        self._sx = 0.0
+        self._sy = 0.0
+        self._sxx = 0.0
+        self._sxy = 0.0
+        if state:
+            self.samples = state['samples']
+            self._n, self._sx, self._sy, self._sxx, self._sxy = state['sums']
+        return
+
+    def observe(self, delta, rate):
+        f = self.forgetting
+        self._n = self._n * f + 1
+        self._sx = self._sx * f + delta
+        self._sy = self._sy * f + rate
+        self._sxx = self._sxx * f + delta * delta
+        self._sxy = self._sxy * f + delta * rate
+        self.samples += 1
+        return
+
+    def coefficients(self):
+        """Returns (intercept, slope)."""
+        if self.samples < self.min_samples:
+            return (self.default_rate, 0.0)
+        var = self._n * self._sxx - self._sx * self._sx
+        # Too little spread in the differences seen so far to tell the
+        # slope, use the mean rate
+        if var <= 1e-6 * self._n * self._n:
+            return (self._sy / self._n, 0.0)
+        slope = (self._n * self._sxy - self._sx * self._sy) / var
+        return ((self._sy - slope * self._sx) / self._n, slope)
+
+    def rate(self, delta):
+        intercept, slope = self.coefficients()
+        return intercept + slope * delta
+
+    def minutes_to(self, start, end, outdoor):
+        """Returns the minutes needed to move the temperature from start
+        to end, or None if the model says it can't be reached."""
+        low, high = sorted((start, end))
+        intercept, slope = self.coefficients()
+        if outdoor is None:
+            # Without the outdoor temperature assume the typical
+            # difference seen so far
+            outdoor = low - (self._sx / self._n if self._n else 0)
+        rate_low = intercept + slope * (low - outdoor)
+        rate_high = intercept + slope * (high - outdoor)
+        if min(rate_low, rate_high) <= 0:
+            return None
+        if abs(slope) < 1e-9:
+            return (high - low) / intercept
+        # The rate changes linearly with the temperature along the way
+        return math.log(rate_high / rate_low) / slope
+
+    def to_dict(self):
+        intercept, slope = self.coefficients()
+        return {
+            'samples': self.samples,
+            'intercept': intercept,
+            'slope': slope,
+            'sums': [self._n, self._sx, self._sy, self._sxx, self._sxy]
+        }
+
+
+class OptimalStart(object):
+    """Starts heating / cooling ahead of a scheduled set point change so
+    the new set point is reached at the scheduled time.
+
+    On every controller update observe() follows the heating and cooling
+    runs and, every sample_span seconds of a run (skipping the first
+    warmup seconds) and when it ends, feeds the rate achieved and the
+    indoor / outdoor difference into the RateModel for that direction.
+
+    target() then looks up the next set_temp change in the schedule's
+    timeline. If the model predicts that getting from the current
+    temperature to the new set point takes at least as long as remains
+    until it (capped at max_lead), the new set point is returned to the
+    controller early, and the normal hysteresis and short-cycle logic
+    take it from there. Once started the new set point is kept until the
+    change fires, unless the schedule or mode changes.
+
+    The models are saved to model_file, if configured, as they change.
+    """
+
+    # Seconds to reuse the outdoor temperature for
+    _OUTDOOR_INTERVAL = 300
+
+    def __init__(self, timeline, max_lead=10800, warmup=120, sample_span=900,
+                 min_span=300, forgetting=0.98, min_samples=5,
+                 default_heat_rate=0.05, default_cool_rate=0.05,
+                 model_file=None, outdoor=None):
+        self._l = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self.timeline = timeline
+        self.max_lead = max_lead
+        self.warmup = warmup
+        self.sample_span = sample_span
+        self.min_span = min_span
+        self.model_file = model_file
+        self._outdoor = outdoor or _outdoor_temp
+        self._outdoor_cache = (None, None)
+
+        state = self._load()
+        self.models = {}
+        for status, default_rate in [(Status.Heating, default_heat_rate),
+                                     (Status.Cooling, default_cool_rate)]:
+            self.models[status.name] = RateModel(
+                default_rate, forgetting=forgetting, min_samples=min_samples,
+                state=state.get(status.name)
+            )
+
+        # Current run: {'status', 'start', 'mark': (time, temp, outdoor),
+        # 'last': (time, temp)}
+        self._run = None
+        # Scheduled change being worked towards early, if any
+        self.active = None
+        return
+
+    @classmethod
+    def from_config(cls, config, timeline):
+        """Creates an OptimalStart from the optimal_start section of the
+        configuration, or returns None if it's disabled."""
+        settings = config['optimal_start']
+        if not settings['enabled']:
+            return None
+        return cls(
+            timeline, max_lead=settings['max_lead'],
+            warmup=settings['warmup'], sample_span=settings['sample_span'],
+            min_span=settings['min_span'], forgetting=settings['forgetting'],
+            min_samples=settings['min_samples'],
+            default_heat_rate=settings['default_heat_rate'],
+            default_cool_rate=settings['default_cool_rate'],
+            model_file=settings.get('model_file')
+        )
+
+    def _load(self):
+        if not self.model_file or not os.path.isfile(self.model_file):
+            return {}
+        try:
+            with open(self.model_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            self._l.warning('Error loading optimal start model: {}'
+                            .format(e))
+            return {}
+
+    def _save(self):
+        if not self.model_file:
+            return
+        state = dict((name, model.to_dict())
+                     for name, model in self.models.items())
+        model_dir = os.path.dirname(os.path.abspath(self.model_file))
+        try:
+            fd, tmp_path = tempfile.mkstemp(prefix='.optimal_start.',
+                                            suffix='.tmp', dir=model_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_path, self.model_file)
+        except (IOError, OSError) as e:
+            self._l.warning('Error saving optimal start model: {}'
+                            .format(e))
+        return
+
+    def _outdoor_temp(self, now):
+        checked, temp = self._outdoor_cache
+        if checked is None or now - checked >= self._OUTDOOR_INTERVAL:
+            try:
+                temp = self._outdoor()
+            except Exception as e:
+                self._l.debug('Outdoor temperature unavailable: {}'
+                              .format(e))
+                temp = None
+            self._outdoor_cache = (now, temp)
+        return temp
+
+    def observe(self, now, status, temp):
+        """Follows the status the controller found the system in, and
+        learns from the heating / cooling runs."""
+        with self._lock:
+            run = self._run
+            if run is not None and run['status'] is not status:
+                self._learn(run, *run['last'])
+                run = self._run = None
+            if status not in (Status.Heating, Status.Cooling):
+                return
+            if run is None:
+                run = self._run = {'status': status, 'start': now,
+                                   'mark': None}
+            run['last'] = (now, temp)
+            if run['mark'] is None:
+                if now - run['start'] >= self.warmup:
+                    run['mark'] = (now, temp, self._outdoor_temp(now))
+            elif now - run['mark'][0] >= self.sample_span:
+                self._learn(run, now, temp)
+                run['mark'] = (now, temp, self._outdoor_temp(now))
+        return
+
+    def _learn(self, run, now, temp):
+        if run['mark'] is None:
+            return
+        start, start_temp, start_outdoor = run['mark']
+        if now - start < self.min_span:
+            return
+        outdoor = self._outdoor_temp(now)
+        if start_outdoor is None or outdoor is None:
+            return
+        delta = ((start_temp + temp) - (start_outdoor + outdoor)) / 2
+        rate = (temp - start_temp) / ((now - start) / 60)
+        if run['status'] is Status.Cooling:
+            rate = -rate
+        model = self.models[run['status'].name]
+        model.observe(delta, rate)
+        self._l.debug('{} rate {:.3f}C/min at {:.1f}C difference, model '
+                      '{:.3f} + {:.4f} * difference'.format(
+                          run['status'].name, rate, delta,
+                          *model.coefficients()))
+        self._save()
+        return
+
+    def target(self, now, mode, temp, set_temp, behavior):
+        """Returns the set point the controller should work to: the next
+        scheduled set point if it's time to start towards it, otherwise
+        set_temp."""
+        try:
+            change = self.timeline.next_change(now, kind='set_temp')
+            if change is None or change['time'] - now > self.max_lead:
+                self.active = None
+                return set_temp
+            scheduled_mode = self.timeline.at(change['time'])['mode_set']
+            new_set_temp = float(change['value'])
+        except TimelineError as e:
+            self._l.debug('Optimal start unavailable: {}'.format(e))
+            self.active = None
+            return set_temp
+        except (KeyError, TypeError, ValueError) as e:
+            # Bad schedule data mustn't stop the controller
+            self._l.warning('Optimal start skipped, invalid scheduled '
+                            'change: {}'.format(e))
+            self.active = None
+            return set_temp
+        if math.isnan(new_set_temp):
+            self.active = None
+            return set_temp
+
+        offset = 0
+        if mode == Mode.Heat_Cool.name:
+            offset = behavior['deadband'] / 2
+        if (new_set_temp > set_temp
+                and mode in (Mode.Heat.name, Mode.Heat_Cool.name)
+                and scheduled_mode in (Mode.Heat.name, Mode.Heat_Cool.name)):
+            status = Status.Heating
+            goal = new_set_temp - offset
+            reached = temp >= goal
+        elif (new_set_temp < set_temp
+                and mode in (Mode.Cool.name, Mode.Heat_Cool.name)
+                and scheduled_mode in (Mode.Cool.name, Mode.Heat_Cool.name)):
+            status = Status.Cooling
+            goal = new_set_temp + offset
+            reached = temp <= goal
+        else:
+            # Nothing to start early for
+            self.active = None
+            return set_temp
+
+        if (self.active is not None
+                and self.active['job_id'] == change['job_id']
+                and self.active['time'] == change['time']
+                and self.active['set_temperature'] == new_set_temp):
+            # Already started: hold the new set point until the change
+            # fires, even once it's reached, rather than letting the
+            # house drift back and starting another cycle at the deadline
+            return new_set_temp
+        if reached:
+            self.active = None
+            return set_temp
+
+        minutes = self.models[status.name].minutes_to(
+            temp, goal, self._outdoor_temp(now)
+        )
+        lead = self.max_lead if minutes is None else minutes * 60
+        if change['time'] - now > lead:
+            self.active = None
+            return set_temp
+        if self.active is None or self.active['job_id'] != change['job_id']:
+            self._l.info('Optimal start: {} to {}C, {:.0f} min before the '
+                         'scheduled change'.format(
+                             status.name, new_set_temp,
+                             (change['time'] - now) / 60))
+        self.active = {
+            'job_id': change['job_id'],
+            'time': change['time'],
+            'set_temperature': new_set_temp,
+            'lead': lead
+        }
+        return new_set_temp
+
+    def get_status(self):
+        models = dict((name, model.to_dict())
+                      for name, model in self.models.items())
+        for model in models.values():
+            del model['sums']
+        return {'active': self.active, 'models': models}
+
+
+def _outdoor_temp():
+    """Returns the outdoor temperature from the weather cache, without
+    waiting for a request."""
+    conditions = LocalWeather().get_cached_conditions()
+    if conditions is None:
+        return None
+    return conditions.get('temp_c')
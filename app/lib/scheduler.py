@@ -27,12 +27,129 @@ from builtins import str
 from builtins import object
 
 import rpyc
+import json
+import socket
+import threading
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+from . import metrics
+from . import tracing
 from functools import wraps
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.jobstores.base import JobLookupError, ConflictingIdError
-from .nido import Config, Controller
+from .nido import (Config, Controller, ControllerEngine,
+                   get_sensor_conditions)
+from .timeline import TimelineError
+
+
+def job_to_dict(j):
+    """Converts an APScheduler Job into a plain dict that can be
+    serialised to JSON."""
+    if j is None:
+        raise NidoDaemonServiceError('No job exists with that ID.')
+    if isinstance(j.trigger, DateTrigger):
+        trigger = {
+            'timezone': str(j.trigger.run_date.tzinfo)
+        }
+    else:
+        trigger_start_date = (
+            j.trigger.start_date.strftime('%m/%d/%Y %H:%M:%S')
+            if j.trigger.start_date else None
+        )
+        trigger_end_date = (
+            j.trigger.end_date.strftime('%m/%d/%Y %H:%M:%S')
+            if j.trigger.end_date else None
+        )
+        trigger = {
+            'start_date': trigger_start_date,
+            'end_date': trigger_end_date,
+            'timezone': str(j.trigger.timezone)
+        }
+
+    if isinstance(j.trigger, CronTrigger):
+        trigger['cron'] = {}
+        for f in j.trigger.fields:
+            trigger['cron'][f.name] = str(f)
+    elif isinstance(j.trigger, IntervalTrigger):
+        trigger_interval = (
+            str(j.trigger.interval) if j.trigger.interval else None
+        )
+        trigger['interval'] = trigger_interval
+    elif isinstance(j.trigger, DateTrigger):
+        trigger['run_date'] = (
+            j.trigger.run_date.strftime('%m/%d/%Y %H:%M:%S')
+        )
+    else:
+        raise NidoDaemonServiceError(
+            'Unknown trigger type: {}'.format(type(j.trigger))
+        )
+
+    job = {
+        'id': j.id,
+        'name': j.name,
+        'args': j.args,
+        'next_run_time': (
+            j.next_run_time.strftime('%m/%d/%Y %H:%M:%S')
+            if j.next_run_time else None
+        ),
+        'trigger': trigger
+    }
+
+    return job
+
+
+def job_to_operation(j):
+    """Converts a scheduled set_temp / set_mode cron job into an 'add'
+    operation of a schedule batch, so an exported schedule can be
+    imported again. Returns None for jobs that can't be expressed as
+    one."""
+    if not isinstance(j.trigger, CronTrigger):
+        return None
+    func = j.func_ref.split('.')[-1]
+    if func == 'set_temp':
+        op = {'type': 'temp', 'temp': j.args[0], 'scale': j.args[1]}
+    elif func == 'set_mode':
+        op = {'type': 'mode', 'mode': j.args[0]}
+    else:
+        return None
+    fields = dict((f.name, str(f)) for f in j.trigger.fields)
+    op.update({
+        'op': 'add',
+        'job_id': j.id,
+        'day_of_week': fields['day_of_week'],
+        'hour': fields['hour'],
+        'minute': fields['minute'],
+        'paused': j.next_run_time is None
+    })
+    return op
+
+
+@contextmanager
+def _no_batch():
+    yield
+
+
+def _json_result(func):
+    """Decorator for service methods that returns the result serialised
+    as a JSON string, so it is sent by value in a single message rather
+    than as a netref that is walked with further round-trips. Scheduler
+    errors are returned as {'error': message}."""
+
+    @wraps(func)
+    def serialise(self, *args, **kwargs):
+        try:
+            result = func(self, *args, **kwargs)
+        except (JobLookupError, ConflictingIdError) as e:
+            return json.dumps({'error': '{}'.format(e.args[0])})
+        except (NidoDaemonServiceError, TimelineError) as e:
+            return json.dumps({'error': e.msg})
+        return json.dumps({'result': result})
+
+    return serialise
 
 
 class NidoSchedulerService(rpyc.Service):
@@ -46,61 +163,389 @@ class NidoSchedulerService(rpyc.Service):
     /examples/rpc/server.py
     """
 
-    def __init__(self, scheduler):
+    # Batches are applied one at a time
+    _batch_lock = threading.Lock()
+
+    def __init__(self, scheduler, timeline=None):
+        self._l = logging.getLogger(__name__)
         self._scheduler = scheduler
+        self._timeline = timeline
 
     def __call__(self, conn):
-        return self.__class__(self._scheduler)
+        return self.__class__(self._scheduler, timeline=self._timeline)
 
+    @tracing.traced('rpc.add_job')
     def add_job(self, func, *args, **kwargs):
         return self._scheduler.add_job(func, *args, **kwargs)
 
+    @tracing.traced('rpc.modify_job')
     def modify_job(self, job_id, jobstore=None, **changes):
         return self._scheduler.modify_job(job_id, jobstore, **changes)
 
+    @tracing.traced('rpc.reschedule_job')
     def reschedule_job(self, job_id, jobstore=None, trigger=None,
                        **trigger_args):
         return self._scheduler.reschedule_job(job_id, jobstore, trigger,
                                               **trigger_args)
 
+    @tracing.traced('rpc.pause_job')
     def pause_job(self, job_id, jobstore=None):
         return self._scheduler.pause_job(job_id, jobstore)
 
+    @tracing.traced('rpc.resume_job')
     def resume_job(self, job_id, jobstore=None):
         return self._scheduler.resume_job(job_id, jobstore)
 
+    @tracing.traced('rpc.remove_job')
     def remove_job(self, job_id, jobstore=None):
         self._scheduler.remove_job(job_id, jobstore)
 
+    @tracing.traced('rpc.get_job')
     def get_job(self, job_id):
         return self._scheduler.get_job(job_id)
 
+    @tracing.traced('rpc.get_jobs')
     def get_jobs(self, jobstore=None):
         return self._scheduler.get_jobs(jobstore)
 
+    # Variants of the methods above that serialise jobs on the daemon
+    # side and return them as JSON in one round-trip
+
+    @tracing.traced('rpc.add_job_json')
+    @_json_result
+    def add_job_json(self, func, *args, **kwargs):
+        return job_to_dict(self._scheduler.add_job(func, *args, **kwargs))
+
+    @tracing.traced('rpc.modify_job_json')
+    @_json_result
+    def modify_job_json(self, job_id, jobstore=None, **changes):
+        return job_to_dict(
+            self._scheduler.modify_job(job_id, jobstore, **changes)
+        )
+
+    @tracing.traced('rpc.reschedule_job_json')
+    @_json_result
+    def reschedule_job_json(self, job_id, jobstore=None, trigger=None,
+                            **trigger_args):
+        return job_to_dict(
+            self._scheduler.reschedule_job(job_id, jobstore, trigger,
+                                           **trigger_args)
+        )
+
+    @tracing.traced('rpc.pause_job_json')
+    @_json_result
+    def pause_job_json(self, job_id, jobstore=None):
+        return job_to_dict(self._scheduler.pause_job(job_id, jobstore))
+
+    @tracing.traced('rpc.resume_job_json')
+    @_json_result
+    def resume_job_json(self, job_id, jobstore=None):
+        return job_to_dict(self._scheduler.resume_job(job_id, jobstore))
+
+    @tracing.traced('rpc.remove_job_json')
+    @_json_result
+    def remove_job_json(self, job_id, jobstore=None):
+        self._scheduler.remove_job(job_id, jobstore)
+        return None
+
+    @tracing.traced('rpc.get_job_json')
+    @_json_result
+    def get_job_json(self, job_id):
+        return job_to_dict(self._scheduler.get_job(job_id))
+
+    @tracing.traced('rpc.get_jobs_json')
+    @_json_result
+    def get_jobs_json(self, jobstore=None):
+        return [job_to_dict(j) for j in self._scheduler.get_jobs(jobstore)]
+
+    @tracing.traced('rpc.apply_batch_json')
+    @_json_result
+    def apply_batch_json(self, operations, replace=False):
+        """Applies a JSON list of schedule operations (as built by
+        NidoDaemonService._batch_operation) to the schedule jobstore,
+        either all of them or none. If replace is True the existing
+        schedule is removed first."""
+        return self._apply_batch(json.loads(operations), replace)
+
+    @tracing.traced('rpc.export_jobs_json')
+    @_json_result
+    def export_jobs_json(self, jobstore='schedule'):
+        operations = []
+        skipped = []
+        for j in self._scheduler.get_jobs(jobstore):
+            op = job_to_operation(j)
+            if op is None:
+                skipped.append(j.id)
+            else:
+                operations.append(op)
+        return {'operations': operations, 'skipped': skipped}
+
+    @tracing.traced('rpc.get_conditions')
+    def get_conditions(self):
+        # Serialised so the result is sent by value in one round-trip
+        return json.dumps(get_sensor_conditions())
+
+    @tracing.traced('rpc.get_setpoint_json')
+    @_json_result
+    def get_setpoint_json(self, t=None):
+        return self._get_timeline().at(t)
+
+    @tracing.traced('rpc.get_timeline_json')
+    @_json_result
+    def get_timeline_json(self, start=None, end=None):
+        return self._get_timeline().segments(start, end)
+
+    def _apply_batch(self, operations, replace, jobstore='schedule'):
+        # APScheduler has no transactions spanning several jobs, so the
+        # whole batch is checked against the current jobs before anything
+        # is changed, and if applying it still fails the jobstore is
+        # restored from a snapshot taken beforehand.
+        with self._batch_lock:
+            jobs = self._scheduler.get_jobs(jobstore)
+            steps = self._check_batch(
+                operations, set() if replace else set(j.id for j in jobs)
+            )
+            snapshot = [j.__getstate__() for j in jobs]
+            batch = (self._timeline.batch() if self._timeline is not None
+                     else _no_batch())
+            with batch:
+                try:
+                    if replace:
+                        self._scheduler.remove_all_jobs(jobstore)
+                    for step in steps:
+                        self._apply_operation(jobstore, *step)
+                except Exception as e:
+                    self._l.error('Error applying schedule batch, rolling '
+                                  'back: {}'.format(e))
+                    self._restore_jobs(jobstore, snapshot)
+                    raise NidoDaemonServiceError(
+                        'Batch not applied: {}'.format(e)
+                    )
+            self._l.info('Applied schedule batch of {} operations'
+                         .format(len(steps)))
+            return {
+                'applied': len(steps),
+                'jobs': [job_to_dict(j)
+                         for j in self._scheduler.get_jobs(jobstore)]
+            }
+
+    def _check_batch(self, operations, job_ids):
+        """Validates a batch against the set of job IDs it starts from
+        and returns the steps to apply as (kind, job_id, op, trigger)."""
+        if not isinstance(operations, list):
+            raise NidoDaemonServiceError('Operations must be a list.')
+        steps = []
+        for i, op in enumerate(operations, 1):
+            try:
+                kind = op['op']
+                job_id = op.get('id')
+                trigger = None
+                if kind == 'add':
+                    if job_id is None:
+                        job_id = uuid.uuid4().hex
+                    if job_id in job_ids:
+                        raise NidoDaemonServiceError(
+                            'Job ID already exists: {}'.format(job_id)
+                        )
+                    job_ids.add(job_id)
+                    self._check_job_fields(op)
+                    trigger = CronTrigger(timezone=self._scheduler.timezone,
+                                          **op['trigger'])
+                elif kind in ('modify', 'reschedule', 'pause', 'resume',
+                              'remove'):
+                    if job_id not in job_ids:
+                        raise NidoDaemonServiceError(
+                            'No job exists with ID: {}'.format(job_id)
+                        )
+                    if kind == 'modify':
+                        self._check_job_fields(op)
+                    elif kind == 'reschedule':
+                        trigger = CronTrigger(
+                            timezone=self._scheduler.timezone,
+                            **op['trigger']
+                        )
+                    elif kind == 'remove':
+                        job_ids.discard(job_id)
+                else:
+                    raise NidoDaemonServiceError(
+                        'Unknown operation: {}'.format(kind)
+                    )
+            except NidoDaemonServiceError as e:
+                raise NidoDaemonServiceError(
+                    'Operation {}: {}'.format(i, e.msg)
+                )
+            except (KeyError, TypeError, ValueError) as e:
+                raise NidoDaemonServiceError(
+                    'Operation {}: invalid parameters ({})'.format(i, e)
+                )
+            steps.append((kind, job_id, op, trigger))
+        return steps
+
+    def _check_job_fields(self, op):
+        for key in ('func', 'args', 'name'):
+            if key not in op:
+                raise NidoDaemonServiceError('No {} specified.'.format(key))
+        if op['func'] not in ('nidod:NidoSchedulerService.set_temp',
+                              'nidod:NidoSchedulerService.set_mode'):
+            raise NidoDaemonServiceError(
+                'Invalid job function: {}'.format(op['func'])
+            )
+        return
+
+    def _apply_operation(self, jobstore, kind, job_id, op, trigger):
+        if kind == 'add':
+            kwargs = {}
+            if op.get('paused'):
+                kwargs['next_run_time'] = None
+            self._scheduler.add_job(
+                op['func'], trigger=trigger, args=tuple(op['args']),
+                name=op['name'], id=job_id, jobstore=jobstore, **kwargs
+            )
+        elif kind == 'modify':
+            self._scheduler.modify_job(job_id, jobstore, func=op['func'],
+                                       args=tuple(op['args']),
+                                       name=op['name'])
+        elif kind == 'reschedule':
+            self._scheduler.reschedule_job(job_id, jobstore, trigger=trigger)
+        else:
+            getattr(self._scheduler, kind + '_job')(job_id, jobstore)
+        return
+
+    def _restore_jobs(self, jobstore, snapshot):
+        self._scheduler.remove_all_jobs(jobstore)
+        for state in snapshot:
+            self._scheduler.add_job(
+                state['func'], trigger=state['trigger'],
+                args=state['args'], kwargs=state['kwargs'], id=state['id'],
+                name=state['name'], executor=state['executor'],
+                misfire_grace_time=state['misfire_grace_time'],
+                coalesce=state['coalesce'],
+                max_instances=state['max_instances'],
+                next_run_time=state['next_run_time'], jobstore=jobstore
+            )
+        return
+
+    def _get_timeline(self):
+        if self._timeline is None:
+            raise NidoDaemonServiceError('Set point timeline not available.')
+        return self._timeline
+
+    def set_tracing(self, enabled=None, sample_rate=None):
+        """Enables or disables tracing in the daemon and returns the
+        tracer status as JSON."""
+        if enabled:
+            tracing.TRACER.enable(sample_rate)
+        elif enabled is not None:
+            tracing.TRACER.disable()
+        return json.dumps(tracing.TRACER.get_status())
+
     @staticmethod
     def set_temp(temp, scale):
         if Config().set_temp(temp, scale):
-            return NidoSchedulerService.wakeup()
+            return NidoSchedulerService.wakeup(event='schedule')
         else:
             return False
 
     @staticmethod
     def set_mode(mode):
         if Config().set_mode(mode):
-            return NidoSchedulerService.wakeup()
+            return NidoSchedulerService.wakeup(event='schedule')
         else:
             return False
 
     @staticmethod
-    def wakeup():
+    def wakeup(event='wakeup'):
+        # Hand the update to the daemon's controller engine if it is
+        # running, otherwise update directly
+        engine = ControllerEngine.get_instance()
+        if engine is not None:
+            engine.notify(event)
+            return True
         return Controller().update()
 
 
+class _ConnectionPool(object):
+    """Process-wide pool of RPyC connections to the daemon.
+
+    Connections are reused across NidoDaemonService instances and
+    requests. A connection that has been idle for longer than
+    _CHECK_INTERVAL seconds is pinged before it is handed out, and
+    closed connections are discarded and replaced lazily.
+    """
+
+    _MAX_IDLE = 4
+    _CHECK_INTERVAL = 30
+    _PING_TIMEOUT = 2
+
+    def __init__(self):
+        self._l = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._idle = {}
+        return
+
+    def acquire(self, host, port):
+        key = (host, port)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                conn, last_used = idle.pop()
+            if conn.closed:
+                continue
+            if time.time() - last_used > self._CHECK_INTERVAL:
+                try:
+                    conn.ping(timeout=self._PING_TIMEOUT)
+                except Exception as e:
+                    self._l.debug('Discarding stale RPC connection: {}'
+                                  .format(e))
+                    self.discard(conn)
+                    continue
+            return conn
+        self._l.debug('Opening RPC connection to {}:{}'.format(host, port))
+        return rpyc.connect(
+            host, port,
+            config={
+                'allow_public_attrs': True,
+                'instantiate_custom_exceptions': True
+            }
+        )
+
+    def release(self, conn, host, port):
+        if conn.closed:
+            return
+        with self._lock:
+            idle = self._idle.setdefault((host, port), [])
+            if len(idle) < self._MAX_IDLE:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+        return
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return
+
+
+_POOL = _ConnectionPool()
+
+_RPC_SECONDS = metrics.histogram(
+    'nido_rpc_seconds', 'Round-trip time of calls to the daemon.',
+    labels=('method',)
+)
+
+
 def keepalive(func):
     """Decorator to ensure that RPC connection is active when calls
     are made.
 
+    A pooled connection is held for the duration of the call. If the
+    connection turns out to be broken, it is replaced and the call is
+    retried once.
+
     The output is converted to JSON if the instance variable self._json
     is True. The base methods return either a Job object or a list of
     Job objects from the APScheduler package.
@@ -108,13 +553,22 @@ def keepalive(func):
 
     @wraps(func)
     def check_connection(self, *args, **kwargs):
-        try:
+        # Nested calls reuse the connection held by the outer call
+        if self._connection is not None:
             return func(self, *args, **kwargs)
-        except EOFError:
+        try:
             self._connect()
-            return func(self, *args, **kwargs)
+            try:
+                return func(self, *args, **kwargs)
+            except (EOFError, socket.error):
+                _POOL.discard(self._connection)
+                self._connection = None
+                self._connect()
+                return func(self, *args, **kwargs)
         except (JobLookupError, ConflictingIdError) as e:
-            raise NidoDaemonServiceError('{}'.format(e.message))
+            raise NidoDaemonServiceError('{}'.format(e))
+        finally:
+            self._disconnect()
 
     return check_connection
 
@@ -138,28 +592,85 @@ class NidoDaemonService(object):
     def __init__(self, json=False):
         self._json = json
         self._config = Config().get_config()
-        self._connect()
+        self._host = self._config['schedule']['rpc_host']
+        self._port = self._config['schedule']['rpc_port']
+        self._connection = None
         return
 
     @keepalive
     def wakeup(self):
-        job = (
-            self._connection.root.add_job('nidod:NidoSchedulerService.wakeup')
+        return self._call('add_job', 'nidod:NidoSchedulerService.wakeup')
+
+    @keepalive
+    def get_conditions(self):
+        """Returns the daemon's latest sensor reading."""
+        with _RPC_SECONDS.time(method='get_conditions'), \
+                tracing.span('rpc.get_conditions'):
+            return json.loads(self._connection.root.get_conditions())
+
+    @keepalive
+    def get_setpoint(self, t=None):
+        """Returns the scheduled set point and mode in effect at time t
+        (Unix time, default now)."""
+        return self._call_json('get_setpoint', t)
+
+    @keepalive
+    def get_timeline(self, start=None, end=None):
+        """Returns the scheduled set point / mode segments between
+        start and end (Unix time, default the next 24 hours)."""
+        return self._call_json('get_timeline', start, end)
+
+    @keepalive
+    def set_tracing(self, enabled=None, sample_rate=None):
+        """Enables or disables tracing in the daemon, returning its
+        tracer status."""
+        return json.loads(
+            self._connection.root.set_tracing(enabled, sample_rate)
         )
-        if self._json:
-            return self._jsonify_job(job)
-        return job
+
+    @keepalive
+    def apply_schedule_batch(self, operations, replace=False):
+        """Applies a list of schedule operations in a single RPC call,
+        either all of them or none, and returns the resulting schedule.
+
+        Each operation is a dict with 'op' set to one of:
+            add -> Takes the parameters of add_scheduled_job, plus
+                   'paused' to add the job paused
+            modify -> Takes the parameters of modify_scheduled_job
+            reschedule -> Takes the parameters of reschedule_job
+            pause, resume, remove -> Take 'job_id'
+        If replace is True the existing schedule is removed first.
+        """
+        if not isinstance(operations, list):
+            raise NidoDaemonServiceError('Operations must be a list.')
+        batch = []
+        for i, op in enumerate(operations, 1):
+            try:
+                batch.append(self._batch_operation(op))
+            except NidoDaemonServiceError as e:
+                raise NidoDaemonServiceError(
+                    'Operation {}: {}'.format(i, e.msg)
+                )
+        return self._call_json('apply_batch', json.dumps(batch),
+                               bool(replace))
+
+    @keepalive
+    def export_schedule(self):
+        """Returns the schedule as a list of 'add' operations that
+        apply_schedule_batch accepts, along with the IDs of any jobs that
+        couldn't be exported."""
+        return self._call_json('export_jobs')
 
     @keepalive
     def get_scheduled_jobs(self, jobstore=None):
-        jobs = self._connection.root.get_jobs(jobstore=jobstore)
-        if self._json:
-            return self._jsonify_jobs(jobs)
-        return jobs
+        return self._call('get_jobs', jobstore=jobstore)
 
     @keepalive
     def get_scheduled_job(self, job_id):
-        return self._return_job(self._connection.root.get_job(job_id))
+        job = self._call('get_job', job_id)
+        if job is None:
+            raise NidoDaemonServiceError('No job exists with that ID.')
+        return job
 
     @keepalive
     def add_scheduled_job(self, type, day_of_week=None, hour=None, minute=None,
@@ -170,12 +681,12 @@ class NidoDaemonService(object):
         self._check_cron_parameters(
             day_of_week=day_of_week, hour=hour, minute=minute
         )
-        job = self._connection.root.add_job(
+        return self._call(
+            'add_job',
             'nidod:NidoSchedulerService.{}'.format(func), args=args, name=name,
             jobstore='schedule', id=job_id, trigger='cron',
             day_of_week=day_of_week, hour=hour, minute=minute
         )
-        return self._return_job(job)
 
     @keepalive
     def modify_scheduled_job(self, job_id, type=None, mode=None, temp=None,
@@ -183,34 +694,34 @@ class NidoDaemonService(object):
         func, args, name = self._parse_mode_settings(
             type, mode=mode, temp=temp, scale=scale
         )
-        job = self._connection.root.modify_job(
+        return self._call(
+            'modify_job',
             job_id, func='nidod:NidoSchedulerService.{}'.format(func),
             args=args, name=name
         )
-        return self._return_job(job)
 
     @keepalive
     def reschedule_job(self, job_id, day_of_week=None, hour=None, minute=None):
         self._check_cron_parameters(
             day_of_week=day_of_week, hour=hour, minute=minute
         )
-        job = self._connection.root.reschedule_job(
+        return self._call(
+            'reschedule_job',
             job_id, trigger='cron', day_of_week=day_of_week, hour=hour,
             minute=minute
         )
-        return self._return_job(job)
 
     @keepalive
     def pause_scheduled_job(self, job_id):
-        return self._return_job(self._connection.root.pause_job(job_id))
+        return self._call('pause_job', job_id)
 
     @keepalive
     def resume_scheduled_job(self, job_id):
-        return self._return_job(self._connection.root.resume_job(job_id))
+        return self._call('resume_job', job_id)
 
     @keepalive
     def remove_scheduled_job(self, job_id):
-        self._connection.root.remove_job(job_id)
+        self._call('remove_job', job_id)
         if self._json:
             return {
                 'message': 'Job removed successfully.',
@@ -218,85 +729,42 @@ class NidoDaemonService(object):
             }
         return None
 
-    def _return_job(self, job):
-        if self._json:
-            return self._jsonify_job(job)
-        return job
+    def _call(self, method, *args, **kwargs):
+        """Calls a scheduler method on the daemon.
+
+        In JSON mode the daemon serialises the result and it is returned
+        as plain dicts from a single round-trip. Otherwise the APScheduler
+        objects are returned as RPyC netrefs.
+        """
+        if not self._json:
+            with _RPC_SECONDS.time(method=method), \
+                    tracing.span('rpc.' + method):
+                return getattr(self._connection.root, method)(*args,
+                                                              **kwargs)
+        return self._call_json(method, *args, **kwargs)
+
+    def _call_json(self, method, *args, **kwargs):
+        """Calls the JSON variant of a method on the daemon and returns
+        its result, raising NidoDaemonServiceError on error."""
+        with _RPC_SECONDS.time(method=method), tracing.span('rpc.' + method):
+            result = json.loads(
+                getattr(self._connection.root, method + '_json')(*args,
+                                                                 **kwargs)
+            )
+        if 'error' in result:
+            raise NidoDaemonServiceError(result['error'])
+        return result['result']
 
     def _is_connected(self):
-        return not self._connection.closed
+        return self._connection is not None and not self._connection.closed
 
     def _connect(self):
-        self._connection = rpyc.connect(
-            self._config['schedule']['rpc_host'],
-            self._config['schedule']['rpc_port'],
-            config={
-                'allow_public_attrs': True,
-                'instantiate_custom_exceptions': True,
-                'allow_pickle': True
-            }
-        )
+        self._connection = _POOL.acquire(self._host, self._port)
 
-    def _jsonify_job(self, j):
-        if j is None:
-            raise NidoDaemonServiceError('No job exists with that ID.')
-        if isinstance(j.trigger, DateTrigger):
-            trigger = {
-                'timezone': str(j.trigger.run_date.tzinfo)
-            }
-        else:
-            trigger_start_date = (
-                j.trigger.start_date.strftime('%m/%d/%Y %H:%M:%S')
-                if j.trigger.start_date else None
-            )
-            trigger_end_date = (
-                j.trigger.end_date.strftime('%m/%d/%Y %H:%M:%S')
-                if j.trigger.end_date else None
-            )
-            trigger = {
-                'start_date': trigger_start_date,
-                'end_date': trigger_end_date,
-                'timezone': str(j.trigger.timezone)
-            }
-
-        if isinstance(j.trigger, CronTrigger):
-            trigger['cron'] = {}
-            for f in j.trigger.fields:
-                trigger['cron'][f.name] = str(f)
-        elif isinstance(j.trigger, IntervalTrigger):
-            trigger_interval = (
-                str(j.trigger.interval) if j.trigger.interval else None
-            )
-            trigger['interval'] = trigger_interval
-        elif isinstance(j.trigger, DateTrigger):
-            trigger['run_date'] = (
-                j.trigger.run_date.strftime('%m/%d/%Y %H:%M:%S')
-            )
-        else:
-            raise NidoDaemonServiceError(
-                'Unknown trigger type: {}'.format(type(j.trigger))
-            )
-
-        job = {
-            'id': j.id,
-            'name': j.name,
-            'args': j.args,
-            'next_run_time': (
-                j.next_run_time.strftime('%m/%d/%Y %H:%M:%S')
-                if j.next_run_time else None
-            ),
-            'trigger': trigger
-        }
-
-        return job
-
-    def _jsonify_jobs(self, jobs):
-        job_list = []
-        for j in jobs:
-            if j is None:
-                continue
-            job_list.append(self._jsonify_job(j))
-        return job_list
+    def _disconnect(self):
+        if self._connection is not None:
+            _POOL.release(self._connection, self._host, self._port)
+            self._connection = None
 
     def _parse_mode_settings(self, type, mode=None, temp=None, scale=None):
         if type == 'mode':
@@ -304,23 +772,67 @@ class NidoDaemonService(object):
                 raise NidoDaemonServiceError('No mode specified.')
             else:
                 func = 'set_mode'
-                args = [mode]
+                args = (mode,)
                 name = 'Mode: {}'.format(mode.upper())
         elif type == 'temp':
             if temp is None or scale is None:
                 raise NidoDaemonServiceError(
                     'Both temperature value and scale are required.'
                 )
-            else:
-                func = 'set_temp'
-                args = [temp, scale]
-                name = 'Temp: {:.1f}{}'.format(float(temp), scale.upper())
+            try:
+                temp = float(temp)
+            except (TypeError, ValueError):
+                raise NidoDaemonServiceError(
+                    'Invalid temperature value: {}'.format(temp)
+                )
+            if (not isinstance(scale, str)
+                    or scale.upper() not in ('C', 'F')):
+                raise NidoDaemonServiceError(
+                    'Invalid temperature scale: {}'.format(scale)
+                )
+            func = 'set_temp'
+            args = (temp, scale.upper())
+            name = 'Temp: {:.1f}{}'.format(temp, scale.upper())
         else:
             raise NidoDaemonServiceError(
                 'Invalid job type specified: {}'.format(type)
             )
         return (func, args, name)
 
+    def _batch_operation(self, op):
+        # Checks one operation of a batch like the single-job methods do,
+        # and converts it to the form the daemon applies
+        if not isinstance(op, dict):
+            raise NidoDaemonServiceError('Operation must be an object.')
+        kind = op.get('op')
+        job_id = op.get('job_id')
+        batch_op = {'op': kind, 'id': job_id}
+        if kind in ('add', 'modify'):
+            func, args, name = self._parse_mode_settings(
+                op.get('type'), mode=op.get('mode'), temp=op.get('temp'),
+                scale=op.get('scale')
+            )
+            batch_op.update({
+                'func': 'nidod:NidoSchedulerService.{}'.format(func),
+                'args': args,
+                'name': name
+            })
+        if kind in ('add', 'reschedule'):
+            cron = dict((k, op.get(k)) for k in ('day_of_week', 'hour',
+                                                 'minute'))
+            self._check_cron_parameters(**cron)
+            batch_op['trigger'] = cron
+        if kind == 'add':
+            batch_op['paused'] = bool(op.get('paused'))
+        elif kind in ('modify', 'reschedule', 'pause', 'resume', 'remove'):
+            if job_id is None:
+                raise NidoDaemonServiceError('No job ID specified.')
+        else:
+            raise NidoDaemonServiceError(
+                'Invalid operation specified: {}'.format(kind)
+            )
+        return batch_op
+
     def _check_cron_parameters(self, day_of_week=None, hour=None,
                                minute=None):
         if day_of_week is None and hour is None and minute is None:
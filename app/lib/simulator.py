@@ -0,0 +1,315 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+
+import heapq
+import math
+import os
+import pickle
+import random
+import sqlite3
+import time
+import logging
+from datetime import timedelta
+from apscheduler.util import (datetime_to_utc_timestamp,
+                              utc_timestamp_to_datetime)
+
+# Accelerated-time simulation of the thermostat in testing mode
+# (NIDO_TESTING). A HouseModel is heated and cooled according to the
+# FakeGPIO relay pins, a SimulatedSensor reports its temperature, and
+# Simulation drives Controller.update() and the schedule's jobs on a
+# VirtualClock, so a week of operation runs in seconds.
+
+
+class SimulatorError(Exception):
+    """Exception class for errors generated by the simulator"""
+
+    def __init__(self, msg):
+        self.msg = msg
+        return
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+class VirtualClock(object):
+    """Clock that only moves when advanced. Calling the instance returns
+    the current time in seconds since the epoch, like time.time()."""
+
+    def __init__(self, start=None):
+        self.now = time.time() if start is None else start
+        return
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+        return self.now
+
+
+class OutdoorProfile(object):
+    """Daily sinusoidal outdoor temperature, coldest at coldest_hour
+    (UTC)."""
+
+    def __init__(self, mean=5.0, amplitude=5.0, coldest_hour=5):
+        self.mean = mean
+        self.amplitude = amplitude
+        self.coldest_hour = coldest_hour
+        return
+
+    def __call__(self, t):
+        hours = (t / 3600 - self.coldest_hour) % 24
+        return self.mean - self.amplitude * math.cos(2 * math.pi * hours / 24)
+
+
+class HouseModel(object):
+    """Single-zone thermal model of a house.
+
+        thermal_mass    - heat capacity of the house, J/K
+        loss            - heat loss coefficient to outdoors, W/K
+        heat_output     - furnace output, W
+        cool_output     - air conditioner output, W
+        outdoor         - function returning the outdoor temperature (C)
+                          at a given time
+
+    The defaults give a time constant of about 22 hours and heat the
+    house about 2C per hour on a cold day.
+    """
+
+    # Longest integration step, in seconds
+    MAX_STEP = 60
+
+    def __init__(self, temp=18.0, thermal_mass=2.0e7, loss=250.0,
+                 heat_output=15000.0, cool_output=10000.0, outdoor=None):
+        self.temp = temp
+        self.thermal_mass = thermal_mass
+        self.loss = loss
+        self.heat_output = heat_output
+        self.cool_output = cool_output
+        self.outdoor = outdoor or OutdoorProfile()
+        return
+
+    def step(self, t, seconds, heating=False, cooling=False):
+        """Advances the model from time t by seconds with the given
+        equipment state, returning the new indoor temperature."""
+        while seconds > 0:
+            dt = min(seconds, self.MAX_STEP)
+            power = self.loss * (self.outdoor(t) - self.temp)
+            if heating:
+                power += self.heat_output
+            if cooling:
+                power -= self.cool_output
+            self.temp += power * dt / self.thermal_mass
+            t += dt
+            seconds -= dt
+        return self.temp
+
+
+class SimulatedSensor(object):
+    """Sensor reading the temperature of a HouseModel.
+
+    The model is advanced lazily to the clock's current time using the
+    relay state read from the GPIO pins, so it reacts to whatever the
+    controller last switched on. get_conditions() returns the same
+    format as Sensor.get_conditions() and can be passed to Controller
+    as its sensor.
+    """
+
+    def __init__(self, house, clock, gpio, heat_pin, cool_pin, noise=0.0,
+                 seed=None):
+        self.house = house
+        self._clock = clock
+        self._gpio = gpio
+        self._heat_pin = heat_pin
+        self._cool_pin = cool_pin
+        self._noise = noise
+        self._random = random.Random(seed)
+        self._time = clock()
+        self.heating_time = 0
+        self.cooling_time = 0
+        return
+
+    def update(self):
+        now = self._clock()
+        elapsed = now - self._time
+        if elapsed > 0:
+            heating = bool(self._gpio.input(self._heat_pin))
+            cooling = bool(self._gpio.input(self._cool_pin))
+            self.house.step(self._time, elapsed, heating, cooling)
+            if heating:
+                self.heating_time += elapsed
+            if cooling:
+                self.cooling_time += elapsed
+            self._time = now
+        return self.house.temp
+
+    def get_conditions(self):
+        temp = self.update()
+        if self._noise:
+            temp += self._random.gauss(0, self._noise)
+        return {
+            'conditions': {
+                'temp_c': round(temp, 2),
+                'pressure_mb': 1013.25,
+                'relative_humidity': 45.0
+            }
+        }
+
+
+def jobs_from_db(db_path):
+    """Reads the jobs from the daemon's schedule database without
+    importing the daemon, returning (trigger, func, args) tuples.
+    Paused jobs are skipped."""
+    try:
+        db = sqlite3.connect(db_path)
+        try:
+            rows = db.execute(
+                'SELECT job_state FROM apscheduler_jobs'
+            ).fetchall()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        raise SimulatorError('Error reading schedule: {}'.format(e))
+    jobs = []
+    for row in rows:
+        state = pickle.loads(row[0])
+        if state.get('next_run_time') is None:
+            continue
+        jobs.append((state['trigger'], state['func'], state['args']))
+    return jobs
+
+
+class Simulation(object):
+    """Runs the controller against a simulated house on a virtual clock.
+
+    Scheduled jobs are replayed at the times their triggers would fire;
+    set_temp and set_mode jobs update the configuration like the
+    daemon's NidoSchedulerService does. As that writes config.yaml, and
+    the controller switches the FakeGPIO pins, this is only allowed in
+    testing mode.
+    """
+
+    def __init__(self, house=None, start=None, controller_cls=None,
+                 noise=0.0, seed=None):
+        if 'NIDO_TESTING' not in os.environ:
+            raise SimulatorError('The simulator requires NIDO_TESTING.')
+        from .nido import Config, Controller, GPIO
+        self._l = logging.getLogger(__name__)
+        self.cfg = Config()
+        config = self.cfg.get_config()
+        self.clock = VirtualClock(start)
+        self.house = house or HouseModel()
+        self.sensor = SimulatedSensor(
+            self.house, self.clock, GPIO, config['GPIO']['heat_pin'],
+            config['GPIO']['cool_pin'], noise=noise, seed=seed
+        )
+        self.controller = (controller_cls or Controller)(
+            clock=self.clock, sensor=self.sensor.get_conditions
+        )
+        self._jobs = []
+        self._seq = 0
+        return
+
+    def add_job(self, trigger, func, args):
+        """Adds a scheduled job. func is 'set_temp' or 'set_mode', or a
+        job reference ending in one of them, eg.
+        'nidod:NidoSchedulerService.set_temp'."""
+        func = func.split('.')[-1].split(':')[-1]
+        if func not in ('set_temp', 'set_mode'):
+            raise SimulatorError('Unsupported job function: {}'.format(func))
+        self._push_job(trigger, func, tuple(args), None)
+        return
+
+    def load_schedule(self, db_path):
+        """Adds the jobs of the daemon's schedule database."""
+        for trigger, func, args in jobs_from_db(db_path):
+            self.add_job(trigger, func, args)
+        return
+
+    def _push_job(self, trigger, func, args, previous):
+        if previous is None:
+            now = utc_timestamp_to_datetime(self.clock())
+        else:
+            now = previous + timedelta(microseconds=1)
+        fire_time = trigger.get_next_fire_time(previous, now)
+        if fire_time is not None:
+            self._seq += 1
+            heapq.heappush(self._jobs, (
+                datetime_to_utc_timestamp(fire_time), self._seq, trigger,
+                func, args, fire_time
+            ))
+        return
+
+    def _run_jobs(self):
+        while self._jobs and self._jobs[0][0] <= self.clock():
+            _, _, trigger, func, args, fire_time = heapq.heappop(self._jobs)
+            if func == 'set_temp':
+                self.cfg.set_temp(*args)
+            else:
+                self.cfg.set_mode(*args)
+            self._l.debug('Simulated job {}{} at {}'
+                          .format(func, args, fire_time))
+            self._push_job(trigger, func, args, fire_time)
+        return
+
+    def run(self, duration, step=60):
+        """Simulates duration seconds, running the controller every step
+        seconds. Returns a summary of the run."""
+        end = self.clock() + duration
+        start_cycles = dict(self.controller.cycles)
+        start_heating = self.sensor.heating_time
+        start_cooling = self.sensor.cooling_time
+        updates = 0
+        error_sum = 0.0
+        error_max = 0.0
+        wall_start = time.time()
+
+        while self.clock() < end:
+            self.clock.advance(min(step, end - self.clock()))
+            # Bring the house up to date before any relay changes
+            self.sensor.update()
+            self._run_jobs()
+            self.controller.update()
+            updates += 1
+            config = self.cfg.get_config()['config']
+            error = abs(self.house.temp - float(config['set_temperature']))
+            error_sum += error
+            error_max = max(error_max, error)
+
+        cycles = dict((k, v - start_cycles[k])
+                      for k, v in self.controller.cycles.items())
+        return {
+            'duration': duration,
+            'updates': updates,
+            'wall_time': time.time() - wall_start,
+            'heating_time': self.sensor.heating_time - start_heating,
+            'cooling_time': self.sensor.cooling_time - start_cooling,
+            'cycles': cycles,
+            'mean_error': error_sum / updates if updates else 0.0,
+            'max_error': error_max,
+            'final_temp': self.house.temp
+        }
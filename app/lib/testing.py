@@ -7,16 +7,41 @@ standard_library.install_aliases()
 from builtins import *
 from builtins import object
 
+import atexit
+import os
+import tempfile
+import threading
 import yaml
 
 
 class FakeGPIO(object):
-    def __init__(self, state_file):
+    """In-memory stand-in for RPi.GPIO.
+
+    Pin state is held in memory. If state_file is given it's mirrored
+    to that YAML file so the web server and the daemon see the same
+    pins: the file is re-read only when its (inode, mtime, size)
+    signature changes, and written only when a pin actually changes.
+    With a flush_delay (seconds) writes are batched in the background
+    instead of made on every change; pending changes are always
+    written at exit.
+    """
+
+    def __init__(self, state_file=None, flush_delay=0):
         self._pins = {}
         self.BCM = None
         self.OUT = None
         self._state = state_file
-        self._write()
+        self._flush_delay = flush_delay
+        self._signature = None
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.RLock()
+        if self._state is not None:
+            if os.path.isfile(self._state):
+                self._get_pins()
+            else:
+                self._write()
+            atexit.register(self.flush)
         return None
 
     def setwarnings(self, bool):
@@ -26,42 +51,93 @@ class FakeGPIO(object):
         return None
 
     def setup(self, pin, mode):
-        self._get_pins()
-        if pin not in self._pins:
-            self._set_pin(pin, False)
+        with self._lock:
+            self._get_pins()
+            if pin not in self._pins:
+                self._set_pin(pin, False)
         return None
 
     def input(self, pin):
-        self._get_pins()
-        return self._pins[pin]
+        with self._lock:
+            self._get_pins()
+            return self._pins[pin]
 
     def output(self, pin, state):
-        self._set_pin(pin, state)
+        with self._lock:
+            self._get_pins()
+            if self._pins.get(pin) != state:
+                self._set_pin(pin, state)
+        return None
+
+    def flush(self):
+        """Writes any pending pin changes to the state file."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._dirty:
+                self._write()
         return None
 
     def _set_pin(self, pin, state):
         self._pins[pin] = state
-        self._write()
+        if self._state is None:
+            return None
+        self._dirty = True
+        if not self._flush_delay:
+            self._write()
+        elif self._timer is None:
+            self._timer = threading.Timer(self._flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
         return None
 
+    def _file_signature(self):
+        try:
+            st = os.stat(self._state)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
     def _get_pins(self):
+        # Pending local changes take precedence over the file
+        if self._state is None or self._dirty:
+            return None
+        signature = self._file_signature()
+        if signature is None or signature == self._signature:
+            return None
         with open(self._state, 'r') as f:
-            self._pins = yaml.load(f)
+            self._pins = yaml.load(f, Loader=yaml.Loader) or {}
+        self._signature = signature
         return None
 
     def _write(self):
-        with open(self._state, 'w') as f:
+        # Replace the file atomically so the other process never reads
+        # a partial write
+        state_dir = os.path.dirname(os.path.abspath(self._state))
+        fd, tmp_path = tempfile.mkstemp(prefix='.gpio.', suffix='.tmp',
+                                        dir=state_dir)
+        with os.fdopen(fd, 'w') as f:
             yaml.dump(self._pins, f, default_flow_style=False, indent=4)
+        os.rename(tmp_path, self._state)
+        self._signature = self._file_signature()
+        self._dirty = False
         return None
 
 
 class FakeSensor(object):
-    def __init__(self, mode):
+    def __init__(self, mode, calibration=None, **kwargs):
+        self.chip_id = None
+        self.address = None
+        self.calibration_key = None
         self._temp = 17.17
         self._pressure = 101331.01
         self._humidity = 50.05
         return None
 
+    def get_calibration(self):
+        return None
+
     def read_temperature(self):
         return self._temp
 
@@ -70,3 +146,6 @@ class FakeSensor(object):
 
     def read_humidity(self):
         return self._humidity
+
+    def read_all(self):
+        return (self._temp, self._pressure, self._humidity)
@@ -0,0 +1,351 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+
+import bisect
+import heapq
+import math
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from datetime import timedelta
+from numbers import Number
+from apscheduler.util import (datetime_to_utc_timestamp,
+                              utc_timestamp_to_datetime)
+from .nido import Config
+
+
+class TimelineError(Exception):
+    """Exception class for errors generated by the set point timeline"""
+
+    def __init__(self, msg):
+        self.msg = msg
+        return
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+class Timeline(object):
+    """Effective set point and mode over the coming week, compiled from
+    the scheduled set_temp / set_mode jobs.
+
+    The fire times of each job's trigger within the window are worked
+    out once, when the job is added, modified, paused or removed, and
+    merged into one sorted list of changes. For every change the last
+    set point and mode in effect are precomputed, so at() is a single
+    bisect. Before the first scheduled change the current configuration
+    applies.
+
+    The window starts when it's compiled and covers WINDOW seconds;
+    it's recompiled once it is more than REBUILD_AFTER seconds old, so
+    queries always see at least a week ahead. Queries before the start
+    compile only the missing stretch and extend the window backwards.
+
+    Jobs with set points that can't be converted are left out, with a
+    warning, so one bad job doesn't stop the rest being compiled.
+    """
+
+    WINDOW = 8 * 86400
+    REBUILD_AFTER = 86400
+
+    def __init__(self, jobs=None):
+        self._l = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+        # {job_id: (trigger, func, args)}
+        self._jobs = {}
+        # {job_id: [(time, job_id, kind, value), ...]}
+        self._job_changes = {}
+        self._start = None
+        self._end = None
+        # When the window was last compiled from scratch
+        self._built = None
+        self._times = []
+        self._changes = []
+        # Set point and mode in effect after each change, None if no
+        # change of that kind has happened yet
+        self._set_temps = []
+        self._modes = []
+        self.rebuilds = 0
+        self._deferred = 0
+        self._dirty = False
+        for job_id, trigger, func, args in (jobs or []):
+            self._jobs[job_id] = (trigger, func, args)
+        return
+
+    @staticmethod
+    def _job_kind(func):
+        # Job functions are references like
+        # 'nidod:NidoSchedulerService.set_temp'
+        if not isinstance(func, str):
+            func = getattr(func, '__name__', '')
+        name = func.split('.')[-1].split(':')[-1]
+        if name in ('set_temp', 'set_mode'):
+            return name
+        return None
+
+    def update_job(self, job_id, job=None):
+        """Adds, replaces or (if job is None or paused) removes a job
+        and recompiles only that job's changes."""
+        with self._lock:
+            if (job is None or job.next_run_time is None
+                    or self._job_kind(job.func_ref) is None):
+                self._jobs.pop(job_id, None)
+                self._job_changes.pop(job_id, None)
+            else:
+                self._jobs[job_id] = (job.trigger, job.func_ref, job.args)
+                if self._start is not None:
+                    self._job_changes[job_id] = self._compile_job(
+                        job_id, self._start, self._end
+                    )
+            self._changed()
+        return
+
+    def clear(self):
+        with self._lock:
+            self._jobs = {}
+            self._job_changes = {}
+            self._changed()
+        return
+
+    @contextmanager
+    def batch(self):
+        """Defers merging until the end of the block, for applying many
+        job changes at once."""
+        with self._lock:
+            self._deferred += 1
+            try:
+                yield self
+            finally:
+                self._deferred -= 1
+                if not self._deferred and self._dirty:
+                    self._changed()
+        return
+
+    def _changed(self):
+        if self._deferred:
+            self._dirty = True
+        elif self._start is not None:
+            self._merge()
+            self._dirty = False
+        return
+
+    def _job_value(self, job_id, kind, args):
+        # Job arguments come from the schedule database as they were
+        # stored, so they are checked here. Returns None if invalid.
+        try:
+            if kind == 'set_temp':
+                temp, scale = args
+                value = Config.to_celsius(float(temp), scale)
+                if value is not None and math.isnan(value):
+                    value = None
+            else:
+                value, = args
+        except (TypeError, ValueError, AttributeError):
+            value = None
+        if value is None:
+            self._l.warning('Skipping job {} with invalid arguments: {}'
+                            .format(job_id, args))
+        return value
+
+    def _compile_job(self, job_id, start, end):
+        # Returns the job's changes in [start, end)
+        trigger, func, args = self._jobs[job_id]
+        kind = self._job_kind(func)
+        value = self._job_value(job_id, kind, args)
+        if value is None:
+            return []
+        changes = []
+        end = utc_timestamp_to_datetime(end)
+        previous = None
+        now = utc_timestamp_to_datetime(start)
+        while True:
+            fire_time = trigger.get_next_fire_time(previous, now)
+            if fire_time is None or fire_time >= end:
+                break
+            changes.append((datetime_to_utc_timestamp(fire_time), job_id,
+                            kind, value))
+            previous = fire_time
+            now = fire_time + timedelta(microseconds=1)
+        return changes
+
+    def _merge(self):
+        changes = list(heapq.merge(*self._job_changes.values()))
+        set_temps = []
+        modes = []
+        set_temp = None
+        mode = None
+        for t, job_id, kind, value in changes:
+            if kind == 'set_temp':
+                set_temp = value
+            else:
+                mode = value
+            set_temps.append(set_temp)
+            modes.append(mode)
+        self._changes = changes
+        self._times = [c[0] for c in changes]
+        self._set_temps = set_temps
+        self._modes = modes
+        return
+
+    def rebuild(self, now=None):
+        """Recompiles every job for a window starting at now."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._start = now
+            self._end = now + self.WINDOW
+            self._built = now
+            self._job_changes = dict(
+                (job_id, self._compile_job(job_id, self._start, self._end))
+                for job_id in self._jobs
+            )
+            self._merge()
+            self.rebuilds += 1
+        self._l.debug('Set point timeline rebuilt: {} changes'
+                      .format(len(self._changes)))
+        return
+
+    def _extend(self, start):
+        # Compiles only [start, self._start) and prepends it
+        for job_id in self._jobs:
+            self._job_changes[job_id] = (
+                self._compile_job(job_id, start, self._start)
+                + self._job_changes.get(job_id, [])
+            )
+        self._start = start
+        self._merge()
+        self._l.debug('Set point timeline extended back to {}'
+                      .format(start))
+        return
+
+    @staticmethod
+    def _check_time(t, name='time'):
+        # Times arrive straight from API requests
+        if t is None:
+            return
+        if (isinstance(t, bool) or not isinstance(t, Number)
+                or math.isnan(t) or math.isinf(t)):
+            raise TimelineError(
+                'Invalid {}: expected a Unix time.'.format(name)
+            )
+        return
+
+    def _check_window(self, t):
+        now = time.time()
+        if self._built is None or now - self._built > self.REBUILD_AFTER:
+            self.rebuild(now)
+        if t < self._start:
+            self._extend(t)
+        if t >= self._end:
+            raise TimelineError('Time is beyond the compiled timeline.')
+        return
+
+    def at(self, t=None):
+        """Returns the set point and mode in effect at time t (default
+        now), the job that set them and when they next change."""
+        self._check_time(t)
+        if t is None:
+            t = time.time()
+        with self._lock:
+            self._check_window(t)
+            i = bisect.bisect_right(self._times, t) - 1
+            result = {
+                'time': t,
+                'set_temperature': None,
+                'mode_set': None,
+                'job_id': None,
+                'since': None,
+                'until': (self._times[i + 1]
+                          if i + 1 < len(self._times) else None)
+            }
+            if i >= 0:
+                result['set_temperature'] = self._set_temps[i]
+                result['mode_set'] = self._modes[i]
+                result['since'], result['job_id'] = self._changes[i][:2]
+            if result['set_temperature'] is None or result['mode_set'] is None:
+                # Nothing scheduled yet, the configuration applies
+                config = Config().get_config()['config']
+                if result['set_temperature'] is None:
+                    result['set_temperature'] = config['set_temperature']
+                if result['mode_set'] is None:
+                    result['mode_set'] = config['mode_set']
+            return result
+
+    def next_change(self, t=None, kind=None):
+        """Returns the first change after t (default now), optionally
+        only of kind 'set_temp' or 'set_mode', as a dict or None."""
+        self._check_time(t)
+        if t is None:
+            t = time.time()
+        with self._lock:
+            self._check_window(t)
+            i = bisect.bisect_right(self._times, t)
+            for change in self._changes[i:]:
+                if kind is None or change[2] == kind:
+                    return {'time': change[0], 'job_id': change[1],
+                            'kind': change[2], 'value': change[3]}
+        return None
+
+    def segments(self, start=None, end=None):
+        """Returns the segments between start and end (default the next
+        24 hours) as dicts with start, end, set_temperature, mode_set
+        and job_id."""
+        self._check_time(start, 'start')
+        self._check_time(end, 'end')
+        if start is None:
+            start = time.time()
+        if end is None:
+            end = start + 86400
+        if end < start:
+            raise TimelineError('The end is before the start.')
+        with self._lock:
+            self._check_window(start)
+            end = min(end, self._end)
+            first = self.at(start)
+            segments = [{
+                'start': start,
+                'set_temperature': first['set_temperature'],
+                'mode_set': first['mode_set'],
+                'job_id': first['job_id']
+            }]
+            i = bisect.bisect_right(self._times, start)
+            j = bisect.bisect_left(self._times, end)
+            for k in range(i, j):
+                t, job_id = self._changes[k][:2]
+                segments[-1]['end'] = t
+                segments.append({
+                    'start': t,
+                    'set_temperature': (self._set_temps[k]
+                                        if self._set_temps[k] is not None
+                                        else first['set_temperature']),
+                    'mode_set': (self._modes[k] if self._modes[k] is not None
+                                 else first['mode_set']),
+                    'job_id': job_id
+                })
+            segments[-1]['end'] = end
+            return segments
@@ -0,0 +1,284 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import object
+
+import json
+import os
+import random
+import threading
+import time
+import uuid
+import logging
+import logging.handlers
+from functools import wraps
+
+# Lightweight span tracing of the hot paths, toggled at runtime.
+#
+# Code marks the work it does with span(name), either as a context
+# manager or through the traced(name) decorator. Spans opened while
+# another is active on the same thread become its children. When the
+# outermost (root) span finishes, the whole tree is written to the trace
+# file as one JSON line:
+#
+#   {"trace_id", "name", "start", "duration_ms", "attrs", "children"}
+#
+# Root spans are sampled at sample_rate; the children of a trace that
+# isn't sampled are skipped too. While tracing is disabled span() returns
+# a shared no-op object, so instrumented code costs one attribute check.
+#
+# Tracing is enabled at start-up by the NIDO_TRACE environment variable
+# (optionally set to the sample rate), or at runtime with enable().
+
+
+class _NoopSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **attrs):
+        return None
+
+
+_NOOP = _NoopSpan()
+
+
+class Span(object):
+    def __init__(self, tracer, name, attrs):
+        self._tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.children = []
+        return
+
+    def __enter__(self):
+        self.start = time.time()
+        self._tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self.start
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self._tracer._pop(self)
+        return False
+
+    def set(self, **attrs):
+        """Adds attributes to the span, eg. a result status."""
+        self.attrs.update(attrs)
+        return None
+
+    def to_dict(self):
+        span = {
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': round(self.duration * 1000, 3)
+        }
+        if self.attrs:
+            span['attrs'] = self.attrs
+        if self.children:
+            span['children'] = [c.to_dict() for c in self.children]
+        return span
+
+
+class Tracer(object):
+    """Collects span trees per thread and writes sampled traces to a
+    rotating file."""
+
+    def __init__(self):
+        self._l = logging.getLogger(__name__)
+        self.enabled = False
+        self.sample_rate = 1.0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writer = None
+        self._trace_file = None
+        self._max_bytes = 1048576
+        self._backup_count = 3
+        self.traces_written = 0
+        return
+
+    def configure(self, trace_file, max_bytes=1048576, backup_count=3):
+        """Sets the trace file; it's opened on the first trace."""
+        with self._lock:
+            if trace_file != self._trace_file:
+                self._close_writer()
+            self._trace_file = trace_file
+            self._max_bytes = max_bytes
+            self._backup_count = backup_count
+        return
+
+    def enable(self, sample_rate=None):
+        if sample_rate is not None:
+            self.sample_rate = max(0.0, min(float(sample_rate), 1.0))
+        self.enabled = True
+        self._l.info('Tracing enabled, sample rate {}'
+                     .format(self.sample_rate))
+        return
+
+    def disable(self):
+        self.enabled = False
+        self._l.info('Tracing disabled')
+        return
+
+    def get_status(self):
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'trace_file': self._trace_file,
+            'traces_written': self.traces_written
+        }
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return _NOOP
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            # Inside an unsampled trace
+            if stack[-1] is None:
+                return _NOOP
+        elif random.random() >= self.sample_rate:
+            return _UnsampledRoot(self)
+        return Span(self, name, attrs)
+
+    def _push(self, span):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        if stack and stack[-1] is not None:
+            stack[-1].children.append(span)
+        stack.append(span)
+        return
+
+    def _pop(self, span):
+        stack = self._local.stack
+        stack.pop()
+        if not stack and span is not None:
+            self._write(span)
+        return
+
+    def _write(self, span):
+        trace = span.to_dict()
+        trace['trace_id'] = uuid.uuid4().hex
+        trace['pid'] = os.getpid()
+        line = json.dumps(trace, sort_keys=True, default=str)
+        with self._lock:
+            if self._trace_file is None:
+                return
+            try:
+                if self._writer is None:
+                    self._writer = logging.handlers.RotatingFileHandler(
+                        self._trace_file, maxBytes=self._max_bytes,
+                        backupCount=self._backup_count
+                    )
+                    self._writer.setFormatter(
+                        logging.Formatter('%(message)s')
+                    )
+                self._writer.emit(logging.LogRecord(
+                    'nido.trace', logging.INFO, '', 0, line, None, None
+                ))
+                self.traces_written += 1
+            except (IOError, OSError) as e:
+                self._l.error('Error writing trace: {}'.format(e))
+        return
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        return
+
+
+class _UnsampledRoot(_NoopSpan):
+    """Root of a trace that wasn't sampled, marks the thread so nested
+    spans are skipped."""
+
+    def __init__(self, tracer):
+        self._tracer = tracer
+
+    def __enter__(self):
+        self._tracer._push(None)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._tracer._pop(None)
+        return False
+
+
+TRACER = Tracer()
+
+
+def span(name, **attrs):
+    return TRACER.span(name, **attrs)
+
+
+def traced(name=None):
+    """Decorator that runs the function in a span, named after the
+    function unless name is given."""
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return func(*args, **kwargs)
+            with TRACER.span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def trace_file(path, process):
+    """Returns the trace file for process: path with the process name
+    inserted before the extension, eg. nido-trace.nidod.log.
+
+    Each process rotates its own file, a file shared between processes
+    would lose spans whenever one of them rotated it."""
+    root, ext = os.path.splitext(path)
+    return '{}.{}{}'.format(root, process, ext)
+
+
+def configure(config, process):
+    """Configures the tracer from the tracing section of the
+    configuration, writing to the trace file for process (see
+    trace_file()), and enables it if NIDO_TRACE is set."""
+    tracing_cfg = config['tracing']
+    TRACER.configure(trace_file(tracing_cfg['file'], process),
+                     max_bytes=tracing_cfg['max_bytes'],
+                     backup_count=tracing_cfg['backup_count'])
+    if 'NIDO_TRACE' in os.environ:
+        try:
+            sample_rate = float(os.environ['NIDO_TRACE'])
+        except ValueError:
+            sample_rate = tracing_cfg['sample_rate']
+        TRACER.enable(sample_rate)
+    elif not TRACER.enabled:
+        TRACER.sample_rate = tracing_cfg['sample_rate']
+    return TRACER
@@ -0,0 +1,301 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+from future import standard_library
+standard_library.install_aliases()
+from builtins import *
+from builtins import str
+from builtins import object
+
+import itertools
+import json
+import logging
+import re
+import threading
+import requests
+from abc import ABCMeta, abstractmethod
+from future.utils import with_metaclass
+from requests import RequestException
+
+# Weather providers return conditions in the following normalized
+# format, regardless of the upstream API:
+#
+#   {
+#       'location': {
+#           'full', 'city', 'state', 'zipcode', 'country',
+#           'coordinates': {'latitude', 'longitude'}
+#       },
+#       'temp_c': current temperature,
+#       'relative_humidity': current relative humidity (integer %),
+#       'pressure_mb': current pressure,
+#       'condition': {'description', 'icon_url'},
+#       'forecast': {'high', 'low'},
+#       'solar': {'sunrise', 'sunset'} (as HHMM integers)
+#   }
+#
+# Each provider fetches current conditions, forecast and solar data
+# together in a single request per refresh.
+
+# Shared HTTP session so weather requests reuse pooled (TLS) connections
+_SESSION = requests.Session()
+
+
+class WeatherProviderError(Exception):
+    """Exception class for errors generated by weather providers"""
+
+    def __init__(self, msg):
+        self.msg = msg
+        return
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+class WeatherProvider(with_metaclass(ABCMeta, object)):
+    """Base class for weather providers.
+
+    HTTP providers fetch data with _get_json(), which turns failed
+    requests, error responses and invalid JSON into
+    WeatherProviderError.
+    """
+
+    def __init__(self, timeout=None):
+        self._l = logging.getLogger(__name__)
+        self._timeout = timeout
+        return
+
+    @abstractmethod
+    def get_conditions(self, query):
+        """Returns conditions in the normalized format above or raises
+        WeatherProviderError. query is 'autoip', a zipcode or a
+        'latitude,longitude' string."""
+
+    def _get_json(self, url):
+        try:
+            r = _SESSION.get(url, timeout=self._timeout)
+            # Error pages from the provider are not weather data, nor
+            # are redirects that weren't followed
+            r.raise_for_status()
+            if not 200 <= r.status_code < 300:
+                raise WeatherProviderError(
+                    'Error retrieving local weather: HTTP {}'
+                    .format(r.status_code)
+                )
+            return r.json()
+        except RequestException as e:
+            # Making the request failed, or the provider returned an error
+            raise WeatherProviderError(
+                'Error retrieving local weather: {}'.format(e)
+            )
+        except ValueError as e:
+            raise WeatherProviderError(
+                'Invalid weather data received: {}'.format(e)
+            )
+
+
+class WundergroundProvider(WeatherProvider):
+    """Weather Underground conditions/forecast/astronomy API.
+
+    API documentation here:
+    http://api.wunderground.com/weather/api/d/docs?d=data/index
+    """
+
+    def __init__(self, api_key, api_url='https://api.wunderground.com/api',
+                 timeout=None):
+        super(WundergroundProvider, self).__init__(timeout=timeout)
+        self.api_key = api_key
+        self.api_url = api_url
+        return
+
+    def get_conditions(self, query):
+        request_url = (
+            '{}/{}/{}/q/{}.json'
+            .format(
+                self.api_url, self.api_key, 'conditions/forecast/astronomy',
+                query
+            )
+        )
+        return self._parse_result(self._get_json(request_url))
+
+    @staticmethod
+    def _parse_result(r_json):
+        try:
+            current_observation = r_json['current_observation']
+            forecast = r_json['forecast']['simpleforecast']['forecastday']
+            sun_phase = r_json['sun_phase']
+        except KeyError:
+            try:
+                api_error = r_json['response']['error']
+            except KeyError:
+                raise WeatherProviderError(
+                    'Unknown Wunderground API error. Response data: '
+                    + str(r_json)
+                )
+            if 'description' in api_error:
+                raise WeatherProviderError(
+                    'Wunderground API error ({}): {}'
+                    .format(api_error['type'], api_error['description'])
+                )
+            raise WeatherProviderError(
+                'Wunderground API error ({})'.format(api_error['type'])
+            )
+
+        try:
+            # Remove '%' and format relatively humidity as a number
+            rh = re.sub('[^0-9]', '',
+                        current_observation['relative_humidity'])
+            rh = int(float(rh))
+            # Get shortest term high/low forecast
+            for period in forecast:
+                if period['period'] == 1:
+                    fcast_high = float(period['high']['celsius'])
+                    fcast_low = float(period['low']['celsius'])
+
+            display_location = current_observation['display_location']
+            sunrise = sun_phase['sunrise']
+            sunset = sun_phase['sunset']
+            # Convert icon URL to HTTPS
+            icon_url = re.sub('(http)', 'https',
+                              current_observation['icon_url'], count=1)
+            return {
+                'location': {
+                    'full': display_location['full'],
+                    'city': display_location['city'],
+                    'state': display_location['state'],
+                    'zipcode': display_location['zip'],
+                    'country': display_location['country'],
+                    'coordinates': {
+                        'latitude': display_location['latitude'],
+                        'longitude': display_location['longitude']
+                    }
+                },
+                'temp_c': current_observation['temp_c'],
+                'relative_humidity': rh,
+                'pressure_mb': current_observation['pressure_mb'],
+                'condition': {
+                    'description': current_observation['weather'],
+                    'icon_url': icon_url
+                },
+                'forecast': {
+                    'high': fcast_high,
+                    'low': fcast_low
+                },
+                'solar': {
+                    'sunrise': int(sunrise['hour'] + sunrise['minute']),
+                    'sunset': int(sunset['hour'] + sunset['minute'])
+                }
+            }
+        except (KeyError, ValueError, NameError) as e:
+            # Something changed in the response format, generate an error
+            raise WeatherProviderError(
+                'Error parsing Wunderground API data: {}'.format(str(e))
+            )
+
+
+class JSONProvider(WeatherProvider):
+    """Generic HTTP provider for a service that already returns
+    conditions in the normalized format.
+
+    url may contain a {query} placeholder. If key is set, the conditions
+    are read from that top-level key of the response.
+    """
+
+    def __init__(self, url, key=None, timeout=None):
+        super(JSONProvider, self).__init__(timeout=timeout)
+        self.url = url
+        self.key = key
+        return
+
+    def get_conditions(self, query):
+        r_json = self._get_json(self.url.format(query=query))
+        if self.key:
+            try:
+                r_json = r_json[self.key]
+            except (KeyError, TypeError):
+                raise WeatherProviderError(
+                    'Weather data has no "{}" key'.format(self.key)
+                )
+        return _check_conditions(r_json)
+
+
+class ReplayProvider(WeatherProvider):
+    """Serves conditions from a local JSON file without any network
+    access, eg. for load testing /get_weather offline.
+
+    The file contains either one conditions dict, or a list of them
+    which are returned in turn on each refresh.
+    """
+
+    def __init__(self, replay_file):
+        super(ReplayProvider, self).__init__()
+        try:
+            with open(replay_file, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            raise WeatherProviderError(
+                'Error loading weather replay file: {}'.format(e)
+            )
+        if not isinstance(data, list):
+            data = [data]
+        self._conditions = itertools.cycle(
+            [_check_conditions(c) for c in data]
+        )
+        self._lock = threading.Lock()
+        return
+
+    def get_conditions(self, query):
+        with self._lock:
+            return next(self._conditions)
+
+
+def _check_conditions(conditions):
+    required = ['location', 'temp_c', 'relative_humidity', 'pressure_mb',
+                'condition', 'forecast', 'solar']
+    if not isinstance(conditions, dict):
+        raise WeatherProviderError('Weather data is not an object.')
+    missing = [k for k in required if k not in conditions]
+    if missing:
+        raise WeatherProviderError(
+            'Weather data is missing: {}'.format(', '.join(missing))
+        )
+    return conditions
+
+
+def get_provider(config):
+    """Returns the weather provider selected by weather:provider in the
+    configuration ('wunderground', 'json' or 'replay')."""
+    weather_cfg = config['weather']
+    provider = weather_cfg['provider']
+    timeout = (weather_cfg['connect_timeout'], weather_cfg['read_timeout'])
+    if provider == 'wunderground':
+        return WundergroundProvider(
+            config['wunderground']['api_key'],
+            api_url=config['wunderground']['api_url'], timeout=timeout
+        )
+    elif provider == 'json':
+        return JSONProvider(weather_cfg['url'], key=weather_cfg.get('key'),
+                            timeout=timeout)
+    elif provider == 'replay':
+        return ReplayProvider(weather_cfg['replay_file'])
+    raise WeatherProviderError(
+        'Unknown weather provider: {}'.format(provider)
+    )
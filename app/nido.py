@@ -51,6 +51,8 @@ app = Flask(__name__)
 app.config.from_object(__name__)
 # Register custom converter with Flask
 app.url_map.converters['regex'] = ns.RegexConverter
+ns.init_metrics(app)
+ns.init_tracing(app)
 
 
 @app.route('/')
@@ -128,7 +130,12 @@ def get_state():
 
     # Returns a JSON dict with an 'error' key on error
     # On success, returns a JSON dict with a 'conditions' key
-    sensor_data = Sensor().get_conditions()
+    # Prefer the daemon's latest sample over reading the sensor here
+    try:
+        sensor_data = NidoDaemonService().get_conditions()
+    except Exception as e:
+        app.logger.debug('Reading sensor directly: {}'.format(e))
+        sensor_data = Sensor().get_conditions()
     if 'error' in sensor_data:
         resp.data['error'].append(sensor_data['error'])
     else:
@@ -148,10 +155,7 @@ def get_weather():
     resp = ns.JSONResponse()
     # Any errors will be passed through
     # The receiving application should note the retrieval_age value
-    # as necessary.
-    # TODO: Support caching built into the LocalWeather() object by
-    #       storing the object in the session.
-    #       Needs to be a serializable object (see Flask documentation).
+    # as necessary. Results are cached and shared between requests.
     resp.data = LocalWeather().get_conditions()
 
     return resp.get_flask_response(app)
@@ -192,6 +196,15 @@ def set_config():
     return resp.get_flask_response(app)
 
 
+@app.route('/get_history', methods=['POST'])
+@ns.require_session
+def get_history():
+    """Returns recorded history as parallel arrays. The JSON body may
+    contain 'from', 'to' and 'resolution' (see ns.history_helper)."""
+    resp = ns.JSONResponse()
+    return ns.history_helper(app, resp, request.get_json(silent=True) or {})
+
+
 # Public API routes
 #   Secured by a pre-shared secret key in the request body
 
@@ -227,6 +240,44 @@ def api_set_temp(temp, scale):
     return resp.get_flask_response(app)
 
 
+@app.route('/api/history', methods=['POST'])
+@ns.require_secret
+def api_history():
+    """Endpoint that returns recorded history as parallel arrays.
+
+    The 'from', 'to' and 'resolution' parameters can be supplied in the
+    query string or the JSON body (see ns.history_helper).
+    """
+
+    resp = ns.JSONResponse()
+    params = dict(request.get_json())
+    params.update(request.args.to_dict())
+    return ns.history_helper(app, resp, params)
+
+
+@app.route('/api/trace', methods=['POST'])
+@ns.require_secret
+def api_trace():
+    """Endpoint to toggle tracing without restarting.
+
+    The body may contain 'enabled' (true / false), 'sample_rate' (0 - 1)
+    and 'target' ("web", "daemon" or "all"). Returns the tracing status
+    of each target.
+    """
+
+    resp = ns.JSONResponse()
+    resp = ns.tracing_helper(resp, request.get_json())
+    return resp.get_flask_response(app)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Returns the web server's metrics in the Prometheus text format.
+    There's no authentication; only the addresses in metrics:allow may
+    read them. Disabled with metrics:enabled in config.yaml."""
+    return ns.metrics_response()
+
+
 @app.route('/api/schedule/get/all', methods=['POST'])
 @ns.require_secret
 def api_schedule_get_all():
@@ -238,6 +289,92 @@ def api_schedule_get_all():
     return resp.get_flask_response(app)
 
 
+@app.route('/api/schedule/setpoint', methods=['POST'])
+@ns.require_secret
+def api_schedule_setpoint():
+    """Endpoint that returns the set point and mode the schedule puts
+    in effect at a given time.
+
+    The body may contain 'time' (Unix time, default now).
+    """
+
+    resp = ns.JSONResponse()
+    nds = NidoDaemonService(json=True)
+    params = request.get_json(silent=True) or {}
+    try:
+        resp.data['setpoint'] = nds.get_setpoint(params.get('time'))
+    except NidoDaemonServiceError as e:
+        resp.data['error'] = 'Error getting set point: {}'.format(e)
+    return resp.get_flask_response(app)
+
+
+@app.route('/api/schedule/timeline', methods=['POST'])
+@ns.require_secret
+def api_schedule_timeline():
+    """Endpoint that returns the scheduled set point / mode segments
+    between 'from' and 'to' in the body (Unix time, default the next 24
+    hours, up to a week ahead)."""
+
+    resp = ns.JSONResponse()
+    nds = NidoDaemonService(json=True)
+    params = request.get_json(silent=True) or {}
+    try:
+        resp.data['timeline'] = nds.get_timeline(params.get('from'),
+                                                 params.get('to'))
+    except NidoDaemonServiceError as e:
+        resp.data['error'] = 'Error getting timeline: {}'.format(e)
+    return resp.get_flask_response(app)
+
+
+@app.route('/api/schedule/batch', methods=['POST'])
+@ns.require_secret
+def api_schedule_batch():
+    """Endpoint to apply several schedule changes at once, eg. to set up
+    or replace a week's schedule in one request. Either every operation
+    is applied or none are.
+
+    The body must consist of a JSON object with the following keys:
+        operations -> List of operations, each an object with 'op' set
+                      to one of the following and the keys of the
+                      matching single-job endpoint:
+            add -> As /api/schedule/add, with 'type' ("temp" or "mode")
+                   and optionally 'paused'
+            modify -> As /api/schedule/modify, with 'job_id'
+            reschedule -> As /api/schedule/reschedule, with 'job_id'
+            pause, resume, remove -> With 'job_id'
+        Optional:
+            replace -> If true, the existing schedule is removed first
+    The operations returned by /api/schedule/export can be imported
+    with replace set.
+    """
+
+    resp = ns.JSONResponse()
+    nds = NidoDaemonService(json=True)
+    params = request.get_json(silent=True) or {}
+    try:
+        resp.data['batch'] = nds.apply_schedule_batch(
+            params.get('operations'), replace=params.get('replace', False)
+        )
+    except NidoDaemonServiceError as e:
+        resp.data['error'] = 'Error applying batch: {}'.format(e)
+    return resp.get_flask_response(app)
+
+
+@app.route('/api/schedule/export', methods=['POST'])
+@ns.require_secret
+def api_schedule_export():
+    """Endpoint that returns the schedule as a list of operations that
+    /api/schedule/batch accepts."""
+
+    resp = ns.JSONResponse()
+    nds = NidoDaemonService(json=True)
+    try:
+        resp.data['schedule'] = nds.export_schedule()
+    except NidoDaemonServiceError as e:
+        resp.data['error'] = 'Error exporting schedule: {}'.format(e)
+    return resp.get_flask_response(app)
+
+
 @app.route('/api/schedule/get/<string:id>', methods=['POST'])
 @ns.require_secret
 def api_schedule_get_jobid(id):
@@ -408,5 +545,6 @@ if __name__ == '__main__':
     root.addHandler(handler)
     # We're using an adhoc SSL context, which is not considered secure
     # by browsers because it invokes a self-signed certificate.
-    app.run(host='0.0.0.0', port=config.get_config()['flask']['port'],
-            ssl_context=SSL_MODE, threaded=False)
+    flask_cfg = config.get_config()['flask']
+    ns.run_server(app, '0.0.0.0', flask_cfg['port'], ssl_context=SSL_MODE,
+                  server=flask_cfg['server'], threads=flask_cfg['threads'])
@@ -31,19 +31,47 @@ import logging
 import logging.handlers
 import os
 from lib.daemon import Daemon
-from lib.nido import Config, Controller
+from lib.nido import Config, Controller, ControllerEngine, SensorSampler
+from lib.history import History
+from lib.timeline import Timeline
+from lib.optimalstart import OptimalStart
+from lib import metrics
+from lib import tracing
 from lib.scheduler import NidoSchedulerService
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import (EVENT_JOB_EXECUTED, EVENT_JOB_ERROR,
+                                EVENT_JOB_ADDED, EVENT_JOB_MODIFIED,
+                                EVENT_JOB_REMOVED, EVENT_ALL_JOBS_REMOVED)
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from rpyc.utils.server import ThreadedServer
 
+_JOB_EXECUTIONS = metrics.counter(
+    'nido_scheduler_jobs_total', 'Scheduled job executions.',
+    labels=('result',)
+)
+
 
 class NidoDaemon(Daemon):
     def run(self):
         self._l.debug('Starting run loop for Nido daemon')
-        self.controller = Controller()
         config = Config().get_config()
-        poll_interval = config['schedule']['poll_interval']
+        tracing.configure(config, 'nidod')
+        # Start sampling before the first controller update so it can
+        # use the latest reading
+        self.sampler = SensorSampler.start_instance(
+            config['sensor']['sample_interval']
+        )
+        self.controller = Controller()
+        self.history = History.from_config(config)
+        if self.history is not None:
+            self.sampler.add_listener(self._record_sample)
+            self.controller.add_listener(self._record_event)
+        # The engine evaluates the controller on its own adaptive timer
+        # and whenever it is notified of a change
+        self.engine = ControllerEngine.start_instance(self.controller, config)
+        self.sampler.add_listener(
+            lambda reading: self.engine.notify('sample')
+        )
         db_path = config['schedule']['db']
         rpc_port = config['schedule']['rpc_port']
 
@@ -57,24 +85,77 @@ class NidoDaemon(Daemon):
         job_defaults = {'coalesce': True, 'misfire_grace_time': 10}
         self.scheduler.configure(jobstores=jobstores,
                                  job_defaults=job_defaults)
-        self.scheduler.add_job(
-            NidoSchedulerService.wakeup, trigger='interval',
-            seconds=poll_interval, name='Poll'
-        )
-        self.scheduler.add_job(NidoSchedulerService.wakeup, name='Poll')
+        self.scheduler.add_listener(self._count_job,
+                                    EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
         self.scheduler.start()
 
+        # Compile the schedule into a set point timeline and keep it up
+        # to date as jobs change
+        self.timeline = Timeline()
+        for job in self.scheduler.get_jobs('schedule'):
+            self.timeline.update_job(job.id, job)
+        self.timeline.rebuild()
+        self.scheduler.add_listener(
+            self._update_timeline,
+            EVENT_JOB_ADDED | EVENT_JOB_MODIFIED | EVENT_JOB_REMOVED
+            | EVENT_ALL_JOBS_REMOVED
+        )
+        # Start heating / cooling early for scheduled set point changes
+        self.controller.optimal_start = OptimalStart.from_config(
+            config, self.timeline
+        )
+
+        metrics_cfg = config['metrics']
+        if metrics_cfg['enabled'] and metrics_cfg['daemon_port']:
+            metrics.start_http_server(metrics_cfg['daemon_port'],
+                                      host=metrics_cfg['daemon_host'])
+
         RPCserver = ThreadedServer(
-            NidoSchedulerService(self.scheduler),
+            NidoSchedulerService(self.scheduler, timeline=self.timeline),
             port=rpc_port,
             protocol_config={
-                'allow_public_attrs': True,
-                'allow_pickle': True
+                'allow_public_attrs': True
             }
         )
         RPCserver.start()
 
+    def _count_job(self, event):
+        _JOB_EXECUTIONS.inc(result='error' if event.exception else 'success')
+        return
+
+    def _update_timeline(self, event):
+        if event.code == EVENT_ALL_JOBS_REMOVED:
+            if event.alias in (None, 'schedule'):
+                self.timeline.clear()
+        elif event.jobstore == 'schedule':
+            job = None
+            if event.code != EVENT_JOB_REMOVED:
+                job = self.scheduler.get_job(event.job_id, 'schedule')
+            self.timeline.update_job(event.job_id, job)
+        return
+
+    def _record_sample(self, reading):
+        if 'conditions' not in reading:
+            return
+        config = Config().get_config()['config']
+        self.history.record(
+            reading['sample_time'], reading['conditions'],
+            config['set_temperature'], config['mode_set'],
+            self.controller.get_status()
+        )
+        return
+
+    def _record_event(self, status, ts):
+        config = Config().get_config()['config']
+        self.history.record_event(ts, status, config['mode_set'],
+                                  config['set_temperature'])
+        return
+
     def quit(self):
+        SensorSampler.stop_instance()
+        ControllerEngine.stop_instance()
+        if self.history is not None:
+            self.history.close()
         self.scheduler.shutdown()
         self.controller.shutdown()
         self._l.info('Nido daemon shutdown')
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares two benchmark result files from run.py.
+
+    python benchmarks/compare.py before.json after.json [--metric p50_ms]
+
+Prints the chosen latency metric of every benchmark in both files and
+the change, and exits with status 1 if any got slower by more than
+--threshold percent.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+
+def flatten(results, prefix=''):
+    """Yields (name, stats) for every benchmark in a results tree."""
+    for key, value in sorted(results.items()):
+        if not isinstance(value, dict):
+            continue
+        name = prefix + key
+        if 'count' in value:
+            yield name, value
+        else:
+            for item in flatten(value, name + ' '):
+                yield item
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('-m', '--metric', default='p50_ms')
+    parser.add_argument('-t', '--threshold', type=float, default=10,
+                        help='regression threshold in percent')
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = dict(flatten(json.load(f)['results']))
+    with open(args.after) as f:
+        after = dict(flatten(json.load(f)['results']))
+
+    regressed = False
+    for name in sorted(set(before) & set(after)):
+        old = before[name].get(args.metric)
+        new = after[name].get(args.metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        flag = ''
+        if change > args.threshold:
+            flag = '  REGRESSION'
+            regressed = True
+        print('{:40} {:10.3f} {:10.3f} {:+8.1f}%{}'
+              .format(name, old, new, change, flag))
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
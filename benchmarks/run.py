@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for Nido's request and control hot paths.
+
+Runs in testing mode (NIDO_TESTING, FakeGPIO and FakeSensor) against the
+installation in NIDO_BASE, so use a base with a test configuration:
+
+    NIDO_BASE=/path/to/nido python benchmarks/run.py -o results.json
+
+Suites (select with --suite, default all):
+
+    core  - Controller.update(), Config.get_config() and
+            Sensor.get_conditions() called in-process
+    http  - /get_state, /get_config, /set_config and the
+            /api/schedule/* routes through Flask's test client
+    load  - concurrent clients against the app served over HTTP by the
+            thread pool server (or --url)
+
+The load suite's in-process server answers /get_weather from a
+ReplayProvider with fixed conditions, so no requests go out to the
+weather service. With --url the weather provider can't be replaced, so
+/get_weather is left out of the mix.
+
+The schedule routes need the daemon's RPC service. --start-daemon runs
+an in-process scheduler with an in-memory job store on the configured
+rpc_port instead of the real daemon.
+
+Results are written as JSON; compare two runs with compare.py.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+_APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'app')
+
+
+def summarise(samples, elapsed=None):
+    """Returns latency statistics (in milliseconds) for a list of
+    per-call durations in seconds."""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    count = len(ordered)
+
+    def percentile(p):
+        return ordered[min(int(p / 100 * count), count - 1)] * 1000
+
+    result = {
+        'count': count,
+        'mean_ms': sum(ordered) / count * 1000,
+        'min_ms': ordered[0] * 1000,
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p99_ms': percentile(99),
+        'max_ms': ordered[-1] * 1000
+    }
+    if elapsed is None:
+        elapsed = sum(ordered)
+    result['ops_per_sec'] = count / elapsed if elapsed else None
+    return result
+
+
+def measure(func, iterations, warmup=10):
+    for i in range(warmup):
+        func()
+    samples = []
+    start = time.time()
+    for i in range(iterations):
+        t = time.time()
+        func()
+        samples.append(time.time() - t)
+    return summarise(samples, time.time() - start)
+
+
+def bench_core(iterations):
+    from lib.nido import Config, Controller, Sensor
+    controller = Controller()
+    return {
+        'Controller.update': measure(controller.update, iterations),
+        'Config.get_config': measure(lambda: Config().get_config(),
+                                     iterations),
+        'Sensor.get_conditions': measure(
+            lambda: Sensor().get_conditions(), iterations
+        )
+    }
+
+
+def _check(resp):
+    if resp.status_code != 200:
+        raise RuntimeError('{} returned {}'.format(resp.request.path
+                                                   if hasattr(resp, 'request')
+                                                   else 'request',
+                                                   resp.status_code))
+    data = json.loads(resp.get_data(as_text=True))
+    if 'error' in data:
+        raise RuntimeError(data['error'])
+    return data
+
+
+def bench_http(iterations, daemon):
+    import nido
+    from lib.nido import Config
+    app = nido.app
+    config = Config().get_config()
+    flask_cfg = config['flask']
+    secret = flask_cfg['public_api_secret']
+    client = app.test_client()
+    _check(client.post('/login', data={'username': flask_cfg['username'],
+                                       'password': flask_cfg['password']}))
+
+    def post_json(url, data=None):
+        return _check(client.post(url, data=json.dumps(data or {}),
+                                  content_type='application/json'))
+
+    set_temp = config['config']['set_temperature']
+    results = {
+        '/get_state': measure(lambda: post_json('/get_state'), iterations),
+        '/get_config': measure(lambda: post_json('/get_config'), iterations)
+    }
+    toggle = [0]
+
+    def set_config():
+        toggle[0] ^= 1
+        post_json('/set_config',
+                  {'set_temperature': set_temp + toggle[0] * 0.5})
+
+    results['/set_config'] = measure(set_config, iterations)
+    post_json('/set_config', {'set_temperature': set_temp})
+
+    if not daemon:
+        results['/api/schedule'] = {'skipped': 'daemon not available'}
+        return results
+
+    # One timed call per route per iteration on a fresh job
+    samples = dict((r, []) for r in ['add', 'get', 'get/all', 'modify',
+                                     'reschedule', 'pause', 'resume',
+                                     'remove'])
+    for i in range(iterations):
+        job_id = 'bench-{}'.format(i)
+        calls = [
+            ('add', '/api/schedule/add/temp',
+             {'job_id': job_id, 'temp': 20, 'scale': 'C', 'hour': 6,
+              'minute': 30}),
+            ('get', '/api/schedule/get/' + job_id, {}),
+            ('get/all', '/api/schedule/get/all', {}),
+            ('modify', '/api/schedule/modify/' + job_id,
+             {'type': 'mode', 'mode': 'Heat'}),
+            ('reschedule', '/api/schedule/reschedule/' + job_id,
+             {'hour': 7}),
+            ('pause', '/api/schedule/pause/' + job_id, {}),
+            ('resume', '/api/schedule/resume/' + job_id, {}),
+            ('remove', '/api/schedule/remove/' + job_id, {})
+        ]
+        for name, url, data in calls:
+            data['secret'] = secret
+            t = time.time()
+            post_json(url, data)
+            samples[name].append(time.time() - t)
+    for name, s in samples.items():
+        results['/api/schedule/' + name] = summarise(s)
+    return results
+
+
+# Conditions served by the load suite's weather provider
+_WEATHER = {
+    'location': {
+        'full': 'Springfield, IL', 'city': 'Springfield', 'state': 'IL',
+        'zipcode': '62701', 'country': 'US',
+        'coordinates': {'latitude': '39.80', 'longitude': '-89.64'}
+    },
+    'temp_c': 12.5,
+    'relative_humidity': 60,
+    'pressure_mb': '1015',
+    'condition': {'description': 'Clear', 'icon_url': ''},
+    'forecast': {'high': 15.0, 'low': 4.0},
+    'solar': {'sunrise': 612, 'sunset': 1845}
+}
+
+
+def _replay_weather():
+    """Makes LocalWeather in this process use a ReplayProvider serving
+    _WEATHER instead of the configured provider."""
+    import tempfile
+    from lib import nido
+    from lib.weather import ReplayProvider
+    fd, path = tempfile.mkstemp(prefix='nido-weather.', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_WEATHER, f)
+        provider = ReplayProvider(path)
+    finally:
+        os.remove(path)
+    # Providers are kept per weather configuration
+    with nido._WEATHER_PROVIDERS_LOCK:
+        nido._WEATHER_PROVIDERS[nido.LocalWeather()._provider_key] = provider
+    return
+
+
+def _start_server(threads):
+    import nido
+    from lib.nidoserver import ThreadPoolWSGIServer
+    server = ThreadPoolWSGIServer('127.0.0.1', 0, nido.app, threads=threads)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def bench_load(url, clients, duration, threads):
+    """Runs clients concurrent sessions that each log in and then loop
+    over a mix of UI requests for duration seconds."""
+    import requests
+    from lib.nido import Config
+    flask_cfg = Config().get_config()['flask']
+    server = None
+    mix = ['/get_state', '/get_config', '/get_state']
+    if url is None:
+        _replay_weather()
+        server, url = _start_server(threads)
+        mix.append('/get_weather')
+    lock = threading.Lock()
+    samples = dict((r, []) for r in mix)
+    errors = [0]
+    deadline = [None]
+    # Clients log in, then wait for the rest before starting together
+    ready = threading.Condition()
+    ready_count = [0]
+    go = threading.Event()
+
+    def client():
+        session = requests.Session()
+        session.verify = False
+        local = dict((r, []) for r in mix)
+        failed = 0
+        try:
+            session.post(url + '/login',
+                         data={'username': flask_cfg['username'],
+                               'password': flask_cfg['password']})
+        except requests.RequestException:
+            failed += 1
+        with ready:
+            ready_count[0] += 1
+            ready.notify()
+        go.wait()
+        i = 0
+        while time.time() < deadline[0]:
+            route = mix[i % len(mix)]
+            i += 1
+            t = time.time()
+            try:
+                r = session.post(url + route, json={})
+                if r.status_code != 200:
+                    failed += 1
+            except requests.RequestException:
+                failed += 1
+            local[route].append(time.time() - t)
+        with lock:
+            for route, s in local.items():
+                samples[route].extend(s)
+            errors[0] += failed
+
+    workers = [threading.Thread(target=client) for i in range(clients)]
+    for w in workers:
+        w.start()
+    with ready:
+        while ready_count[0] < clients:
+            ready.wait()
+    start = time.time()
+    deadline[0] = start + duration
+    go.set()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+    if server is not None:
+        server.shutdown()
+
+    all_samples = [s for route in mix for s in samples[route]]
+    results = {
+        'clients': clients,
+        'duration': elapsed,
+        'errors': errors[0],
+        'total': summarise(all_samples, elapsed)
+    }
+    for route in set(mix):
+        results[route] = summarise(samples[route], elapsed)
+    return results
+
+
+def start_daemon():
+    """Starts the daemon's RPC service in-process with an in-memory
+    schedule, returning False if the RPC port is already in use."""
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from rpyc.utils.server import ThreadedServer
+    from lib.nido import Config
+    from lib.scheduler import NidoSchedulerService
+    rpc_port = Config().get_config()['schedule']['rpc_port']
+    scheduler = BackgroundScheduler()
+    scheduler.configure(jobstores={'default': {'type': 'memory'},
+                                   'schedule': {'type': 'memory'}})
+    scheduler.start()
+    try:
+        server = ThreadedServer(
+            NidoSchedulerService(scheduler), hostname='localhost',
+            port=rpc_port, protocol_config={'allow_public_attrs': True}
+        )
+    except (IOError, OSError) as e:
+        print('Could not start RPC service: {}'.format(e), file=sys.stderr)
+        return False
+    thread = threading.Thread(target=server.start)
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def daemon_available():
+    from lib.scheduler import NidoDaemonService
+    try:
+        NidoDaemonService(json=True).get_scheduled_jobs()
+    except Exception:
+        return False
+    return True
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=_APP_DIR,
+            stderr=subprocess.STDOUT
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.time(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', help='JSON results file '
+                        '(default: print to stdout)')
+    parser.add_argument('-s', '--suite', action='append',
+                        choices=['core', 'http', 'load'],
+                        help='suite to run, may be repeated')
+    parser.add_argument('-n', '--iterations', type=int, default=200)
+    parser.add_argument('--start-daemon', action='store_true',
+                        help='serve the daemon RPC API in-process')
+    parser.add_argument('--url', help='base URL for the load suite '
+                        '(default: serve the app in-process)')
+    parser.add_argument('-c', '--clients', type=int, default=8)
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='server threads for the in-process server')
+    args = parser.parse_args()
+
+    if 'NIDO_BASE' not in os.environ:
+        parser.error('NIDO_BASE must be set')
+    os.environ.setdefault('NIDO_TESTING', '')
+    # Keep FakeGPIO pins in memory unless a state file was given
+    os.environ.setdefault('NIDO_TESTING_GPIO', '')
+    sys.path.insert(0, _APP_DIR)
+
+    suites = args.suite or ['core', 'http', 'load']
+    results = {'meta': metadata(), 'results': {}}
+    if args.start_daemon:
+        start_daemon()
+    daemon = 'http' in suites and daemon_available()
+
+    if 'core' in suites:
+        results['results']['core'] = bench_core(args.iterations)
+    if 'http' in suites:
+        results['results']['http'] = bench_http(args.iterations, daemon)
+    if 'load' in suites:
+        results['results']['load'] = bench_load(
+            args.url, args.clients, args.duration, args.threads
+        )
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
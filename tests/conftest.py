@@ -0,0 +1,82 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+# The lib modules read NIDO_BASE and the testing variables when they are
+# imported, so a throwaway base directory with a testing configuration
+# (based on config-example.yaml) is set up here, before any test module
+# imports them. GPIO is the in-memory FakeGPIO.
+
+import os
+import sys
+import tempfile
+import shutil
+import yaml
+import pytest
+
+_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_BASE = tempfile.mkdtemp(prefix='nido-test.')
+
+
+def _write_config():
+    with open(os.path.join(_REPO, 'app', 'cfg', 'config-example.yaml')) as f:
+        config = yaml.safe_load(f)
+    db_dir = os.path.join(_BASE, 'app', 'db')
+    os.makedirs(db_dir)
+    os.makedirs(os.path.join(_BASE, 'app', 'cfg'))
+    config['config'] = {
+        'celsius': True,
+        'modes_available': [['Heat', True], ['Cool', True]],
+        'modes': ['Off', 'Heat', 'Cool', 'Heat_Cool'],
+        'mode_set': 'Off',
+        'set_temperature': 20
+    }
+    config['weather']['cache_file'] = os.path.join(db_dir, 'weather.json')
+    config['history']['db'] = os.path.join(db_dir, 'history.db')
+    config['schedule']['db'] = os.path.join(db_dir, 'nido.db')
+    config['schedule']['rpc_host'] = 'localhost'
+    config['schedule']['rpc_port'] = 49999
+    config['tracing']['file'] = os.path.join(_BASE, 'trace.log')
+    config['daemon'] = {
+        'pid_file': os.path.join(_BASE, 'nido.pid'),
+        'work_dir': _BASE,
+        'log_file': os.path.join(_BASE, 'nidod.log')
+    }
+    with open(os.path.join(_BASE, 'app', 'cfg', 'config.yaml'), 'w') as f:
+        yaml.dump(config, f, default_flow_style=False)
+
+
+_write_config()
+os.environ['NIDO_BASE'] = _BASE
+os.environ['NIDO_TESTING'] = '1'
+os.environ['NIDO_TESTING_GPIO'] = ''
+os.environ.pop('NIDO_TRACE', None)
+sys.path.insert(0, os.path.join(_REPO, 'app'))
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_BASE, ignore_errors=True)
+
+
+@pytest.fixture
+def nido_config():
+    """Returns the test Config, reset to mode Off at 20C afterwards."""
+    from lib.nido import Config
+    cfg = Config()
+    yield cfg
+    cfg.set_mode('Off')
+    cfg.set_temp(20, 'C')
@@ -0,0 +1,71 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+
+from lib.Adafruit_BME280 import BME280
+
+
+class _Device(object):
+    """Stands in for an I2C device, with registers as a dict."""
+
+    def __init__(self, registers):
+        self.registers = registers
+
+    def readU8(self, register):
+        return self.registers.get(register, 0)
+
+    def readList(self, register, length):
+        return [self.registers.get(register + i, 0) for i in range(length)]
+
+    def write8(self, register, value):
+        self.registers[register] = value
+
+
+class _I2C(object):
+    def __init__(self, device):
+        self.device = device
+
+    def get_i2c_device(self, address, **kwargs):
+        return self.device
+
+
+def _registers(seed):
+    registers = dict((0x88 + i, (seed + i * 7) % 256) for i in range(26))
+    registers.update((0xE1 + i, (seed + i * 11) % 256) for i in range(7))
+    registers[0xD0] = 0x60
+    return registers
+
+
+def test_calibration_cache():
+    device = _Device(_registers(1))
+    sensor = BME280(i2c=_I2C(device))
+    calibration = sensor.get_calibration()
+    cache = {sensor.calibration_key: calibration}
+
+    # The same part reuses the cached values
+    cached = dict(calibration, dig_T1=12345)
+    sensor = BME280(i2c=_I2C(device),
+                    calibration={sensor.calibration_key: cached})
+    assert sensor.dig_T1 == 12345
+
+    # A replaced part at the same address, with the same chip ID, reads
+    # its own calibration
+    replaced = BME280(i2c=_I2C(_Device(_registers(2))), calibration=cache)
+    assert replaced.calibration_key != sensor.calibration_key
+    assert replaced.calibration_key.startswith('0x77-')
+    assert replaced.get_calibration() != calibration
@@ -0,0 +1,83 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+import yaml
+
+from lib.nido import Config
+
+
+def _read(config):
+    with open(config._CONFIG) as f:
+        return yaml.safe_load(f)
+
+
+def test_only_changes_written(nido_config):
+    before = _read(nido_config)
+    assert 'sample_interval' not in before['sensor']
+    # Filled in from the schema
+    assert 'sample_interval' in nido_config.get_config()['sensor']
+
+    nido_config.set_temp(23, 'C')
+    after = _read(nido_config)
+    assert after['config']['set_temperature'] == 23
+    # Defaults aren't written to the file
+    assert 'sample_interval' not in after['sensor']
+    del before['config']['set_temperature']
+    del after['config']['set_temperature']
+    assert after == before
+
+
+def test_unchanged_not_written(nido_config):
+    nido_config.set_temp(22, 'C')
+    mtime = os.stat(nido_config._CONFIG).st_mtime_ns
+    nido_config.set_temp(22, 'C')
+    assert os.stat(nido_config._CONFIG).st_mtime_ns == mtime
+
+
+def test_merge_changes():
+    persisted = {'config': {'set_temperature': 20},
+                 'sensor': {'mode': 'normal'}}
+    effective = {'config': {'set_temperature': 20, 'celsius': True},
+                 'sensor': {'mode': 'normal', 'sample_interval': 10},
+                 'history': {'db': None}}
+    config = {'config': {'set_temperature': 20, 'celsius': False},
+              'sensor': {'mode': 'normal', 'sample_interval': 10},
+              'history': {'db': None},
+              'daemon': {'pid_file': '/tmp/nido.pid'}}
+    assert Config._merge_changes(persisted, effective, config) == {
+        'config': {'set_temperature': 20, 'celsius': False},
+        'sensor': {'mode': 'normal'},
+        'daemon': {'pid_file': '/tmp/nido.pid'}
+    }
+
+
+def test_moved_settings(nido_config):
+    config = {'wunderground': {'api_key': 'key', 'cache_expiry': 600,
+                               'cache_file': '/tmp/weather.json'},
+              'weather': {'cache_expiry': 300}}
+    nido_config._apply_moved(config)
+    # Only read from the old place if not set in the new one
+    assert config['weather'] == {'cache_expiry': 300,
+                                 'cache_file': '/tmp/weather.json'}
+
+    config = {'wunderground': {'api_key': 'key', 'cache_expiry': 600}}
+    nido_config._apply_moved(config)
+    assert config['weather'] == {'cache_expiry': 600}
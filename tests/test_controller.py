@@ -0,0 +1,186 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+# Controller state machine checks, run against the simulated house and
+# FakeGPIO on a virtual clock.
+
+import pytest
+
+from lib.nido import ControllerEngine, GPIO, Status
+from lib.simulator import HouseModel, OutdoorProfile, Simulation
+
+
+@pytest.fixture
+def simulation(nido_config):
+    """Returns a function creating a Simulation that records the
+    controller's transitions in sim.transitions as (time, Status)."""
+    sims = []
+
+    def create(temp=18.0, outdoor=None, noise=0.0):
+        house = HouseModel(temp=temp,
+                           outdoor=outdoor or OutdoorProfile(mean=5.0))
+        sim = Simulation(house=house, start=1000000000.0, noise=noise,
+                         seed=1)
+        sim.transitions = []
+        sim.controller.add_listener(
+            lambda status, now: sim.transitions.append((now, Status(status)))
+        )
+        sims.append(sim)
+        return sim
+
+    yield create
+    for sim in sims:
+        sim.controller.shutdown()
+
+
+def _check_timing(transitions, behavior):
+    # transitions[0] is the initial status
+    last_start = None
+    for (t0, s0), (t1, s1) in zip(transitions, transitions[1:]):
+        if s0 is not Status.Off:
+            assert t1 - t0 >= behavior['min_on_time']
+            assert s1 is Status.Off
+        elif last_start is not None:
+            assert t1 - t0 >= behavior['min_off_time']
+            assert t1 - last_start >= behavior['min_cycle_time']
+        if s1 is not Status.Off:
+            last_start = t1
+    return
+
+
+def test_heats_to_set_point(simulation, nido_config):
+    nido_config.set_mode('Heat')
+    nido_config.set_temp(21, 'C')
+    sim = simulation(temp=18.0)
+    sim.run(600, step=60)
+    assert sim.transitions[-1][1] is Status.Heating
+    assert GPIO.input(sim.controller._HEATING)
+    assert not GPIO.input(sim.controller._COOLING)
+
+    stats = sim.run(6 * 3600, step=60)
+    assert stats['cycles']['Heating'] >= 1
+    assert abs(sim.house.temp - 21) < 1.0
+
+
+def test_short_cycle_limits(simulation, nido_config):
+    # A noisy sensor keeps flipping the demand, so only the timing
+    # limits prevent short cycles
+    nido_config.set_mode('Heat')
+    nido_config.set_temp(20, 'C')
+    sim = simulation(temp=20.0, noise=0.5)
+    sim.run(12 * 3600, step=30)
+    behavior = nido_config.get_config()['behavior']
+    assert len(sim.transitions) > 4
+    _check_timing(sim.transitions, behavior)
+
+
+def test_heat_cool_passes_through_off(simulation, nido_config):
+    nido_config.set_mode('Heat_Cool')
+    nido_config.set_temp(20, 'C')
+    # Large outdoor swings make the house need heating at night and
+    # cooling during the day
+    sim = simulation(temp=20.0,
+                     outdoor=OutdoorProfile(mean=20.0, amplitude=20.0))
+    sim.run(3 * 86400, step=60)
+    statuses = [s for _, s in sim.transitions]
+    assert Status.Heating in statuses and Status.Cooling in statuses
+    for s0, s1 in zip(statuses, statuses[1:]):
+        assert Status.Off in (s0, s1)
+    _check_timing(sim.transitions, nido_config.get_config()['behavior'])
+
+
+def test_mode_off_stops_immediately(simulation, nido_config):
+    nido_config.set_mode('Heat')
+    nido_config.set_temp(22, 'C')
+    sim = simulation(temp=18.0)
+    sim.run(60, step=60)
+    assert sim.transitions[-1][1] is Status.Heating
+
+    # Well within min_on_time
+    nido_config.set_mode('Off')
+    sim.run(60, step=60)
+    assert sim.transitions[-1][1] is Status.Off
+    assert not GPIO.input(sim.controller._HEATING)
+
+
+def test_hold_remaining(simulation, nido_config):
+    nido_config.set_mode('Heat')
+    nido_config.set_temp(22, 'C')
+    sim = simulation(temp=18.0)
+    sim.run(60, step=60)
+    # Drop the set point so heating is no longer wanted, it keeps
+    # running for the rest of min_on_time
+    nido_config.set_temp(10, 'C')
+    sim.run(60, step=60)
+    behavior = nido_config.get_config()['behavior']
+    assert sim.controller.get_stats()['status'] == 'Heating'
+    assert 0 < sim.controller.hold_remaining <= behavior['min_on_time']
+    sim.run(behavior['min_on_time'], step=60)
+    assert sim.controller.get_stats()['status'] == 'Off'
+
+
+def test_engine_survives_errors(simulation, nido_config, monkeypatch):
+    nido_config.set_mode('Heat')
+    nido_config.set_temp(22, 'C')
+    sim = simulation(temp=18.0)
+    engine = ControllerEngine(sim.controller, 30, 300, 3.0)
+    engine._evaluate('test')
+    assert GPIO.input(sim.controller._HEATING)
+
+    def fail():
+        raise RuntimeError('bad schedule data')
+
+    monkeypatch.setattr(sim.controller, '_update', fail)
+    engine._evaluate('test')
+    assert engine.updates == 2
+    assert not GPIO.input(sim.controller._HEATING)
+
+
+def test_engine_interval(simulation, nido_config):
+    nido_config.set_mode('Heat')
+    nido_config.set_temp(21, 'C')
+    # The engine reads the controller's sensor, not the real one
+    sim = simulation(temp=19.5)
+    engine = ControllerEngine(sim.controller, 30, 300, 3.0)
+    engine._evaluate('test')
+    assert sim.controller.target_temp == 21
+    assert engine._interval == pytest.approx(165, abs=15)
+
+    # An early start moves the set point the interval is based on
+    sim.controller.target_temp = 19.5
+    assert engine._next_interval() == pytest.approx(30, abs=15)
+
+
+def test_shutdown_writes_pins_once(simulation, nido_config, monkeypatch):
+    nido_config.set_mode('Heat')
+    nido_config.set_temp(22, 'C')
+    sim = simulation(temp=18.0)
+    sim.run(60, step=60)
+    writes = []
+    output = GPIO.output
+
+    def record(pin, state):
+        writes.append((pin, state))
+        output(pin, state)
+
+    monkeypatch.setattr(GPIO, 'output', record)
+    sim.controller.shutdown()
+    # Both pins, even where the shadow says they're already off
+    assert sorted(writes) == sorted([(sim.controller._HEATING, False),
+                                     (sim.controller._COOLING, False)])
+    assert sim.transitions[-1][1] is Status.Off
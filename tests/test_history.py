@@ -0,0 +1,115 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+
+import pytest
+from flask import Flask
+
+from lib import nidoserver
+from lib.history import History, HistoryError
+from lib.nido import Status
+
+START = 1000000000.0
+CONDITIONS = {'temp_c': 20.0, 'relative_humidity': 50.0,
+              'pressure_mb': 1010.0}
+
+
+@pytest.fixture
+def history(tmpdir):
+    history = History(str(tmpdir.join('history.db')))
+    for i in range(10):
+        history.record(START + i * 10, CONDITIONS, 21.0, 'Heat',
+                       Status.Off.value)
+    history.record_event(START - 100, Status.Off.value, 'Heat', 21.0)
+    history.record_event(START + 50, Status.Heating.value, 'Heat', 21.0)
+    yield history
+    history.close()
+
+
+def test_readonly(tmpdir):
+    path = str(tmpdir.join('history.db'))
+    history = History(path, readonly=True)
+    with pytest.raises(HistoryError):
+        history.snapshot()
+    # Readers don't create the database
+    assert not tmpdir.join('history.db').exists()
+    with pytest.raises(HistoryError):
+        history.record_event(START, Status.Off.value, 'Heat', 21.0)
+
+
+def test_snapshot(history):
+    reader = History(history._db_path, readonly=True)
+    snapshot = reader.snapshot()
+    columns = snapshot.iter_columns(History.COLUMN_ORDER, START,
+                                    START + 1000, History.RAW)
+    # Changes made after the snapshot was taken aren't seen by it
+    history.record(START + 100, CONDITIONS, 21.0, 'Heat',
+                   Status.Heating.value)
+    history.record_event(START + 90, Status.Off.value, 'Heat', 21.0)
+    history.prune(now=START + 7 * 86400 + 25)
+    events = snapshot.get_events(START, START + 1000)
+    assert [e['status'] for e in events] == [Status.Off.value,
+                                             Status.Heating.value]
+    assert [len(list(values)) for _, values in columns] == [10] * 10
+    snapshot.close()
+
+    snapshot = reader.snapshot()
+    assert len(snapshot.get_events(START, START + 1000)) == 2
+    snapshot.close()
+
+
+def test_history_helper(history, monkeypatch):
+    monkeypatch.setitem(nidoserver._HISTORY, 'history',
+                        History(history._db_path, readonly=True))
+    closed = []
+    snapshot = History.snapshot
+
+    def tracked(self):
+        result = snapshot(self)
+        closed.append(False)
+        close = result.close
+
+        def track_close():
+            closed[-1] = True
+            close()
+
+        result.close = track_close
+        return result
+
+    monkeypatch.setattr(History, 'snapshot', tracked)
+    app = Flask(__name__)
+    with app.app_context():
+        response = nidoserver.history_helper(
+            app, nidoserver.JSONResponse(),
+            {'from': START, 'to': START + 1000, 'resolution': 'raw'}
+        )
+        data = json.loads(response.get_data(as_text=True))
+        response.close()
+    assert data['columns']['ts'] == [START + i * 10 for i in range(10)]
+    assert len(data['events']) == 2
+    assert closed == [True]
+
+    # Closed even if the response is never read
+    with app.app_context():
+        response = nidoserver.history_helper(
+            app, nidoserver.JSONResponse(), {'resolution': 'raw'}
+        )
+        response.close()
+    assert closed == [True, True]
@@ -0,0 +1,65 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+
+import pytest
+
+from lib.optimalstart import OptimalStart
+
+BEHAVIOR = {'deadband': 2.0, 'hysteresis': 0.5}
+
+
+class _Timeline(object):
+    """Stands in for the schedule's Timeline with a single change."""
+
+    def __init__(self, value, mode='Heat'):
+        self.value = value
+        self.mode = mode
+
+    def next_change(self, t=None, kind=None):
+        return {'time': t + 3600, 'job_id': 'wake', 'kind': 'set_temp',
+                'value': self.value}
+
+    def at(self, t=None):
+        return {'mode_set': self.mode}
+
+
+def _optimal_start(timeline):
+    # The outdoor temperature is constant, the rate the default
+    return OptimalStart(timeline, outdoor=lambda: 5.0,
+                        default_heat_rate=0.05)
+
+
+def test_starts_early():
+    start = _optimal_start(_Timeline(21.0))
+    # 2C at 0.05C/min takes 40 minutes, the change is an hour away
+    assert start.target(0, 'Heat', 19.0, 17.0, BEHAVIOR) == 17.0
+    assert start.target(0, 'Heat', 17.0, 17.0, BEHAVIOR) == 21.0
+    assert start.active['job_id'] == 'wake'
+
+
+@pytest.mark.parametrize('value', ['hot', None, [21], float('nan')])
+def test_invalid_change(value):
+    start = _optimal_start(_Timeline(value))
+    assert start.target(0, 'Heat', 15.0, 17.0, BEHAVIOR) == 17.0
+    assert start.active is None
+
+
+def test_string_value():
+    start = _optimal_start(_Timeline('21'))
+    assert start.target(0, 'Heat', 15.0, 17.0, BEHAVIOR) == 21.0
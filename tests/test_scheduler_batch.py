@@ -0,0 +1,186 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+# Batch schedule changes, applied by NidoSchedulerService to an
+# in-process scheduler. The client's RPC connection is replaced with the
+# service itself.
+
+import pytest
+from apscheduler.events import (EVENT_JOB_ADDED, EVENT_JOB_MODIFIED,
+                                EVENT_JOB_REMOVED, EVENT_ALL_JOBS_REMOVED)
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from lib.scheduler import (NidoDaemonService, NidoDaemonServiceError,
+                           NidoSchedulerService)
+from lib.timeline import Timeline
+
+
+class _Connection(object):
+    closed = False
+
+    def __init__(self, root):
+        self.root = root
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = BackgroundScheduler(jobstores={
+        'default': MemoryJobStore(),
+        'schedule': MemoryJobStore()
+    })
+    # Paused, so no job fires during a test
+    scheduler.start(paused=True)
+    yield scheduler
+    scheduler.shutdown(wait=False)
+
+
+@pytest.fixture
+def timeline(scheduler):
+    timeline = Timeline()
+    timeline.rebuild()
+
+    def update(event):
+        if event.code == EVENT_ALL_JOBS_REMOVED:
+            timeline.clear()
+        elif event.jobstore == 'schedule':
+            job = None
+            if event.code != EVENT_JOB_REMOVED:
+                job = scheduler.get_job(event.job_id, 'schedule')
+            timeline.update_job(event.job_id, job)
+
+    scheduler.add_listener(update, EVENT_JOB_ADDED | EVENT_JOB_MODIFIED
+                           | EVENT_JOB_REMOVED | EVENT_ALL_JOBS_REMOVED)
+    return timeline
+
+
+@pytest.fixture
+def client(scheduler, timeline):
+    client = NidoDaemonService(json=True)
+    client._connection = _Connection(
+        NidoSchedulerService(scheduler, timeline=timeline)
+    )
+    return client
+
+
+def _week():
+    operations = []
+    for day in ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']:
+        for hour, temp in [(6, 21), (9, 17), (17, 21), (22, 16)]:
+            operations.append({
+                'op': 'add', 'type': 'temp', 'temp': temp, 'scale': 'C',
+                'day_of_week': day, 'hour': hour, 'minute': 30,
+                'job_id': '{}-{}'.format(day, hour)
+            })
+    return operations
+
+
+def _state(scheduler):
+    # Triggers are compared by field, as exported ones spell out defaults
+    return sorted((j.id, j.name, tuple(j.args),
+                   tuple(str(f) for f in j.trigger.fields),
+                   j.next_run_time is None)
+                  for j in scheduler.get_jobs('schedule'))
+
+
+def test_apply_and_export(client, scheduler, timeline):
+    operations = _week() + [
+        {'op': 'add', 'type': 'mode', 'mode': 'Heat', 'hour': 0,
+         'job_id': 'mode'},
+        {'op': 'pause', 'job_id': 'sun-22'},
+        {'op': 'modify', 'job_id': 'mon-6', 'type': 'temp', 'temp': 22,
+         'scale': 'C'},
+        {'op': 'remove', 'job_id': 'mon-9'}
+    ]
+    result = client.apply_schedule_batch(operations)
+    assert result['applied'] == len(operations)
+    assert len(result['jobs']) == 28
+    assert scheduler.get_job('sun-22').next_run_time is None
+    assert scheduler.get_job('mon-6').args == (22, 'C')
+    client.apply_schedule_batch([
+        {'op': 'modify', 'job_id': 'mon-6', 'type': 'temp', 'temp': '72',
+         'scale': 'f'}
+    ])
+    # Stored as a number and an upper case scale
+    assert scheduler.get_job('mon-6').args == (72.0, 'F')
+    assert timeline.next_change() is not None
+
+    exported = client.export_schedule()
+    assert exported['skipped'] == []
+    assert len(exported['operations']) == 28
+    state = _state(scheduler)
+    client.apply_schedule_batch(exported['operations'], replace=True)
+    assert _state(scheduler) == state
+
+
+def test_invalid_batch_changes_nothing(client, scheduler):
+    client.apply_schedule_batch(_week())
+    state = _state(scheduler)
+    for operations in [
+        # Conflicting ID
+        [{'op': 'remove', 'job_id': 'mon-6'},
+         {'op': 'add', 'type': 'mode', 'mode': 'Cool', 'hour': 1,
+          'job_id': 'tue-6'}],
+        # Invalid cron expression
+        [{'op': 'remove', 'job_id': 'mon-6'},
+         {'op': 'add', 'type': 'mode', 'mode': 'Cool', 'hour': 99}],
+        # Missing job
+        [{'op': 'remove', 'job_id': 'mon-6'},
+         {'op': 'pause', 'job_id': 'missing'}],
+        # Removed earlier in the batch
+        [{'op': 'remove', 'job_id': 'mon-6'},
+         {'op': 'resume', 'job_id': 'mon-6'}],
+        [{'op': 'unknown', 'job_id': 'mon-6'}],
+        # Invalid set points
+        [{'op': 'modify', 'job_id': 'mon-6', 'type': 'temp',
+          'temp': 'warm', 'scale': 'C'}],
+        [{'op': 'modify', 'job_id': 'mon-6', 'type': 'temp', 'temp': 21,
+          'scale': 'K'}]
+    ]:
+        with pytest.raises(NidoDaemonServiceError):
+            client.apply_schedule_batch(operations)
+        assert _state(scheduler) == state
+
+
+def test_failed_batch_rolls_back(client, scheduler, timeline, monkeypatch):
+    client.apply_schedule_batch(_week() + [
+        {'op': 'pause', 'job_id': 'sun-22'}
+    ])
+    state = _state(scheduler)
+    start = timeline.at()['time']
+    segments = timeline.segments(start)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('disk full')
+
+    monkeypatch.setattr(scheduler, 'resume_job', fail)
+    with pytest.raises(NidoDaemonServiceError):
+        client.apply_schedule_batch([
+            {'op': 'remove', 'job_id': 'mon-6'},
+            {'op': 'add', 'type': 'temp', 'temp': 18, 'scale': 'C',
+             'hour': 12, 'job_id': 'noon'},
+            {'op': 'resume', 'job_id': 'sun-22'}
+        ], replace=False)
+    assert _state(scheduler) == state
+    assert timeline.segments(start) == segments
+
+    with pytest.raises(NidoDaemonServiceError):
+        client.apply_schedule_batch([
+            {'op': 'resume', 'job_id': 'sun-22'}
+        ], replace=True)
+    assert _state(scheduler) == state
@@ -0,0 +1,182 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from collections import namedtuple
+
+import pytest
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.util import utc_timestamp_to_datetime
+
+from lib.timeline import Timeline, TimelineError
+
+SET_TEMP = 'nidod:NidoSchedulerService.set_temp'
+SET_MODE = 'nidod:NidoSchedulerService.set_mode'
+
+# Stand-in for an APScheduler Job
+Job = namedtuple('Job', ['trigger', 'func_ref', 'args', 'next_run_time'])
+
+
+def _day_start():
+    now = time.time()
+    return now - now % 86400
+
+
+@pytest.fixture
+def timeline(nido_config):
+    nido_config.set_mode('Heat')
+    nido_config.set_temp(20, 'C')
+    tl = Timeline(jobs=[
+        ('wake', CronTrigger(hour=6, timezone='UTC'), SET_TEMP, (21, 'C')),
+        ('night', CronTrigger(hour=22, timezone='UTC'), SET_TEMP,
+         (60.8, 'F')),
+        ('cool', CronTrigger(hour=12, timezone='UTC'), SET_MODE, ('Cool',))
+    ])
+    tl.rebuild(_day_start())
+    return tl
+
+
+def test_at(timeline):
+    day = _day_start()
+    result = timeline.at(day + 7 * 3600)
+    assert result['set_temperature'] == 21
+    assert result['job_id'] == 'wake'
+    assert result['since'] == day + 6 * 3600
+    assert result['until'] == day + 12 * 3600
+    # Before anything is scheduled the configuration applies
+    assert result['mode_set'] == 'Heat'
+    # Fahrenheit set points are converted
+    result = timeline.at(day + 23 * 3600)
+    assert result['set_temperature'] == pytest.approx(16.0)
+    assert result['mode_set'] == 'Cool'
+
+
+def test_next_change(timeline):
+    day = _day_start()
+    change = timeline.next_change(day + 7 * 3600)
+    assert change['job_id'] == 'cool'
+    change = timeline.next_change(day + 7 * 3600, kind='set_temp')
+    assert change['job_id'] == 'night'
+    assert change['time'] == day + 22 * 3600
+
+
+def test_segments(timeline):
+    day = _day_start()
+    segments = timeline.segments(day + 3600, day + 86400)
+    assert [s['job_id'] for s in segments] == [None, 'wake', 'cool', 'night']
+    assert segments[0]['set_temperature'] == 20
+    for s0, s1 in zip(segments, segments[1:]):
+        assert s0['end'] == s1['start']
+    assert segments[-1]['end'] == day + 86400
+
+
+def test_update_job(timeline):
+    day = _day_start()
+    t = day + 7 * 3600
+    # Paused jobs have no next run time and are left out
+    job = Job(CronTrigger(hour=6, timezone='UTC'), SET_TEMP, (21, 'C'), None)
+    timeline.update_job('wake', job)
+    assert timeline.at(t)['job_id'] is None
+    job = job._replace(args=(23, 'C'), next_run_time=day)
+    timeline.update_job('wake', job)
+    assert timeline.at(t)['set_temperature'] == 23
+    timeline.update_job('wake', None)
+    assert timeline.at(t)['set_temperature'] == 20
+
+
+def test_batch_defers_merge(timeline):
+    day = _day_start()
+    job = Job(CronTrigger(hour=8, timezone='UTC'), SET_TEMP, (19, 'C'), day)
+    with timeline.batch():
+        timeline.update_job('morning', job)
+        timeline.update_job('night', None)
+        # Not merged until the end of the batch
+        assert timeline.at(day + 9 * 3600)['job_id'] == 'wake'
+    assert timeline.at(day + 9 * 3600)['job_id'] == 'morning'
+    assert timeline.next_change(day + 9 * 3600, kind='set_temp')[
+        'job_id'] == 'wake'
+
+
+def test_clear(timeline):
+    timeline.clear()
+    assert timeline.next_change() is None
+    assert len(timeline.segments()) == 1
+
+
+@pytest.mark.parametrize('t', ['now', [1], True, float('nan'),
+                               float('inf')])
+def test_invalid_time(timeline, t):
+    with pytest.raises(TimelineError):
+        timeline.at(t)
+    with pytest.raises(TimelineError):
+        timeline.segments(t)
+
+
+def test_invalid_range(timeline):
+    day = _day_start()
+    with pytest.raises(TimelineError):
+        timeline.segments(day + 3600, day)
+    with pytest.raises(TimelineError):
+        timeline.at(day + 30 * 86400)
+
+
+def test_past_query_extends_window(nido_config):
+    day = _day_start()
+    # Triggers don't fire before their start date
+    since = utc_timestamp_to_datetime(day - 2 * 86400)
+    timeline = Timeline(jobs=[
+        (job_id, CronTrigger(hour=hour, timezone='UTC', start_date=since),
+         func, args)
+        for job_id, hour, func, args in [
+            ('wake', 6, SET_TEMP, (21, 'C')),
+            ('night', 22, SET_TEMP, (16, 'C')),
+            ('cool', 12, SET_MODE, ('Cool',))
+        ]
+    ])
+    timeline.rebuild(day)
+    end = timeline._end
+    rebuilds = timeline.rebuilds
+    segments = timeline.segments(day - 86400, day + 86400)
+    assert [s['job_id'] for s in segments] == [
+        None, 'wake', 'cool', 'night', 'wake', 'cool', 'night'
+    ]
+    assert timeline.at(day - 86400 + 7 * 3600)['job_id'] == 'wake'
+    assert timeline.rebuilds == rebuilds
+    assert timeline._end == end
+    # Still answers up to a week ahead
+    assert timeline.at(time.time() + 7 * 86400) is not None
+
+
+@pytest.mark.parametrize('args', [('70', 'F'), ('hot', 'C'), (21, 'K'),
+                                  (21,), None])
+def test_invalid_job_skipped(nido_config, args):
+    nido_config.set_temp(20, 'C')
+    tl = Timeline(jobs=[
+        ('bad', CronTrigger(hour=8, timezone='UTC'), SET_TEMP, args),
+        ('wake', CronTrigger(hour=6, timezone='UTC'), SET_TEMP, ('21', 'C'))
+    ])
+    day = _day_start()
+    tl.rebuild(day)
+    result = tl.at(day + 9 * 3600)
+    if args == ('70', 'F'):
+        # Strings are converted
+        assert result['job_id'] == 'bad'
+        assert result['set_temperature'] == pytest.approx(21.1)
+    else:
+        assert result['job_id'] == 'wake'
+        assert result['set_temperature'] == 21.0
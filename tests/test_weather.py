@@ -0,0 +1,261 @@
+#   Nido, a Raspberry Pi-based home thermostat.
+#
+#   Copyright (C) 2016 Alex Marshall
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.
+#   If not, see <http://www.gnu.org/licenses/>.
+
+
+# Weather providers and the weather cache against a stub HTTP server.
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from lib import nido
+from lib.nido import LocalWeather, WeatherCache
+from lib.weather import JSONProvider, WeatherProviderError, \
+    WundergroundProvider
+
+CONDITIONS = {
+    'location': {
+        'full': 'Springfield, IL', 'city': 'Springfield', 'state': 'IL',
+        'zipcode': '62701', 'country': 'US',
+        'coordinates': {'latitude': '39.80', 'longitude': '-89.64'}
+    },
+    'temp_c': 12.5,
+    'relative_humidity': 60,
+    'pressure_mb': '1015',
+    'condition': {'description': 'Clear',
+                  'icon_url': 'https://icons.example.com/clear.gif'},
+    'forecast': {'high': 15.0, 'low': 4.0},
+    'solar': {'sunrise': 612, 'sunset': 1845}
+}
+
+WUNDERGROUND = {
+    'current_observation': {
+        'display_location': {
+            'full': 'Springfield, IL', 'city': 'Springfield', 'state': 'IL',
+            'zip': '62701', 'country': 'US', 'latitude': '39.80',
+            'longitude': '-89.64'
+        },
+        'temp_c': 12.5,
+        'relative_humidity': '60%',
+        'pressure_mb': '1015',
+        'weather': 'Clear',
+        'icon_url': 'http://icons.example.com/clear.gif'
+    },
+    'forecast': {'simpleforecast': {'forecastday': [
+        {'period': 1, 'high': {'celsius': '15'}, 'low': {'celsius': '4'}},
+        {'period': 2, 'high': {'celsius': '17'}, 'low': {'celsius': '6'}}
+    ]}},
+    'sun_phase': {
+        'sunrise': {'hour': '6', 'minute': '12'},
+        'sunset': {'hour': '18', 'minute': '45'}
+    }
+}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        stub = self.server.stub
+        with stub.lock:
+            stub.requests.append(self.path)
+            status, body, delay = stub.routes.get(
+                self.path, (404, {'error': 'not found'}, 0)
+            )
+        time.sleep(delay)
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        return
+
+
+class _Stub(object):
+    """Serves routes = {path: (status, body, delay)} on localhost and
+    records the paths requested."""
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.stub = self
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_port)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def stub():
+    stub = _Stub()
+    yield stub
+    stub.close()
+
+
+def test_wunderground(stub):
+    stub.routes['/api/KEY/conditions/forecast/astronomy/q/62701.json'] = (
+        200, WUNDERGROUND, 0
+    )
+    provider = WundergroundProvider('KEY', api_url=stub.url + '/api',
+                                    timeout=5)
+    conditions = provider.get_conditions('62701')
+    assert conditions == CONDITIONS
+
+
+def test_wunderground_api_error(stub):
+    stub.routes['/api/KEY/conditions/forecast/astronomy/q/autoip.json'] = (
+        200, {'response': {'error': {'type': 'keynotfound',
+                                     'description': 'Invalid key'}}}, 0
+    )
+    provider = WundergroundProvider('KEY', api_url=stub.url + '/api',
+                                    timeout=5)
+    with pytest.raises(WeatherProviderError) as e:
+        provider.get_conditions('autoip')
+    assert 'keynotfound' in str(e.value)
+
+
+def test_json_provider(stub):
+    stub.routes['/weather/62701'] = (200, {'data': CONDITIONS}, 0)
+    provider = JSONProvider(stub.url + '/weather/{query}', key='data',
+                            timeout=5)
+    assert provider.get_conditions('62701') == CONDITIONS
+
+    stub.routes['/weather/62701'] = (200, {'data': {'temp_c': 1}}, 0)
+    with pytest.raises(WeatherProviderError):
+        provider.get_conditions('62701')
+
+
+@pytest.mark.parametrize('status', [301, 404, 500, 503])
+def test_error_responses(stub, status):
+    # Error pages are rejected even if they contain valid conditions
+    stub.routes['/weather'] = (status, CONDITIONS, 0)
+    provider = JSONProvider(stub.url + '/weather', timeout=5)
+    with pytest.raises(WeatherProviderError):
+        provider.get_conditions('autoip')
+
+
+def test_invalid_json(stub):
+    stub.routes['/weather'] = (200, b'<html>Not JSON</html>', 0)
+    provider = JSONProvider(stub.url + '/weather', timeout=5)
+    with pytest.raises(WeatherProviderError):
+        provider.get_conditions('autoip')
+
+
+def test_timeout(stub):
+    stub.routes['/weather'] = (200, CONDITIONS, 2)
+    provider = JSONProvider(stub.url + '/weather', timeout=(1, 0.2))
+    start = time.time()
+    with pytest.raises(WeatherProviderError):
+        provider.get_conditions('autoip')
+    assert time.time() - start < 1.5
+
+
+def test_fetch_coalesces(stub):
+    stub.routes['/weather'] = (200, CONDITIONS, 0.3)
+    provider = JSONProvider(stub.url + '/weather', timeout=5)
+    cache = WeatherCache()
+    results = []
+
+    def fetch():
+        results.append(cache.fetch('autoip', lambda: {
+            'weather': provider.get_conditions('autoip')
+        }))
+
+    threads = [threading.Thread(target=fetch) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(stub.requests) == 1
+    assert results == [{'weather': CONDITIONS}] * 5
+
+
+def test_fetch_error(stub):
+    stub.routes['/weather'] = (500, {}, 0)
+    provider = JSONProvider(stub.url + '/weather', timeout=5)
+    result = WeatherCache().fetch('autoip',
+                                  lambda: provider.get_conditions('autoip'))
+    assert 'error' in result
+
+
+@pytest.fixture
+def local_weather(stub, monkeypatch):
+    """Points LocalWeather at a JSONProvider for stub.url/weather, with
+    an empty cache."""
+    monkeypatch.setattr(nido, '_WEATHER_CACHE', WeatherCache())
+    provider = JSONProvider(stub.url + '/weather', timeout=5)
+    weather = LocalWeather()
+    # Every LocalWeather with this configuration shares the provider
+    monkeypatch.setitem(nido._WEATHER_PROVIDERS, weather._provider_key,
+                        provider)
+    return weather
+
+
+def test_stale_while_revalidate(stub, local_weather):
+    old = dict(CONDITIONS, temp_c=5.0)
+    expiry = local_weather._CACHE_EXPIRY
+    nido._WEATHER_CACHE.set('autoip', old,
+                            retrieval_time=int(time.time()) - expiry - 10)
+    stub.routes['/weather'] = (200, CONDITIONS, 0.3)
+
+    # Expired conditions are served at once, refreshed in the background
+    start = time.time()
+    for _ in range(3):
+        resp = local_weather.get_conditions()
+        assert resp['weather'] == old
+        assert resp['retrieval_age'] >= expiry
+    assert time.time() - start < 0.3
+
+    deadline = time.time() + 5
+    while (nido._WEATHER_CACHE.get('autoip')[1] == old
+           and time.time() < deadline):
+        time.sleep(0.05)
+    resp = local_weather.get_conditions()
+    assert resp['weather'] == CONDITIONS
+    assert resp['retrieval_age'] < expiry
+    # One refresh for all the stale requests
+    assert len(stub.requests) == 1
+
+
+def test_first_request_waits(stub, local_weather, monkeypatch):
+    stub.routes['/weather'] = (200, CONDITIONS, 0)
+    resp = local_weather.get_conditions()
+    assert resp['weather'] == CONDITIONS
+    assert resp['retrieval_age'] <= 1
+
+    monkeypatch.setattr(nido, '_WEATHER_CACHE', WeatherCache())
+    stub.routes['/weather'] = (500, {}, 0)
+    resp = local_weather.get_conditions()
+    assert 'error' in resp and 'weather' not in resp